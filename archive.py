@@ -0,0 +1,747 @@
+# Re-analysis of archived calibration outputs
+#
+# Years of calibrations survive only as the .tex files rodcal.py and
+# rodbank.py generated: report-N.tex, worthtable-N.tex and banktable-N.tex.
+# Ingesting an archive walks a directory tree for them, parses each back
+# into numbers in a pool of worker processes, and appends the numbers to a
+# columnar store as they arrive:
+#
+#     report    one row per calibration: every Tech Specs value in the
+#               report, and the coefficients of its six fits
+#     worth     one row per worth table entry: calibration, rod, height, worth
+#     bank      one row per bank table cell: calibration, core excess, power,
+#               height (NaN where the table is blank)
+#
+# Each column is a flat binary file, appended to a file at a time and
+# memory-mapped for reading, so neither ingesting nor reading needs more than
+# one file's (or one query's) worth of memory, however big the archive.
+# Files are read a chunk at a time too. Calibrations are named by their
+# directory and file number (the N in report-N.tex), and a re-run only reads
+# files that are new or changed. A changed file's new rows are appended and
+# its old ones marked deleted, so whole columns hold each calibration once.
+# Usage:
+#
+#     python archive.py ingest ARCHIVE [ARCHIVE ...] -o STORE [-j 8]
+#     python archive.py list STORE
+#     python archive.py compare STORE [records.json] [--history FILE]
+#
+# compare refits the calibrations it finds pulls for (records whose ID
+# matches a calibration's file number, or history calibrations whose ID and
+# store tag do, as in report-h<ID>-<tag>.tex) with the current reactivity_calc() and says
+# how far the archived tables and fits are from the new ones.
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import re
+
+import numpy as np
+
+RODS = ["safe", "shim", "reg"]
+KINDS = ["report", "worthtable", "banktable"]
+FILENAME = re.compile(r"^(report|worthtable|banktable)(?:-(.+))?\.tex$")
+
+# Bytes read from a file at once
+CHUNK_BYTES = 1 << 16
+
+# The report's tables: the label starting each row, and the values in its
+# bold cells, in order
+REPORT_ROWS = {
+    "Safe Rod": ["safeworth"],
+    "Shim Rod": ["shimworth"],
+    "Reg Rod": ["regworth"],
+    "Total": ["totalworth"],
+    "Safe": ["safemaxdpp", "safemaxdps", "safedpsok"],
+    "Shim": ["shimmaxdpp", "shimmaxdps", "shimdpsok"],
+    "Reg": ["regmaxdpp", "regmaxdps", "regdpsok"],
+    "CXS height": ["safecxsht", "shimcxsht"],
+    "Core excess": ["safecxs", "shimcxs", "cxsok"],
+    "Shutdown margin": ["safesdm", "shimsdm", "sdmok"],
+    "One-stuck-rod SDM": ["safeosr", "shimosr", "osrok"],
+}
+REPORT_VALUES = [value for label in ["Safe Rod", "Shim Rod", "Reg Rod",
+                                     "Total", "Safe", "Shim", "Reg",
+                                     "CXS height", "Core excess",
+                                     "Shutdown margin", "One-stuck-rod SDM"]
+                 for value in REPORT_ROWS[label]]
+# The fits listed at the end of the report
+REPORT_FITS = {
+    "Safe Int. Worth:": "safeintpoly",
+    "Safe Add. Rate:": "safeaddpoly",
+    "Shim Int. Worth:": "shimintpoly",
+    "Shim Add. Rate:": "shimaddpoly",
+    "Reg Int. Worth:": "regintpoly",
+    "Reg Add. Rate:": "regaddpoly",
+}
+FITS = ["safeintpoly", "safeaddpoly", "shimintpoly", "shimaddpoly",
+        "regintpoly", "regaddpoly"]
+
+# The store's tables: (column, dtype, width)
+SCHEMA = {
+    "report": ([("calibration", "<i4", 1)] +
+               [(value, "<f8", 1) for value in REPORT_VALUES] +
+               [(fit, "<f8", 4) for fit in FITS]),
+    "worth": [("calibration", "<i4", 1), ("rod", "<i1", 1),
+              ("height", "<f8", 1), ("worth", "<f8", 1)],
+    "bank": [("calibration", "<i4", 1), ("core_excess", "<f8", 1),
+             ("power", "<f8", 1), ("height", "<f8", 1)],
+}
+
+_BOLD = re.compile(r"\\textbf\{([^}]*)\}")
+_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|nan|inf")
+# A coefficient as rodcal.tex_polynomial() writes it: plain, or as
+# (m \times 10^{e})
+_COEFFICIENT = re.compile(
+    r"\(([-+]?[\d.]+) \\times 10\^\{([-+]?\d+)\}\)|([-+]?[\d.]+|nan|inf)")
+_ROD_HEADING = re.compile(r"\\bf (Safe|Shim|Reg) Rod\s*$")
+_STUCK_ROD = re.compile(r"in this case the \\textbf\{([^}]*)\}")
+_ROW_END = re.compile(r"\\\\|\n")
+
+
+def rows(f, chunk=CHUNK_BYTES):
+    """
+    Read a generated .tex file a chunk at a time, split into TeX rows: at
+    each \\\\ and each line break. Tables like rodbank.py's, written as one
+    long line, come out a row at a time all the same.
+
+    Yields:
+        Each row, without the \\\\ or line break.
+    """
+    rest = ""
+    while True:
+        data = f.read(chunk)
+        if not data:
+            break
+        pieces = _ROW_END.split(rest + data)
+        # The last piece may continue in the next chunk, and a \ at its end
+        # may be the start of a \\
+        rest = pieces.pop()
+        for piece in pieces:
+            yield piece
+    if rest:
+        yield rest
+
+def parse_report(f):
+    """
+    Parse a report from rodcal.write_report().
+
+    Returns:
+        A dict of each of REPORT_VALUES found (flags as 1.0 for OK and 0.0
+        for PROBLEM), "mostrxvrod", and each of FITS found as its four
+        coefficients, highest power first (NaN for curves other than
+        cubics).
+    """
+    result = {}
+    for row in rows(f):
+        stuck = _STUCK_ROD.search(row)
+        if stuck:
+            result["mostrxvrod"] = stuck.group(1)
+        label, _, rest = row.partition("&")
+        label = label.strip()
+        if label in REPORT_FITS:
+            result[REPORT_FITS[label]] = _coefficients(rest)
+        elif label in REPORT_ROWS:
+            for value, cell in zip(REPORT_ROWS[label], _BOLD.findall(rest)):
+                result[value] = _value(cell)
+    return result
+
+def parse_worthtable(f):
+    """
+    Parse worth tables from rodcal.write_tables().
+
+    Returns:
+        A dict from each rod to its (heights, worths) arrays, in order of
+        height, and "totals", a dict from each rod to its total worth.
+    """
+    pairs = dict((rod, []) for rod in RODS)
+    totals = {}
+    rod = None
+    for row in rows(f):
+        heading = _ROD_HEADING.search(row)
+        if heading:
+            rod = heading.group(1).lower()
+            continue
+        stripped = row.strip()
+        if stripped.startswith("Total Worth:") and rod is not None:
+            totals[rod] = _value(stripped)
+        elif rod is not None and stripped[:1] in "-.0123456789" and stripped:
+            # height & \$worth & height & \$worth ...
+            pairs[rod].append(np.fromstring(
+                stripped.replace("\\$", " ").replace("&", " "), sep=" "))
+
+    result = {"totals": totals}
+    for rod in RODS:
+        data = (np.concatenate(pairs[rod]) if pairs[rod] else
+                np.empty(0)).reshape(-1, 2)
+        # The table runs down each column in turn
+        order = np.argsort(data[:, 0], kind="mergesort")
+        result[rod] = (data[order, 0], data[order, 1])
+    return result
+
+def parse_banktable(f):
+    """
+    Parse a banked rod height table from rodbank.write_tex().
+
+    Returns:
+        A dict of the "powers" (kW) and "core_excesses" ($) axes, the
+        "heights" (% to the nearest 1%, NaN where blank) of shape (core
+        excesses, powers), and "bold", whether each row was set in bold as
+        being near the xenon-free core excess.
+    """
+    powers = None
+    excesses = []
+    heights = []
+    bold = []
+    for row in rows(f):
+        label, _, rest = row.partition("&")
+        label = label.strip()
+        if label == "Excess":
+            powers = [_value(cell) for cell in rest.split("&")]
+        elif powers is not None and "\\$" in label:
+            cells = rest.split("&")
+            bold.append(label.startswith("\\textbf"))
+            excesses.append(_value(label))
+            heights.append([_value(cell) for cell in cells])
+    width = len(powers or [])
+    grid = np.full((len(heights), width), np.nan)
+    for i, row in enumerate(heights):
+        grid[i, :len(row)] = row[:width]
+    return {"powers": np.array(powers or [], dtype=float),
+            "core_excesses": np.array(excesses, dtype=float),
+            "heights": grid,
+            "bold": np.array(bold, dtype=bool)}
+
+PARSERS = {"report": parse_report, "worthtable": parse_worthtable,
+           "banktable": parse_banktable}
+
+def _value(text):
+    """
+    The number in a cell, 1.0 or 0.0 for OK or PROBLEM, or NaN for none.
+    """
+    text = _BOLD.sub(r"\1", text)
+    if "PROBLEM" in text:
+        return 0.0
+    if "OK" in text:
+        return 1.0
+    match = _NUMBER.search(text)
+    return float(match.group(0)) if match else np.nan
+
+def _coefficients(text):
+    """
+    The coefficients of a cubic from rodcal.tex_polynomial(), or NaNs for a
+    curve written some other way.
+    """
+    if "x^3" not in text:
+        return [np.nan] * 4
+    coefficients = []
+    for term in text.split(" + "):
+        match = _COEFFICIENT.search(term)
+        if match is None:
+            return [np.nan] * 4
+        mantissa, exponent, plain = match.groups()
+        coefficients.append(float(plain) if plain is not None else
+                            float(mantissa) * 10.0 ** int(exponent))
+    if len(coefficients) != 4:
+        return [np.nan] * 4
+    return coefficients
+
+
+def find(directories):
+    """
+    Walk archive directories for generated .tex files.
+
+    Yields:
+        (path, kind, name) for each, kind one of KINDS and name the
+        calibration it belongs to: its directory, relative to the archive
+        directory it was found under, and its file number.
+    """
+    for top in directories:
+        for directory, subdirectories, filenames in os.walk(top):
+            subdirectories.sort()
+            relative = os.path.relpath(directory, top)
+            for filename in sorted(filenames):
+                match = FILENAME.match(filename)
+                if match is None:
+                    continue
+                parts = [part for part in (relative.replace(os.sep, "/"),
+                                           match.group(2))
+                         if part and part != "."]
+                name = "/".join(parts) or os.path.basename(
+                    os.path.abspath(top))
+                yield os.path.join(directory, filename), match.group(1), name
+
+def parse(path, kind):
+    """
+    Parse one generated file.
+
+    Returns:
+        (parsed, error): what its parser returns and None, or None and a
+        description of what went wrong.
+    """
+    try:
+        with open(path) as f:
+            return PARSERS[kind](f), None
+    except Exception as e:
+        return None, "{}: {}".format(type(e).__name__, e)
+
+def _parse_star(job):
+    path, kind, name = job
+    return (path, kind, name) + parse(path, kind)
+
+
+class ColumnStore(object):
+    """
+    Tables stored a column at a time in a directory: each column a flat
+    little-endian binary file, <table>.<column>.bin, appended to as rows
+    arrive and memory-mapped for reading. columns.json says what the
+    columns are, how many rows each table has and which of them have been
+    deleted; rows written after it was last saved (by an interrupted ingest)
+    are ignored. Rows are numbered in the order they were appended, deleted
+    ones included.
+    """
+    MANIFEST = "columns.json"
+
+    def __init__(self, directory, schema=None):
+        """
+        Args:
+            directory: Where the store is, created if need be.
+            schema: {table: [(column, dtype, width), ...]} for a new store;
+                an existing store keeps the schema it was made with.
+        """
+        self.directory = directory
+        manifest = os.path.join(directory, self.MANIFEST)
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                saved = json.load(f)
+            self.schema = dict((table, [tuple(column) for column in columns])
+                               for table, columns in saved["schema"].items())
+            self.counts = saved["rows"]
+            self.deleted = saved.get("deleted") or {}
+        else:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.schema = dict(schema or {})
+            self.counts = dict((table, 0) for table in self.schema)
+            self.deleted = {}
+        # [start, stop) ranges of rows no longer current, by table
+        for table in self.schema:
+            self.deleted.setdefault(table, [])
+        # Drop anything beyond the saved row counts
+        for table, columns in self.schema.items():
+            for column, dtype, width in columns:
+                filename = self._filename(table, column)
+                size = self.counts[table] * width * np.dtype(dtype).itemsize
+                if not os.path.exists(filename):
+                    open(filename, "wb").close()
+                elif os.path.getsize(filename) > size:
+                    with open(filename, "r+b") as f:
+                        f.truncate(size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
+
+    def _filename(self, table, column):
+        return os.path.join(self.directory,
+                            "{}.{}.bin".format(table, column))
+
+    def rows(self, table):
+        """
+        The number of current (not deleted) rows in a table.
+        """
+        return self.counts[table] - sum(stop - start for start, stop
+                                        in self.deleted[table])
+
+    def append(self, table, columns):
+        """
+        Append rows to a table.
+
+        Args:
+            columns: A dict from each of the table's columns to an array of
+                its values, all the same length.
+
+        Returns:
+            (start, stop): the row numbers appended.
+        """
+        lengths = set(len(np.asarray(columns[column]))
+                      for column, _, _ in self.schema[table])
+        if len(lengths) != 1:
+            raise ValueError("{} columns of different lengths: {}".format(
+                table, sorted(lengths)))
+        count = lengths.pop()
+        for column, dtype, width in self.schema[table]:
+            values = np.asarray(columns[column], dtype=dtype)
+            with open(self._filename(table, column), "ab") as f:
+                f.write(values.reshape(count, width).tobytes())
+        start = self.counts[table]
+        self.counts[table] = start + count
+        return start, self.counts[table]
+
+    def delete(self, table, start, stop):
+        """
+        Mark rows start to stop (as append() returned them) deleted. They
+        stay in the files, so later row numbers don't change, but column()
+        leaves them out.
+        """
+        if [start, stop] not in self.deleted[table]:
+            self.deleted[table].append([start, stop])
+
+    def column(self, table, column, deleted=False):
+        """
+        A column's current rows: shape (rows,), or (rows, width) for a column
+        several values wide. A read-only memory map if no rows have been
+        deleted, otherwise a copy of the current ones.
+
+        Args:
+            deleted: Include deleted rows, so that the row numbers append()
+                returned index it, and always give the memory map.
+        """
+        dtype, width = [(d, w) for c, d, w in self.schema[table]
+                        if c == column][0]
+        count = self.counts[table]
+        if count == 0:
+            return np.empty((0, width) if width > 1 else 0, dtype=dtype)
+        shape = (count, width) if width > 1 else (count,)
+        values = np.memmap(self._filename(table, column), dtype=dtype,
+                           mode="r", shape=shape)
+        if deleted or not self.deleted[table]:
+            return values
+        current = np.ones(count, dtype=bool)
+        for start, stop in self.deleted[table]:
+            current[start:stop] = False
+        return values[current]
+
+    def save(self):
+        """
+        Record the row counts and deletions, making the rows appended so far
+        permanent.
+        """
+        manifest = os.path.join(self.directory, self.MANIFEST)
+        with open(manifest + ".tmp", "w") as f:
+            json.dump({"schema": self.schema, "rows": self.counts,
+                       "deleted": self.deleted}, f, indent=2, sort_keys=True)
+        os.rename(manifest + ".tmp", manifest)
+
+
+class Archive(object):
+    """
+    An ingested archive: the ColumnStore of the numbers, and the list of
+    calibrations (calibrations.json) saying which rows are whose.
+
+        archive = Archive("store")
+        heights, worths = archive.worth("2015/4", "safe")
+        archive.report("2015/4")["totalworth"]
+        archive.store.column("report", "totalworth")   # every calibration
+    """
+    CALIBRATIONS = "calibrations.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.store = ColumnStore(directory, SCHEMA)
+        filename = os.path.join(directory, self.CALIBRATIONS)
+        self.calibrations = []
+        self.files = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                saved = json.load(f)
+            self.calibrations = saved["calibrations"]
+            self.files = saved["files"]
+        self._by_name = dict((calibration["name"], i) for i, calibration
+                             in enumerate(self.calibrations))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
+
+    def save(self):
+        self.store.save()
+        filename = os.path.join(self.directory, self.CALIBRATIONS)
+        with open(filename + ".tmp", "w") as f:
+            json.dump({"calibrations": self.calibrations,
+                       "files": self.files}, f, indent=1, sort_keys=True)
+        os.rename(filename + ".tmp", filename)
+
+    @property
+    def names(self):
+        return [calibration["name"] for calibration in self.calibrations]
+
+    def calibration(self, name, create=False):
+        """
+        A calibration's entry: its "name", the "files" it came from, the
+        "rows" of each table that are its, and anything else its files
+        said. KeyError if there's no such calibration (unless create).
+        """
+        if name not in self._by_name:
+            if not create:
+                raise KeyError(name)
+            self._by_name[name] = len(self.calibrations)
+            self.calibrations.append({"name": name, "files": {}, "rows": {},
+                                      "errors": {}})
+        return self.calibrations[self._by_name[name]]
+
+    def add(self, path, kind, name, parsed):
+        """
+        Add one parsed file's numbers, in place of any it had before.
+        """
+        calibration = self.calibration(name, create=True)
+        index = self._by_name[name]
+        calibration["files"][kind] = path
+        calibration["errors"].pop(kind, None)
+        # The rows the file gave before are replaced
+        keys = {"report": ["report"], "banktable": ["bank"],
+                "worthtable": ["worth-" + rod for rod in RODS]}[kind]
+        for key in keys:
+            rows = calibration["rows"].pop(key, None)
+            if rows is not None:
+                self.store.delete(key.split("-")[0], *rows)
+        if kind == "report":
+            columns = {"calibration": [index]}
+            for value in REPORT_VALUES:
+                columns[value] = [parsed.get(value, np.nan)]
+            for fit in FITS:
+                columns[fit] = [parsed.get(fit, [np.nan] * 4)]
+            calibration["rows"]["report"] = self.store.append("report",
+                                                              columns)
+            calibration["mostrxvrod"] = parsed.get("mostrxvrod")
+        elif kind == "worthtable":
+            calibration["totals"] = parsed["totals"]
+            for code, rod in enumerate(RODS):
+                heights, worths = parsed[rod]
+                calibration["rows"]["worth-" + rod] = self.store.append(
+                    "worth", {"calibration": np.full(len(heights), index),
+                              "rod": np.full(len(heights), code),
+                              "height": heights, "worth": worths})
+        elif kind == "banktable":
+            grid = parsed["heights"]
+            excesses, powers = np.meshgrid(parsed["core_excesses"],
+                                           parsed["powers"], indexing="ij")
+            calibration["rows"]["bank"] = self.store.append(
+                "bank", {"calibration": np.full(grid.size, index),
+                         "core_excess": excesses.ravel(),
+                         "power": powers.ravel(), "height": grid.ravel()})
+            calibration["bank_shape"] = list(grid.shape)
+            # The bold rows are those within 5c of the xenon-free excess
+            if parsed["bold"].any():
+                calibration["xenon_free"] = float(np.mean(
+                    parsed["core_excesses"][parsed["bold"]]))
+
+    def _rows(self, table, name, key=None):
+        rows = self.calibration(name)["rows"].get(key or table)
+        if rows is None:
+            raise KeyError("{} has no {}".format(name, key or table))
+        return slice(*rows)
+
+    def _column(self, table, column, rows):
+        # Row numbers from append() count deleted rows too
+        return np.array(self.store.column(table, column, deleted=True)[rows])
+
+    def report(self, name):
+        """
+        A calibration's report values: each of REPORT_VALUES, and each of
+        FITS as a np.poly1d (None if it wasn't a cubic).
+        """
+        row = self._rows("report", name).start
+        result = dict((value, float(self._column("report", value, row)))
+                      for value in REPORT_VALUES)
+        for fit in FITS:
+            coefficients = self._column("report", fit, row)
+            result[fit] = (None if np.isnan(coefficients).any() else
+                           np.poly1d(coefficients))
+        result["mostrxvrod"] = self.calibration(name).get("mostrxvrod")
+        return result
+
+    def worth(self, name, rod):
+        """
+        A calibration's worth table for one rod, as (heights, worths).
+        """
+        rows = self._rows("worth", name, "worth-" + rod)
+        return (self._column("worth", "height", rows),
+                self._column("worth", "worth", rows))
+
+    def bank(self, name):
+        """
+        A calibration's bank table, as (core_excesses, powers, heights) with
+        heights of shape (core excesses, powers).
+        """
+        rows = self._rows("bank", name)
+        shape = self.calibration(name)["bank_shape"]
+        column = lambda column: self._column("bank", column,
+                                             rows).reshape(shape)
+        return (column("core_excess")[:, 0], column("power")[0],
+                column("height"))
+
+    def ingest(self, directories, processes=None):
+        """
+        Parse every generated file under directories that's new or changed
+        since it was last ingested, in parallel, and add their numbers.
+
+        Args:
+            directories: Archive directories to walk.
+            processes: The number of worker processes; defaults to the
+                number of CPUs. 1 parses in this process.
+
+        Returns:
+            (parsed, failed): the number of files added, and a list of
+            (path, error) for those that couldn't be parsed.
+        """
+        jobs = []
+        for path, kind, name in find(directories):
+            mtime = os.path.getmtime(path)
+            if self.files.get(path) != mtime:
+                jobs.append((path, kind, name))
+        if processes == 1 or len(jobs) < 2:
+            pool = None
+            results = itertools.imap(_parse_star, jobs)
+        else:
+            pool = multiprocessing.Pool(processes)
+            # Results come back as they're ready and are written straight to
+            # the store, so only a few files' numbers are held at once
+            results = pool.imap_unordered(_parse_star, jobs)
+
+        parsed = 0
+        failed = []
+        try:
+            for path, kind, name, result, error in results:
+                if error is None:
+                    self.add(path, kind, name, result)
+                    parsed += 1
+                else:
+                    self.calibration(name, create=True)["errors"][kind] = error
+                    failed.append((path, error))
+                self.files[path] = os.path.getmtime(path)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            self.save()
+        return parsed, failed
+
+
+def compare(archive, name, rod_pulls):
+    """
+    Refit an archived calibration from its pulls with the current
+    reactivity_calc() and compare with what was archived.
+
+    Args:
+        archive: An Archive.
+        name: The calibration.
+        rod_pulls: Its pulls, [safe, shim, reg] as rodcal.collect_rod()
+            returns.
+
+    Returns:
+        A dict from each rod to a dict of "table": the largest difference
+        between the archived worth table and the new fit at its heights, in
+        dollars (the table is rounded to the cent), and "fit": the largest
+        difference between the archived and new integral worth fits over
+        0-100%; either is None if the archive doesn't have it.
+    """
+    import rodcal
+    calibration = archive.calibration(name)
+    report = (archive.report(name) if "report" in calibration["rows"] else
+              {})
+    heights = np.linspace(0, 100, 1001)
+    result = {}
+    for rod, pulls in zip(RODS, rod_pulls):
+        fit = rodcal.reactivity_calc(pulls[0], pulls[1:])[0]
+        table = None
+        if "worth-" + rod in calibration["rows"]:
+            table_heights, worths = archive.worth(name, rod)
+            if len(worths):
+                table = float(np.abs(fit(table_heights) - worths).max())
+        archived = report.get(rod + "intpoly")
+        result[rod] = {"table": table,
+                       "fit": (float(np.abs(fit(heights) -
+                                            archived(heights)).max())
+                               if archived is not None else None)}
+    return result
+
+def _describe(difference):
+    return "-" if difference is None else "${:.4f}".format(difference)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Ingest archived calibration .tex files into a columnar "
+                    "store, and compare them with current fits.")
+    subparsers = parser.add_subparsers(dest="command")
+
+    ingest = subparsers.add_parser(
+        "ingest", help="parse the generated .tex files under directories")
+    ingest.add_argument("archives", nargs="+", metavar="ARCHIVE")
+    ingest.add_argument("-o", "--store", required=True,
+                        help="the store directory, created or added to")
+    ingest.add_argument("-j", "--processes", type=int, default=None,
+                        help="number of worker processes (default: all CPUs)")
+
+    listing = subparsers.add_parser("list", help="list the calibrations")
+    listing.add_argument("store")
+
+    comparison = subparsers.add_parser(
+        "compare", help="refit calibrations from their pulls and compare")
+    comparison.add_argument("store")
+    comparison.add_argument("files", nargs="*",
+                            help="JSON or CSV record files (as for batch.py)")
+    comparison.add_argument("--history", metavar="FILE",
+                            help="a history store (see history.py)")
+    args = parser.parse_args()
+
+    if args.command == "ingest":
+        with Archive(args.store) as archive:
+            parsed, failed = archive.ingest(args.archives, args.processes)
+        print "{} files ingested into {}; {} calibrations, {} worth table " \
+              "entries, {} bank table cells".format(
+                  parsed, args.store, len(archive.calibrations),
+                  archive.store.rows("worth"), archive.store.rows("bank"))
+        for path, error in failed:
+            print "FAILED {}: {}".format(path, error)
+
+    elif args.command == "list":
+        archive = Archive(args.store)
+        for calibration in archive.calibrations:
+            kinds = [kind for kind in KINDS if kind in calibration["files"]]
+            line = "{:<24} {}".format(calibration["name"], ", ".join(kinds))
+            if "report" in calibration["rows"]:
+                line += "  total ${:.2f}".format(
+                    archive.report(calibration["name"])["totalworth"])
+            if calibration["errors"]:
+                line += "  ({} unreadable)".format(
+                    ", ".join(sorted(calibration["errors"])))
+            print line
+
+    elif args.command == "compare":
+        archive = Archive(args.store)
+        # Pulls by ID: records by their ID, history calibrations by theirs
+        pulls = {}
+        if args.files:
+            import batch
+            for filename in args.files:
+                for record in batch.load_records(filename):
+                    pulls[str(record["id"])] = batch.rod_pulls(record)
+        if args.history:
+            import history
+            with history.History(args.history) as store:
+                for calibration in store.calibrations():
+                    name = store.artifact_name(calibration["id"])
+                    pulls[name] = store.rod_pulls(calibration["id"])
+        matched = 0
+        for name in archive.names:
+            key = name.rsplit("/", 1)[-1]
+            if key not in pulls:
+                continue
+            matched += 1
+            for rod, difference in sorted(
+                    compare(archive, name, pulls[key]).items()):
+                print "{:<24} {:<5} table {:>8}  fit {:>8}".format(
+                    name, rod, _describe(difference["table"]),
+                    _describe(difference["fit"]))
+        print "{} of {} archived calibrations compared".format(
+            matched, len(archive.calibrations))
+
+if __name__ == "__main__":
+    main()
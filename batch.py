@@ -0,0 +1,361 @@
+# Headless batch processing of control rod calibrations
+#
+# Each record holds everything main() in rodcal.py (and optionally rodbank.py)
+# would prompt for, so archived or synthetic calibrations can be re-run without
+# retyping them. Usage:
+#
+#     python batch.py records.json [more.csv ...] -o outputs -j 8
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+
+import export
+import instrument
+import rodbank
+import rodcal
+import typesetting
+import worthtable
+
+RODS = ["safe", "shim", "reg"]
+CSV_FIELDS = ["id", "mode", "rod", "height", "period", "shim_height",
+              "withdrawal_time", "power", "excess"]
+
+
+def load_records(filename):
+    """
+    Read calibration records from a JSON or CSV file.
+
+    A JSON file holds one record or a list of them. Each record looks like
+        {"id": "20210125",
+         "mode": "together",               # or "separate"
+         "withdrawal_times": [safe, shim, reg],         # seconds
+         "reg": {"bottom": 12.3, "pulls": [[height, period], ...]},
+         "safe": {"bottom": 47.3, "pulls": [[height, period, shim], ...]},
+         "shim": {"bottom": 51.4},
+         "banks": [[power, height, excess], ...]}        # optional
+    with heights in %, periods in ms and powers in kW, as on SOP 34A. In
+    "together" mode the Safe pulls carry the stable Shim height and the Shim
+    rod has only its critical height; in "separate" mode each rod has its own
+    [height, period] pulls.
+
+    A CSV file has the columns in CSV_FIELDS, one row per form entry. For each
+    record and rod, a row without a period gives the critical ("bottom")
+    height and the withdrawal time; rows with a period are pulls, in order.
+    Rows with rod "bank" give the power, banked height and core excess.
+
+    Args:
+        filename: A .json or .csv file.
+
+    Returns:
+        A list of record dicts in the JSON form above.
+    """
+    if filename.lower().endswith(".csv"):
+        with open(filename, "rb") as f:
+            return _records_from_rows(csv.DictReader(f))
+    with open(filename) as f:
+        records = json.load(f)
+    if isinstance(records, dict):
+        records = [records]
+    return records
+
+def _records_from_rows(rows):
+    """
+    Group CSV rows into records; see load_records() for the layout.
+    """
+    records = []
+    by_id = {}
+    for row in rows:
+        record_id = row["id"]
+        if record_id not in by_id:
+            by_id[record_id] = {"id": record_id,
+                                "withdrawal_times": [None] * len(RODS)}
+            records.append(by_id[record_id])
+        record = by_id[record_id]
+        if row.get("mode"):
+            record["mode"] = row["mode"]
+
+        rod = row["rod"]
+        if rod == "bank":
+            record.setdefault("banks", []).append(
+                [float(row["power"]), float(row["height"]),
+                 float(row["excess"])])
+            continue
+
+        entry = record.setdefault(rod, {"pulls": []})
+        if not row.get("period"):
+            entry["bottom"] = float(row["height"])
+            if row.get("withdrawal_time"):
+                record["withdrawal_times"][RODS.index(rod)] = float(
+                    row["withdrawal_time"])
+        elif row.get("shim_height"):
+            entry["pulls"].append([float(row["height"]), float(row["period"]),
+                                   float(row["shim_height"])])
+        else:
+            entry["pulls"].append([float(row["height"]),
+                                   float(row["period"])])
+    return records
+
+def rod_pulls(record):
+    """
+    Convert a record into the rod pulls main() would have collected.
+
+    Args:
+        record: A record dict, as returned by load_records().
+
+    Returns:
+        [safe, shim, reg], each in the form rodcal.collect_rod() returns, with
+        periods converted to seconds.
+    """
+    def pulls(rod):
+        entry = record[rod]
+        return [entry["bottom"]] + [(height, period / 1000.0)
+                                    for height, period in entry["pulls"]]
+
+    mode = str(record.get("mode", "together")).lower()
+    if calibrated_together(record):
+        safe, shim = rodcal.together_pulls(
+            record["safe"]["bottom"], record["shim"]["bottom"],
+            [(safe_height, period / 1000.0, shim_height)
+             for safe_height, period, shim_height in record["safe"]["pulls"]])
+    elif mode in ("separate", "2"):
+        safe, shim = pulls("safe"), pulls("shim")
+    else:
+        raise ValueError("Unknown calibration mode: {}".format(mode))
+
+    return [safe, shim, pulls("reg")]
+
+def calibrated_together(record):
+    """
+    Whether a record's Safe and Shim rods were calibrated together, the SOP's
+    usual procedure (and the default when a record doesn't say).
+    """
+    return str(record.get("mode", "together")).lower() in ("together", "1")
+
+def make_record(record_id, rod_pulls, withdrawal_times, banks=None):
+    """
+    Build a record from rod pulls in the form rodcal.collect_rod() returns,
+    e.g. to save data typed into rodcal.main() for re-running later. The
+    record is in "separate" mode; Safe and Shim pulls from a calibration done
+    together are stored as rodcal.together_pulls() splits them.
+
+    Args:
+        record_id: The record's ID.
+        rod_pulls: [safe, shim, reg], with periods in seconds.
+        withdrawal_times: The [safe, shim, reg] withdrawal times in seconds.
+        banks: Optional rod bank data, a list of (power, height, excess).
+
+    Returns:
+        A record dict, as load_records() returns.
+    """
+    record = {"id": record_id,
+              "mode": "separate",
+              "withdrawal_times": list(withdrawal_times)}
+    for rod, pulls in zip(RODS, rod_pulls):
+        record[rod] = {"bottom": pulls[0],
+                       "pulls": [[height, period * 1000.0]
+                                 for height, period in pulls[1:]]}
+    if banks is not None:
+        record["banks"] = [list(bank) for bank in banks]
+    return record
+
+def run_record(record, output_dir, typeset=True, worth_step=None,
+               exports=(), pdf=True):
+    """
+    Process one record as a full calibration run, writing everything into its
+    own directory under output_dir: fits.json, techspecs.json, the plots, the
+    worth tables and report, and the bank table if the record has bank data.
+    With worth_step, also write a binary worth table file (see worthtable.py)
+    for each rod, <rod>-worth.bin.
+
+    Args:
+        record: A record dict, as returned by load_records().
+        output_dir: The parent directory for all records' outputs.
+        typeset: Whether to run pdflatex on the generated .tex files.
+        worth_step: The height spacing of the binary worth tables, in %, or
+            None not to write them.
+        exports: Formats to also write the results in (see export.py).
+        pdf: Whether to make the plots, tables and report at all, or only
+            the JSON files and exports.
+
+    Returns:
+        A summary dict: the record "id", its output "directory", and either
+        "ok": True or "ok": False with the "error" traceback.
+    """
+    directory = os.path.join(output_dir, str(record["id"]))
+    summary = {"id": record["id"], "directory": directory}
+    instrument.set_calibration(record["id"])
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        banks = [tuple(bank) for bank in record.get("banks") or []]
+        if pdf:
+            calibration = rodcal.calibrate(rod_pulls(record),
+                                           record["withdrawal_times"],
+                                           directory, typeset_pdf=False,
+                                           processes=1)
+            jobs = [(calibration["table_filename"], "template-worthtable.tex",
+                     ()),
+                    (calibration["report_filename"], "template-report.tex",
+                     rodcal.PLOTS)]
+            if exports:
+                export.write(directory, exports, calibration["tech_specs"],
+                             rodcal.tabular_data([fit[0] for fit in
+                                                  calibration["fits"]]),
+                             export.bank_data(banks) if banks else None)
+        else:
+            calibration = export.calibrate(rod_pulls(record),
+                                           record["withdrawal_times"],
+                                           directory, exports, banks)
+            jobs = []
+        fits = {}
+        for rod, (integral_fit, integral, addition_rate_fit,
+                  addition_rate) in zip(RODS, calibration["fits"]):
+            fits[rod] = {"integral": list(integral_fit.c),
+                         "integral_data": integral,
+                         "addition_rate": list(addition_rate_fit.c),
+                         "addition_rate_data": addition_rate}
+            if worth_step:
+                worthtable.save(
+                    os.path.join(directory, "{}-worth.bin".format(rod)), rod,
+                    integral_fit, worthtable.STARTS[rod], step=worth_step)
+
+        if banks:
+            hvsrho = rodbank.rod_height_vs_core_excess(banks)
+            rhovsp = rodbank.core_excess_vs_power(banks)
+            fits["bank"] = {"height_vs_excess": list(hvsrho.c),
+                            "excess_vs_power": list(rhovsp.c)}
+            if pdf:
+                jobs.append((rodbank.write_tex(banks[0][2],
+                                               rodbank.table(hvsrho, rhovsp),
+                                               directory),
+                             "template-banktable.tex", ()))
+
+        # Typeset this record's documents side by side
+        if typeset and jobs:
+            typesetting.typeset_all(jobs, processes=len(jobs))
+
+        _write_json(os.path.join(directory, "fits.json"), fits)
+        _write_json(os.path.join(directory, "techspecs.json"),
+                    calibration["tech_specs"])
+        summary["ok"] = True
+    except Exception:
+        summary["ok"] = False
+        summary["error"] = traceback.format_exc()
+    return summary
+
+def _write_json(filename, data):
+    with open(filename, "w") as f:
+        json.dump(data, f, indent=2, sort_keys=True, default=_to_builtin)
+
+def _to_builtin(value):
+    """
+    json.dump fallback for numpy scalars, e.g. the np.bool_ Tech Specs flags.
+    """
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+def _run_record_star(args):
+    return run_record(*args)
+
+def run(records, output_dir, processes=None, typeset=True, worth_step=None,
+        exports=(), pdf=True):
+    """
+    Process records in parallel over a pool of worker processes.
+
+    Args:
+        records: A list of record dicts.
+        output_dir: The parent directory for all records' outputs.
+        processes: The number of workers; defaults to the number of CPUs.
+        typeset: Whether to run pdflatex on the generated .tex files.
+        worth_step: The height spacing of the binary worth tables, or None.
+        exports, pdf: As for run_record().
+
+    Returns:
+        The summary dicts from run_record(), in completion order.
+    """
+    pool = multiprocessing.Pool(processes)
+    try:
+        jobs = [(record, output_dir, typeset, worth_step, exports, pdf)
+                for record in records]
+        return list(pool.imap_unordered(_run_record_star, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Process control rod calibration records without "
+                    "prompting for input.")
+    parser.add_argument("files", nargs="+",
+                        help="JSON or CSV files of calibration records")
+    parser.add_argument("-o", "--output", default="batch-output",
+                        help="directory to write each record's outputs under")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="number of worker processes (default: all CPUs)")
+    parser.add_argument("--no-typeset", dest="typeset", action="store_false",
+                        help="write the .tex files but don't run pdflatex")
+    parser.add_argument("--worth-step", type=float, default=None,
+                        help="also write binary worth tables at this height "
+                             "spacing in %%, e.g. 0.001")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="append per-stage timings to FILE as JSON lines")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a cProfile dump per stage into DIR")
+    parser.add_argument("--history", metavar="FILE",
+                        help="record each processed calibration in the "
+                             "history store FILE (see history.py)")
+    parser.add_argument("--export", metavar="FORMATS",
+                        help="also write each record's results as any of "
+                             "csv,json,html (comma-separated)")
+    parser.add_argument("--no-pdf", dest="pdf", action="store_false",
+                        help="skip the plots, TeX and pdflatex entirely; "
+                             "only write the JSON files and --export formats")
+    args = parser.parse_args()
+    formats = []
+    if args.export:
+        try:
+            formats = export.parse_formats(args.export)
+        except ValueError as e:
+            parser.error(str(e))
+    instrument.configure(args.trace, args.profile)
+
+    records = []
+    for filename in args.files:
+        records.extend(load_records(filename))
+
+    store = None
+    if args.history:
+        import history
+        store = history.History(args.history)
+    by_id = dict((record["id"], record) for record in records)
+
+    failures = 0
+    for summary in run(records, args.output, args.processes, args.typeset,
+                       args.worth_step, formats, args.pdf):
+        if summary["ok"]:
+            print "{}: OK ({})".format(summary["id"], summary["directory"])
+            # Recorded here rather than in the workers, so the store has a
+            # single writer
+            if store is not None:
+                store.add(by_id[summary["id"]])
+        else:
+            failures += 1
+            print "{}: FAILED".format(summary["id"])
+            print summary["error"]
+
+    if store is not None:
+        store.close()
+    print "{} of {} records processed".format(len(records) - failures,
+                                              len(records))
+    if failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+# Benchmarks for the calibration tools. Run each from the top of the repository
+# as a module, e.g. python -m benchmarks.startup
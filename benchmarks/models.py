@@ -0,0 +1,97 @@
+# Fit model benchmark
+#
+# For each model in fitmodels.py, and rodcal's usual np.polyfit cubics: how
+# long fitting a rod takes, how long tabulating its integral worth at 0.001%
+# takes (from the cached design matrices, and evaluated afresh), how long an
+# inverse lookup of many worths and the addition rate maximum take, and how
+# closely the fitted integral worth follows the true S-curve of the
+# synthetic rods. Usage:
+#
+#     python -m benchmarks.models [--rods 50] [--pulls 12]
+
+import argparse
+
+import numpy as np
+
+import fitmodels
+import rodcal
+from benchmarks import synthetic
+from benchmarks.pipeline import measure
+
+# Inverse lookups per call
+TARGETS = 10000
+
+
+def accuracy(model, random, rods, pulls):
+    """
+    The RMS and largest error, in dollars, of the fitted integral worth
+    against the true curve, over many synthetic rods.
+    """
+    errors = []
+    for _ in xrange(rods):
+        total = random.uniform(1.2, 3.8)
+        rod = synthetic.rod_pulls(random, random.uniform(0, 50), total, pulls)
+        integral_fit = rodcal.reactivity_calc(rod[0], rod[1:], model)[0]
+        x = np.linspace(rod[0], 100, 1001)
+        errors.append(integral_fit(x) - synthetic.integral_worth(x, total))
+    errors = np.concatenate(errors)
+    return np.sqrt(np.mean(errors ** 2)), np.abs(errors).max()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the fit models' speed and accuracy.")
+    parser.add_argument("--rods", type=int, default=50,
+                        help="synthetic rods to measure accuracy over "
+                             "(default: 50)")
+    parser.add_argument("--pulls", type=int, default=12,
+                        help="pulls per rod (default: 12)")
+    args = parser.parse_args()
+
+    random = np.random.RandomState(21)
+    rod = synthetic.rod_pulls(random, 30.0, 2.5, args.pulls)
+    targets = np.linspace(0.05, 2.0, TARGETS)
+    x = fitmodels.heights(0, 100, 0.001)
+
+    print ("{:<16} {:>9} {:>11} {:>11} {:>10} {:>9} {:>9} {:>9}".format(
+        "model", "fit (us)", "table (ms)", "fresh (ms)", "inverse", "max (us)",
+        "RMS ($)", "worst ($)"))
+    models = [("np.polyfit", None)] + fitmodels.MODELS.items()
+    for name, model in models:
+        fit = measure(lambda: rodcal.reactivity_calc(rod[0], rod[1:], model))
+        integral_fit, _, addition_rate_fit, _ = rodcal.reactivity_calc(
+            rod[0], rod[1:], model)
+        line = "{:<16} {:9.0f}".format(name, fit["best"] * 1e6)
+
+        if model is None:
+            line += " {:>11}".format("-")
+        else:
+            # The first call fills the design matrix cache
+            integral_fit.table(0, 100, 0.001)
+            table = measure(lambda: integral_fit.table(0, 100, 0.001))
+            line += " {:11.2f}".format(table["best"] * 1e3)
+        fresh = measure(lambda: integral_fit(x))
+        line += " {:11.2f}".format(fresh["best"] * 1e3)
+
+        if model is None:
+            line += " {:>10} {:>9}".format("-", "-")
+        else:
+            # Below the top, where the cubics turn back up
+            try:
+                integral_fit.inverse(targets, rod[0], 90.0)
+                lookup = measure(lambda: integral_fit.inverse(targets,
+                                                              rod[0], 90.0))
+                line += " {:7.2f} ms".format(lookup["best"] * 1e3)
+            except ValueError:
+                line += " {:>10}".format("not mono.")
+            peak = measure(lambda: addition_rate_fit.maximum(0.0, 100.0))
+            line += " {:9.0f}".format(peak["best"] * 1e6)
+
+        rms, worst = accuracy(model, np.random.RandomState(34), args.rods,
+                              args.pulls)
+        print line + " {:9.4f} {:9.4f}".format(rms, worst)
+    print
+    print ("fit: both curves of one rod; table/fresh: integral worth at "
+           "{} heights; inverse: {} worths".format(len(x), TARGETS))
+
+if __name__ == "__main__":
+    main()
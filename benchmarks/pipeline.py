@@ -0,0 +1,255 @@
+# Pipeline benchmarks
+#
+# Times each stage of the calculation on synthetic data, over a range of pull
+# counts, table resolutions and batch sizes, and writes the results as JSON.
+# Comparing against an earlier results file flags regressions. Usage:
+#
+#     python -m benchmarks.pipeline [-o results.json] [--compare old.json]
+#                                   [--quick]
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import export
+import inverse
+import rodbank
+import rodcal
+from benchmarks import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATES = os.path.join(ROOT, "sample outputs")
+
+# A benchmark that gets slower than this factor of its previous time counts as
+# a regression
+THRESHOLD = 1.25
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """
+    Time a function call. Each of repeat rounds calls it as many times as it
+    takes to fill min_time, so fast calls are timed in bulk.
+
+    Returns:
+        A dict of the "best" and "median" seconds per call over the rounds,
+        and the number of "calls" per round.
+    """
+    calls = 1
+    while True:
+        start = time.time()
+        for _ in xrange(calls):
+            func()
+        elapsed = time.time() - start
+        if elapsed >= min_time or calls >= 1 << 20:
+            break
+        calls *= 2
+
+    rounds = [elapsed / calls]
+    for _ in xrange(repeat - 1):
+        start = time.time()
+        for _ in xrange(calls):
+            func()
+        rounds.append((time.time() - start) / calls)
+    rounds.sort()
+    return {"best": rounds[0], "median": rounds[len(rounds) // 2],
+            "calls": calls}
+
+def benchmarks(quick=False):
+    """
+    Generate the benchmark cases.
+
+    Yields:
+        (name, params, func) for each case; func takes no arguments.
+    """
+    random = np.random.RandomState(34)
+    pull_counts = [8, 16] if quick else [8, 16, 32, 64]
+    batch_sizes = [1, 100] if quick else [1, 100, 1000, 10000]
+    steps = [0.1, 0.01] if quick else [0.1, 0.01, 0.001]
+    grids = ([None, (1, 0.01)] if quick else
+             [None, (1, 0.01), (1, 0.001)])
+
+    for pulls in pull_counts:
+        rod = synthetic.rod_pulls(random, 47.0, 2.4, pulls)
+        yield ("reactivity_calc", {"pulls": pulls},
+               lambda rod=rod: rodcal.reactivity_calc(rod[0], rod[1:]))
+
+    for rods in batch_sizes:
+        bottom, heights, periods = synthetic.batch_arrays(random, rods)
+        yield ("reactivity_calc_batch", {"rods": rods, "pulls": 12},
+               lambda args=(bottom, heights, periods):
+                   rodcal.reactivity_calc_batch(*args))
+
+    rod_pulls, withdrawal_times = synthetic.calibration(random)
+    fits = [rodcal.reactivity_calc(rod[0], rod[1:]) for rod in rod_pulls]
+    [(safe_int, _, safe_add, _), (shim_int, _, shim_add, _),
+     (reg_int, _, reg_add, _)] = fits
+    yield ("tech_specs", {},
+           lambda: rodcal.tech_specs(safe_int, safe_add, shim_int, shim_add,
+                                     reg_int, reg_add, rod_pulls[0][0],
+                                     rod_pulls[1][0], withdrawal_times))
+
+    cubics = [safe_int, shim_int, reg_int]
+    for step in steps:
+        yield ("tabular_data", {"step": step},
+               lambda step=step: rodcal.tabular_data(cubics, step))
+        table = rodcal.tabular_data(cubics, step)[2]
+        yield ("tex_one_table", {"step": step, "rows": len(table)},
+               lambda table=table: rodcal.tex_one_table(table, 8))
+
+    banks = synthetic.rod_banks(random)
+    hvsrho = rodbank.rod_height_vs_core_excess(banks)
+    rhovsp = rodbank.core_excess_vs_power(banks)
+    for grid in grids:
+        if grid is None:
+            axes = (rodbank.POWERS, rodbank.CORE_EXCESSES)
+            params = {"grid": "logbook"}
+        else:
+            axes = rodbank.grid(*grid)
+            params = {"power_step": grid[0], "excess_step": grid[1]}
+        params["cells"] = len(axes[0]) * len(axes[1])
+        yield ("rodbank.table", params,
+               lambda axes=axes: rodbank.table(hvsrho, rhovsp, *axes))
+
+    # The inverse, over a day of 1 Hz (height, power) samples
+    query = inverse.ExcessQuery.from_banks(banks)
+    powers = random.uniform(0, 230, 86400)
+    heights = rodbank.rod_height(random.uniform(0.5, 1.5, 86400), powers,
+                                 hvsrho, rhovsp)
+    yield ("ExcessQuery.excess", {"samples": 86400},
+           lambda: query.excess(heights, powers))
+
+    # .tex generation, in a scratch directory with the templates
+    results = rodcal.tech_specs(safe_int, safe_add, shim_int, shim_add,
+                                reg_int, reg_add, rod_pulls[0][0],
+                                rod_pulls[1][0], withdrawal_times)
+    for step in steps[:2]:
+        data = rodcal.tabular_data(cubics, step)
+        yield ("write_tables", {"step": step},
+               lambda data=data: _scratch(rodcal.write_tables, data,
+                                          safe_int(0), shim_int(0),
+                                          reg_int(0)))
+    yield ("write_report", {},
+           lambda: _scratch(rodcal.write_report, dict(results)))
+    for grid in grids[:2]:
+        axes = (rodbank.grid(*grid) if grid else
+                (rodbank.POWERS, rodbank.CORE_EXCESSES))
+        data = rodbank.table(hvsrho, rhovsp, *axes)
+        yield ("rodbank.write_tex",
+               {"cells": len(axes[0]) * len(axes[1])},
+               lambda data=data, axes=axes: _scratch(
+                   rodbank.write_tex, banks[0][2], data, ".", *axes))
+
+    # The same results as CSV, JSON and HTML, each overwriting the last
+    bank = export.bank_data(banks)
+    data = rodcal.tabular_data(cubics)
+    for fmt in export.FORMATS:
+        yield ("export.write", {"format": fmt},
+               lambda fmt=fmt: export.write(".", [fmt], results, data, bank))
+
+def _scratch(write, *args):
+    """
+    Call one of the .tex writers and delete what it wrote, so that every call
+    writes the same filename.
+    """
+    os.remove(write(*args))
+
+def run(quick=False):
+    """
+    Run every benchmark.
+
+    Returns:
+        The results, ready to write as JSON.
+    """
+    scratch = tempfile.mkdtemp(prefix="rodcal-bench-")
+    for template in os.listdir(TEMPLATES):
+        if template.startswith("template-"):
+            shutil.copy(os.path.join(TEMPLATES, template), scratch)
+
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    try:
+        cases = []
+        for name, params, func in benchmarks(quick):
+            timing = measure(func)
+            cases.append(dict(name=name, params=params, **timing))
+            print "{:<24} {:<42} {:>12.1f} us".format(
+                name, _describe(params), timing["best"] * 1e6)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch)
+
+    return {"meta": _metadata(), "results": cases}
+
+def _describe(params):
+    return " ".join("{}={}".format(key, params[key]) for key in sorted(params))
+
+def _metadata():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                         cwd=ROOT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "commit": commit,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.platform()}
+
+def compare(old, new, threshold=THRESHOLD):
+    """
+    Compare two sets of results case by case.
+
+    Returns:
+        A list of (name, params, old seconds, new seconds) for the cases that
+        got slower by more than threshold.
+    """
+    previous = dict(((case["name"], _describe(case["params"])), case["best"])
+                    for case in old["results"])
+    regressions = []
+    for case in new["results"]:
+        key = (case["name"], _describe(case["params"]))
+        if key in previous and case["best"] > previous[key] * threshold:
+            regressions.append((case["name"], case["params"], previous[key],
+                                case["best"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the calibration pipeline on synthetic data.")
+    parser.add_argument("-o", "--output", default="benchmark-results.json",
+                        help="where to write the results "
+                             "(default: benchmark-results.json)")
+    parser.add_argument("--compare", metavar="OLD",
+                        help="an earlier results file to check for "
+                             "regressions against")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="slowdown factor that counts as a regression "
+                             "(default: {})".format(THRESHOLD))
+    parser.add_argument("--quick", action="store_true",
+                        help="only the smaller sizes")
+    args = parser.parse_args()
+
+    results = run(args.quick)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        for name, params, old, new in regressions:
+            print "REGRESSION {} {}: {:.1f} us -> {:.1f} us ({:.2f}x)".format(
+                name, _describe(params), old * 1e6, new * 1e6, new / old)
+        if regressions:
+            sys.exit(1)
+        print "No regressions against {}".format(args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Rod height evaluator benchmark
+#
+# Per-call latency of rodbank.RodHeightEvaluator against rodbank.rod_height()
+# for single (core excess, power) queries, with and without its LRU cache
+# (cycling through a working set of queries that fits in it), and per-height
+# cost for arrays of queries. Usage:
+#
+#     python -m benchmarks.rodheight [--queries 256]
+
+import argparse
+
+import numpy as np
+
+import rodbank
+from benchmarks import synthetic
+from benchmarks.pipeline import measure
+
+
+def cases(hvsrho, rhovsp, queries):
+    """
+    Generate the benchmark cases.
+
+    Yields:
+        (name, heights per call, func) for each case; func takes no
+        arguments.
+    """
+    random = np.random.RandomState(20)
+    excesses = [round(x, 2) for x in random.uniform(0, 2, queries)]
+    powers = [float(p) for p in random.choice(rodbank.POWERS, queries)]
+    pairs = zip(excesses, powers)
+
+    def cycle(func):
+        # One query per call, round the working set
+        state = {"i": 0}
+        def call():
+            i = state["i"]
+            state["i"] = (i + 1) % queries
+            excess, power = pairs[i]
+            return func(excess, power)
+        return call
+
+    yield ("rod_height", 1, cycle(
+        lambda excess, power: rodbank.rod_height(excess, power, hvsrho,
+                                                 rhovsp)))
+    yield ("evaluator, no cache", 1,
+           cycle(rodbank.RodHeightEvaluator(hvsrho, rhovsp, 0)))
+    yield ("evaluator, cache hits", 1,
+           cycle(rodbank.RodHeightEvaluator(hvsrho, rhovsp, queries)))
+    # Too small for the working set, so every query misses
+    yield ("evaluator, cache misses", 1,
+           cycle(rodbank.RodHeightEvaluator(hvsrho, rhovsp, queries // 4)))
+    yield ("baseline (call overhead)", 1,
+           cycle(lambda excess, power: excess))
+
+    evaluator = rodbank.RodHeightEvaluator(hvsrho, rhovsp, 0)
+    excesses = np.array(excesses)
+    powers = np.array(powers)
+    yield ("rod_height, arrays", queries,
+           lambda: rodbank.rod_height(excesses, powers, hvsrho, rhovsp))
+    yield ("evaluator, arrays", queries, lambda: evaluator(excesses, powers))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time rod height evaluation, per call.")
+    parser.add_argument("--queries", type=int, default=256,
+                        help="distinct (core excess, power) queries "
+                             "(default: 256)")
+    args = parser.parse_args()
+
+    banks = synthetic.rod_banks(np.random.RandomState(34))
+    hvsrho = rodbank.rod_height_vs_core_excess(banks)
+    rhovsp = rodbank.core_excess_vs_power(banks)
+
+    evaluator = rodbank.RodHeightEvaluator(hvsrho, rhovsp)
+    excesses, powers = np.meshgrid(rodbank.CORE_EXCESSES, rodbank.POWERS)
+    difference = np.abs(evaluator(excesses, powers) -
+                        rodbank.rod_height(excesses, powers, hvsrho, rhovsp))
+    print "Largest difference from rod_height(): {:.2g} %".format(
+        difference.max())
+
+    for name, heights, func in cases(hvsrho, rhovsp, args.queries):
+        timing = measure(func)
+        print "{:<26} {:9.3f} us per call  {:9.4f} us per height".format(
+            name, timing["best"] * 1e6, timing["best"] * 1e6 / heights)
+
+if __name__ == "__main__":
+    main()
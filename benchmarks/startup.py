@@ -0,0 +1,110 @@
+# Startup benchmark for the console tools
+#
+# Measures, in fresh interpreters, how long it takes to import rodcal and
+# rodbank and how long each tool takes to put up its first prompt. Usage:
+#
+#     python -m benchmarks.startup [-n RUNS] [-o results.json]
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The first thing each tool asks for
+FIRST_PROMPTS = {"rodcal": "Safe: ", "rodbank": " Rod height (%): "}
+
+
+def time_command(args):
+    """
+    Wall-clock time to run a Python command to completion in a fresh
+    interpreter, in seconds.
+    """
+    start = time.time()
+    subprocess.check_call([sys.executable] + args, cwd=ROOT)
+    return time.time() - start
+
+def import_time(module):
+    """
+    Time to import module in a fresh interpreter, less the interpreter's own
+    startup time, in seconds.
+    """
+    return (time_command(["-c", "import " + module]) -
+            time_command(["-c", "pass"]))
+
+def heavy_modules(module):
+    """
+    Which of numpy and matplotlib importing module pulls in.
+    """
+    output = subprocess.check_output(
+        [sys.executable, "-c",
+         "import sys, {}; print ' '.join(m for m in ('numpy', 'matplotlib') "
+         "if m in sys.modules)".format(module)], cwd=ROOT)
+    return output.split()
+
+def time_to_first_prompt(module):
+    """
+    Time from launching a tool to its first prompt appearing, in seconds.
+    """
+    start = time.time()
+    process = subprocess.Popen([sys.executable, "-u", module + ".py"],
+                               cwd=ROOT, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+    output = ""
+    try:
+        while not output.endswith(FIRST_PROMPTS[module]):
+            chunk = os.read(process.stdout.fileno(), 4096)
+            if not chunk:
+                raise RuntimeError("{} exited before prompting".format(module))
+            output += chunk
+        return time.time() - start
+    finally:
+        process.kill()
+        process.wait()
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {"min": samples[0],
+            "median": samples[len(samples) // 2],
+            "max": samples[-1]}
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time startup of the rodcal and rodbank console tools.")
+    parser.add_argument("-n", "--runs", type=int, default=10,
+                        help="runs per measurement (default: 10)")
+    parser.add_argument("-o", "--output",
+                        help="also write the results to this JSON file")
+    args = parser.parse_args()
+
+    results = {"python": sys.version.split()[0], "runs": args.runs}
+    for module in ["rodcal", "rodbank"]:
+        results[module] = {
+            "import": summarize([import_time(module)
+                                 for _ in xrange(args.runs)]),
+            "first_prompt": summarize([time_to_first_prompt(module)
+                                       for _ in xrange(args.runs)]),
+            "heavy_modules_on_import": heavy_modules(module),
+        }
+
+    for module in ["rodcal", "rodbank"]:
+        print "{}:".format(module)
+        for key, label in [("import", "import"),
+                           ("first_prompt", "first prompt")]:
+            print "  {:>12}: {:7.1f} ms median ({:.1f}-{:.1f} ms)".format(
+                label, results[module][key]["median"] * 1000,
+                results[module][key]["min"] * 1000,
+                results[module][key]["max"] * 1000)
+        print "  {:>12}: {}".format(
+            "loads", ", ".join(results[module]["heavy_modules_on_import"]) or
+            "neither numpy nor matplotlib")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
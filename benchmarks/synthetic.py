@@ -0,0 +1,164 @@
+# Synthetic calibration data for benchmarks
+#
+# Rod worth follows the textbook S-curve of a rod in a cosine flux shape, and
+# each period is what the inhour equation gives for the worth of its pull, so
+# the data look like a real SOP 34A worksheet and fit the way real data do.
+
+import numpy as np
+
+import batch
+import kinetics
+import rodcal
+
+BANK_POWERS = [0.05, 1, 25, 50, 75, 100, 125, 150, 175, 200, 225, 230]
+
+
+def integral_worth(height, total):
+    """
+    The S-curve integral worth remaining above each height, in dollars, for a
+    rod of the given total worth.
+    """
+    u = np.asarray(height, dtype=float) / 100.0
+    return total * (1 - (u - np.sin(2 * np.pi * u) / (2 * np.pi)))
+
+def period_for(reactivity):
+    """
+    Invert the inhour equation: the stable period, in seconds, that follows a
+    positive reactivity insertion in dollars. Vectorized bisection in log
+    period.
+    """
+    reactivity = np.asarray(reactivity, dtype=float)
+    lo = np.full(reactivity.shape, np.log(1e-3))
+    hi = np.full(reactivity.shape, np.log(1e6))
+    for _ in xrange(60):
+        mid = (lo + hi) / 2
+        # Reactivity falls as the period gets longer
+        too_short = rodcal.inhour(np.exp(mid)) > reactivity
+        lo = np.where(too_short, mid, lo)
+        hi = np.where(too_short, hi, mid)
+    return np.exp((lo + hi) / 2)
+
+def pull_heights(random, bottom, pulls):
+    """
+    Heights at the top of each pull, evenly spread from bottom to fully out
+    with some jitter; the last pull ends above 99.4%, as the SOP requires.
+    """
+    heights = np.linspace(bottom, 99.6, pulls + 1)[1:]
+    step = (99.6 - bottom) / pulls
+    heights[:-1] += random.uniform(-0.2, 0.2, pulls - 1) * step
+    return np.round(heights, 1)
+
+def rod_pulls(random, bottom, total, pulls, noise=0.01):
+    """
+    One rod's calibration, in the form rodcal.collect_rod() returns.
+
+    Args:
+        random: A np.random.RandomState.
+        bottom: The critical height the pulls start from, in %.
+        total: The rod's total worth, in dollars.
+        pulls: The number of pulls.
+        noise: The relative scatter of the periods, as from reading them off
+            an instrument.
+
+    Returns:
+        [bottom, (height, period), ...], with periods in seconds.
+    """
+    heights = pull_heights(random, bottom, pulls)
+    worth = integral_worth(np.concatenate(([bottom], heights)), total)
+    periods = period_for(-np.diff(worth))
+    periods *= 1 + noise * random.standard_normal(pulls)
+    # Periods are read to the nearest 10 ms
+    periods = np.round(periods, 2)
+    return [bottom] + zip(heights.tolist(), periods.tolist())
+
+def calibration(random, pulls=12):
+    """
+    A full calibration of all three rods, calibrated separately.
+
+    Returns:
+        (rod_pulls, withdrawal_times): [safe, shim, reg] in the form
+        rodcal.collect_rod() returns, and their withdrawal times in seconds.
+    """
+    safe = rod_pulls(random, random.uniform(45, 50), random.uniform(2.2, 2.6),
+                     pulls)
+    shim = rod_pulls(random, random.uniform(45, 52), random.uniform(3.4, 3.8),
+                     pulls)
+    reg = rod_pulls(random, random.uniform(0, 5), random.uniform(1.2, 1.4),
+                    pulls)
+    withdrawal_times = [random.uniform(30, 40), random.uniform(60, 80),
+                        random.uniform(30, 40)]
+    return [safe, shim, reg], withdrawal_times
+
+def record(random, record_id, pulls=12):
+    """
+    A full calibration as a batch.py record, including rod bank data.
+    """
+    rod_pulls, withdrawal_times = calibration(random, pulls)
+    return batch.make_record(record_id, rod_pulls, withdrawal_times,
+                             rod_banks(random))
+
+def batch_arrays(random, rods, pulls=12):
+    """
+    Many rods' pulls stacked for rodcal.reactivity_calc_batch().
+
+    Returns:
+        (bottom, heights, periods), shapes (rods,), (rods, pulls) and
+        (rods, pulls).
+    """
+    bottom = random.uniform(0, 50, rods)
+    totals = random.uniform(1.2, 3.8, rods)
+    heights = np.array([pull_heights(random, b, pulls) for b in bottom])
+    starts = np.concatenate((bottom[:, np.newaxis], heights[:, :-1]), axis=1)
+    reactivity = (integral_worth(starts, totals[:, np.newaxis]) -
+                  integral_worth(heights, totals[:, np.newaxis]))
+    periods = period_for(reactivity)
+    periods *= 1 + 0.01 * random.standard_normal(periods.shape)
+    return bottom, heights, periods
+
+def rod_banks(random):
+    """
+    Rod bank data, as entered into rodbank.main(): a list of (power in kW,
+    banked height in %, core excess in $). The excess falls with power from
+    the power defect, and the banked height rises to hold it.
+    """
+    xenon_free = random.uniform(1.2, 1.5)
+    defect = random.uniform(1.2, 1.5) / 230.0
+    banks = []
+    for power in BANK_POWERS:
+        excess = xenon_free - defect * power
+        height = 100 - 30 * excess / xenon_free + random.normal(0, 0.3)
+        banks.append((power, round(height, 1), round(excess, 2)))
+    return banks
+
+def power_log(random, rod, rate=100.0, noise=0.005, hold=60.0):
+    """
+    A data acquisition power log of one rod's calibration. After each pull
+    the power rises as point kinetics predicts from the pull's period, for
+    five minutes or until it has grown a thousandfold, and is then held
+    steady while the next pull is readied.
+
+    Args:
+        random: A np.random.RandomState.
+        rod: The rod's pulls, as rod_pulls() returns.
+        rate: Samples per second.
+        noise: The relative scatter of each sample.
+        hold: Seconds of steady power before each pull.
+
+    Returns:
+        (times, power) arrays.
+    """
+    times = []
+    power = []
+    start = 0.0
+    level = 1.0
+    for height, period in rod[1:]:
+        steady = np.arange(0, hold, 1.0 / rate)
+        rising = np.arange(0, min(300.0, 7.0 * period), 1.0 / rate)
+        trace = kinetics.power(rodcal.inhour(period), rising)
+        times.extend([start + steady, start + hold + rising])
+        power.extend([np.full(len(steady), level), level * trace])
+        start += hold + rising[-1] + 1.0 / rate
+        level *= trace[-1]
+    power = np.concatenate(power)
+    return (np.concatenate(times),
+            power * (1 + noise * random.standard_normal(len(power))))
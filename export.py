@@ -0,0 +1,408 @@
+# Machine-readable outputs
+#
+# The Tech Specs results, the logbook worth tables and the banked rod height
+# table as CSV, JSON and a self-contained HTML page, written straight from
+# the numbers without templates or pdflatex, for other programs to read (and
+# people to glance at) in milliseconds. For each calibration:
+#
+#     techspecs.csv     key,value,description; one row per tech_specs() value,
+#                       a fit's coefficients space-separated in one field
+#     worthtables.csv   rod,height,worth; heights in %, worths in dollars
+#     banktable.csv     core_excess,<power>,...; rod heights in %, one row
+#                       per five-watt core excess in dollars, one column per
+#                       target power in kW
+#     techspecs.json    the tech_specs() dict, as batch.py has always written
+#     worthtables.json  {rod: {"height": [...], "worth": [...]}}
+#     banktable.json    {"xenon_free", "powers", "core_excesses", "heights"}
+#     calibration.html  all of the above on one page, the fits as TeX only
+#
+# With a name (e.g. a calibration ID), each file is named like
+# techspecs-<name>.csv instead. Usage:
+#
+#     python export.py records.json [--format csv,json,html] [-o DIR]
+
+import argparse
+import cgi
+import json
+import os
+
+import numpy as np
+
+import rodbank
+import rodcal
+import texwriter
+
+FORMATS = ["csv", "json", "html"]
+RODS = ["safe", "shim", "reg"]
+
+# The tech_specs() values, in report order, with what each one is
+TECH_SPECS = [
+    ("safeworth", "Safe rod worth ($)"),
+    ("shimworth", "Shim rod worth ($)"),
+    ("regworth", "Reg rod worth ($)"),
+    ("totalworth", "Total rod worth ($)"),
+    ("safemaxdpp", "Safe rod peak addition rate (cents/%)"),
+    ("shimmaxdpp", "Shim rod peak addition rate (cents/%)"),
+    ("regmaxdpp", "Reg rod peak addition rate (cents/%)"),
+    ("safemaxdps", "Safe rod peak addition rate (cents/s)"),
+    ("shimmaxdps", "Shim rod peak addition rate (cents/s)"),
+    ("regmaxdps", "Reg rod peak addition rate (cents/s)"),
+    ("safedpsok", "Safe rod addition rate below 12 cents/s"),
+    ("shimdpsok", "Shim rod addition rate below 12 cents/s"),
+    ("regdpsok", "Reg rod addition rate below 12 cents/s"),
+    ("safecxsht", "Lowest critical safe rod height (%)"),
+    ("shimcxsht", "Lowest critical shim rod height (%)"),
+    ("safecxs", "Core excess from the safe rod ($)"),
+    ("shimcxs", "Core excess from the shim rod ($)"),
+    ("cxsok", "Core excess below $3.00"),
+    ("safesdm", "Shutdown margin from the safe rod ($)"),
+    ("shimsdm", "Shutdown margin from the shim rod ($)"),
+    ("sdmok", "Shutdown margin above $1.00"),
+    ("mostrxvrod", "Most reactive rod"),
+    ("safeosr", "One-stuck-rod margin from the safe rod ($)"),
+    ("shimosr", "One-stuck-rod margin from the shim rod ($)"),
+    ("osrok", "One-stuck-rod margin above $0.50"),
+    ("safeintpoly", "Safe rod integral worth fit"),
+    ("safeaddpoly", "Safe rod addition rate fit"),
+    ("shimintpoly", "Shim rod integral worth fit"),
+    ("shimaddpoly", "Shim rod addition rate fit"),
+    ("regintpoly", "Reg rod integral worth fit"),
+    ("regaddpoly", "Reg rod addition rate fit"),
+    ("safeintpoly_coefficients",
+     "Safe rod integral worth fit coefficients, highest power first"),
+    ("safeaddpoly_coefficients",
+     "Safe rod addition rate fit coefficients, highest power first"),
+    ("shimintpoly_coefficients",
+     "Shim rod integral worth fit coefficients, highest power first"),
+    ("shimaddpoly_coefficients",
+     "Shim rod addition rate fit coefficients, highest power first"),
+    ("regintpoly_coefficients",
+     "Reg rod integral worth fit coefficients, highest power first"),
+    ("regaddpoly_coefficients",
+     "Reg rod addition rate fit coefficients, highest power first"),
+]
+
+# The pass/fail flags among them
+FLAGS = ["safedpsok", "shimdpsok", "regdpsok", "cxsok", "sdmok", "osrok"]
+
+
+def bank_data(banks, powers=rodbank.POWERS,
+              core_excesses=rodbank.CORE_EXCESSES):
+    """
+    Fit and tabulate rod bank data, as rodbank.main() does, for write().
+
+    Args:
+        banks: A list of (power in kW, banked height in %, core excess in $),
+            the first at (near) zero power.
+        powers, core_excesses: The table axes, as for rodbank.table().
+
+    Returns:
+        A dict of the "xenon_free" core excess, the "powers" and
+        "core_excesses" axes as arrays, and the "heights" array, one row per
+        core excess.
+    """
+    hvsrho = rodbank.rod_height_vs_core_excess(banks)
+    rhovsp = rodbank.core_excess_vs_power(banks)
+    return {"xenon_free": float(banks[0][2]),
+            "powers": np.asarray(powers, dtype=float),
+            "core_excesses": np.asarray(core_excesses, dtype=float),
+            "heights": rodbank.table(hvsrho, rhovsp, powers, core_excesses)}
+
+def tech_specs_rows(result):
+    """
+    The tech_specs() results as (key, value, description) rows, in report
+    order; values are plain Python numbers, bools and strings.
+    """
+    return [(key, _builtin(result[key]), description)
+            for key, description in TECH_SPECS if key in result]
+
+def worth_arrays(worth_tables):
+    """
+    The tabular_data() tables as arrays.
+
+    Returns:
+        [(rod, heights, worths)] for the safe, shim and reg rods.
+    """
+    arrays = []
+    for rod, table in zip(RODS, worth_tables):
+        data = np.asarray(table, dtype=float).reshape(-1, 2)
+        arrays.append((rod, data[:, 0], data[:, 1]))
+    return arrays
+
+def write_tech_specs_csv(result, f):
+    f.write("key,value,description\n")
+    for key, value, description in tech_specs_rows(result):
+        if isinstance(value, float):
+            value = "{:.10g}".format(value)
+        elif isinstance(value, list):
+            value = " ".join("{:.10g}".format(c) for c in value)
+        elif value is None:
+            value = ""
+        f.write(",".join(_csv_field(field)
+                         for field in (key, value, description)) + "\n")
+
+def write_worth_tables_csv(worth_tables, f):
+    f.write("rod,height,worth\n")
+    for rod, heights, worths in worth_arrays(worth_tables):
+        _write_rows(f, rod + ",%.10g,%.6f\n", np.column_stack([heights,
+                                                               worths]))
+
+def write_bank_table_csv(bank, f):
+    f.write(",".join(["core_excess"] + ["{:g}".format(power)
+                                        for power in bank["powers"]]) + "\n")
+    row = "%.6g" + ",%.4f" * len(bank["powers"]) + "\n"
+    _write_rows(f, row, np.column_stack([bank["core_excesses"],
+                                         bank["heights"]]))
+
+def worth_tables_json(worth_tables):
+    return dict((rod, {"height": heights.tolist(), "worth": worths.tolist()})
+                for rod, heights, worths in worth_arrays(worth_tables))
+
+def bank_table_json(bank):
+    return {"xenon_free": bank["xenon_free"],
+            "powers": bank["powers"].tolist(),
+            "core_excesses": bank["core_excesses"].tolist(),
+            "heights": np.asarray(bank["heights"]).tolist()}
+
+def html(result, worth_tables, bank=None, title="Control rod calibration"):
+    """
+    One self-contained HTML page (no scripts, no external files) showing the
+    Tech Specs results, the worth tables and, if given, the bank table.
+
+    Args:
+        result: The dict returned by rodcal.tech_specs().
+        worth_tables: [safe, shim, reg], as returned by rodcal.tabular_data().
+        bank: The dict returned by bank_data(), or None.
+        title: The page's title and heading.
+
+    Returns:
+        The page, as a string.
+    """
+    escape = lambda text: cgi.escape(unicode(text), quote=True)
+    parts = ["<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\">",
+             "<title>{}</title>".format(escape(title)), _STYLE,
+             "</head><body>\n<h1>{}</h1>\n".format(escape(title)),
+             "<h2>Tech Specs</h2>\n<table>\n"]
+    for key, value, description in tech_specs_rows(result):
+        if key.endswith("_coefficients"):
+            continue
+        if key in FLAGS:
+            css, value = ("ok", "OK") if value else ("problem", "PROBLEM")
+        else:
+            css = "poly" if key.endswith("poly") else ""
+            if isinstance(value, float):
+                value = "{:.2f}".format(value)
+        parts.append("<tr><th>{}</th><td class=\"{}\">{}</td></tr>\n".format(
+            escape(description), css, escape(value)))
+    parts.append("</table>\n")
+
+    parts.append("<h2>Rod worths</h2>\n<div class=\"tables\">\n")
+    for rod, heights, worths in worth_arrays(worth_tables):
+        parts.append("<table><caption>{}</caption>\n"
+                     "<tr><th>%</th><th>$</th></tr>\n".format(rod.title()))
+        _join_rows(parts, "<tr><td>%.1f</td><td>%.2f</td></tr>\n",
+                   np.column_stack([heights, worths]))
+        parts.append("</table>\n")
+    parts.append("</div>\n")
+
+    if bank is not None:
+        parts.append("<h2>Banked rod heights (%)</h2>\n<table>\n"
+                     "<tr><th>Core excess ($) \\ Power (kW)</th>")
+        parts.extend("<th>{:g}</th>".format(power) for power in bank["powers"])
+        parts.append("</tr>\n")
+        # Rows near the xenon-free core excess stand out, and heights off
+        # the top of the rods (or not found) are left blank, as in the PDF
+        near = np.abs(bank["core_excesses"] - bank["xenon_free"]) <= 0.05
+        heights = np.asarray(bank["heights"], dtype=float)
+        cells = np.char.mod("<td>%.1f</td>", heights).astype(object)
+        with np.errstate(invalid="ignore"):
+            blank = np.isnan(heights) | (heights >= 100.5)
+        cells[blank] = "<td></td>"
+        for excess, row, bold in zip(bank["core_excesses"], cells.tolist(),
+                                     near):
+            parts.append("<tr{}><th>{:.2f}</th>".format(
+                " class=\"near\"" if bold else "", excess))
+            parts.append("".join(row) + "</tr>\n")
+        parts.append("</table>\n")
+    parts.append("</body></html>\n")
+    return "".join(parts)
+
+def write(directory, formats, result, worth_tables, bank=None, name=None):
+    """
+    Write a calibration's results in each of formats.
+
+    Args:
+        directory: Where to write the files.
+        formats: Any of FORMATS.
+        result: The dict returned by rodcal.tech_specs().
+        worth_tables: [safe, shim, reg], as returned by rodcal.tabular_data().
+        bank: The dict returned by bank_data(), or None for no bank table.
+        name: Added to each filename, e.g. techspecs-<name>.csv, so as not to
+            overwrite other calibrations' files.
+
+    Returns:
+        The filenames written.
+
+    Raises:
+        ValueError: If a format isn't one of FORMATS.
+    """
+    _check_formats(formats)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def filename(kind, extension):
+        if name is not None:
+            kind = "{}-{}".format(kind, name)
+        return os.path.join(directory, "{}.{}".format(kind, extension))
+
+    written = []
+    if "csv" in formats:
+        outputs = [("techspecs", write_tech_specs_csv, result),
+                   ("worthtables", write_worth_tables_csv, worth_tables)]
+        if bank is not None:
+            outputs.append(("banktable", write_bank_table_csv, bank))
+        for kind, writer, data in outputs:
+            written.append(filename(kind, "csv"))
+            with open(written[-1], "w") as f:
+                writer(data, f)
+    if "json" in formats:
+        # The tech specs laid out for reading, the long arrays compactly
+        # (sorting or indenting keeps json off its C encoder)
+        outputs = [("techspecs", dict((key, _builtin(value))
+                                      for key, value in result.items()), 2),
+                   ("worthtables", worth_tables_json(worth_tables), None)]
+        if bank is not None:
+            outputs.append(("banktable", bank_table_json(bank), None))
+        for kind, data, indent in outputs:
+            written.append(filename(kind, "json"))
+            with open(written[-1], "w") as f:
+                f.write(json.dumps(data, indent=indent,
+                                   sort_keys=indent is not None))
+    if "html" in formats:
+        title = "Control rod calibration"
+        if name is not None:
+            title += " {}".format(name)
+        written.append(filename("calibration", "html"))
+        with open(written[-1], "w") as f:
+            f.write(html(result, worth_tables, bank, title).encode("utf-8"))
+    return written
+
+def calibrate(rod_pulls, withdrawal_times, directory=".", formats=FORMATS,
+              banks=None, name=None):
+    """
+    Run a calibration straight to the machine-readable outputs: fit each rod,
+    check the Tech Specs and write the results, without plots, templates or
+    pdflatex.
+
+    Args:
+        rod_pulls: [safe, shim, reg], each in the form rodcal.collect_rod()
+            returns.
+        withdrawal_times: List containing the time it takes to pull the [safe,
+            shim, reg] rods all the way out, in seconds.
+        directory: Where to write the files.
+        formats: Any of FORMATS.
+        banks: Optional rod bank data, as for bank_data().
+        name: As for write().
+
+    Returns:
+        A dict with the "fits" and "tech_specs", as rodcal.calibrate()
+        returns, and the "filenames" written.
+    """
+    fits = [rodcal.reactivity_calc(rod[0], rod[1:]) for rod in rod_pulls]
+    [(safe_int, _, safe_add, _), (shim_int, _, shim_add, _),
+     (reg_int, _, reg_add, _)] = fits
+    results = rodcal.tech_specs(safe_int, safe_add, shim_int, shim_add,
+                                reg_int, reg_add, rod_pulls[0][0],
+                                rod_pulls[1][0], withdrawal_times)
+    worth_tables = rodcal.tabular_data([safe_int, shim_int, reg_int])
+    bank = bank_data(banks) if banks else None
+    return {"fits": fits,
+            "tech_specs": results,
+            "filenames": write(directory, formats, results, worth_tables,
+                               bank, name)}
+
+def parse_formats(text):
+    """
+    Parse a comma-separated list of formats, as the --export options take.
+
+    Raises:
+        ValueError: If any isn't one of FORMATS.
+    """
+    formats = [fmt.strip().lower() for fmt in text.split(",") if fmt.strip()]
+    _check_formats(formats)
+    return formats
+
+def _check_formats(formats):
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise ValueError("unknown export format {!r} (expected one of "
+                             "{})".format(fmt, ", ".join(FORMATS)))
+
+def _builtin(value):
+    # numpy scalars, e.g. the np.bool_ Tech Specs flags, as plain Python
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+def _csv_field(value):
+    text = unicode(value).encode("utf-8")
+    if any(c in text for c in ",\"\n"):
+        text = "\"" + text.replace("\"", "\"\"") + "\""
+    return text
+
+def _write_rows(f, row, data, chunk_rows=texwriter.CHUNK_ROWS):
+    # One % operation per block of rows, as texwriter.py formats its tables
+    for start in xrange(0, len(data), chunk_rows):
+        block = data[start:start + chunk_rows]
+        f.write((row * len(block)) % tuple(block.ravel()))
+
+def _join_rows(parts, row, data, chunk_rows=texwriter.CHUNK_ROWS):
+    for start in xrange(0, len(data), chunk_rows):
+        block = data[start:start + chunk_rows]
+        parts.append((row * len(block)) % tuple(block.ravel()))
+
+_STYLE = """<style>
+body { font-family: sans-serif; margin: 2em; }
+table { border-collapse: collapse; margin: 0 1em 1em 0; }
+th, td { border: 1px solid #ccc; padding: 0.15em 0.5em; text-align: right; }
+th { background: #f4f4f4; }
+caption { font-weight: bold; }
+.tables { display: flex; align-items: flex-start; }
+.ok { color: #070; font-weight: bold; }
+.problem { color: #fff; background: #c00; font-weight: bold; }
+.poly { font-family: monospace; text-align: left; }
+tr.near td, tr.near th { font-weight: bold; background: #ffd; }
+</style>"""
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write calibration records' results as CSV, JSON and "
+                    "HTML, without typesetting anything.")
+    parser.add_argument("files", nargs="+",
+                        help="JSON or CSV files of calibration records (as "
+                             "for batch.py)")
+    parser.add_argument("--format", default=",".join(FORMATS),
+                        help="comma-separated formats to write (default: "
+                             "csv,json,html)")
+    parser.add_argument("-o", "--output", default=".",
+                        help="directory to write into; each file is named by "
+                             "its record's ID")
+    args = parser.parse_args()
+    try:
+        formats = parse_formats(args.format)
+    except ValueError as e:
+        parser.error(str(e))
+
+    import batch
+    for filename in args.files:
+        for record in batch.load_records(filename):
+            banks = [tuple(bank) for bank in record.get("banks") or []]
+            calibration = calibrate(batch.rod_pulls(record),
+                                    record["withdrawal_times"], args.output,
+                                    formats, banks, name=record["id"])
+            for written in calibration["filenames"]:
+                print written
+
+if __name__ == "__main__":
+    main()
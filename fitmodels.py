@@ -0,0 +1,472 @@
+# Fit models for the rod worth and rod bank curves
+#
+# reactivity_calc() and the rodbank fits use least-squares cubics, with the
+# clamps (no worth left at 100%, no addition rate at either end) added as
+# ordinary data points. The models here are alternatives behind one
+# interface, model.fit(x, y, clamps, weights), each giving a curve with
+# vectorized evaluate(), derivative(), inverse(), maximum() and table():
+#
+#     Cubic           least squares, clamps as data: the usual fits
+#     ClampedCubic    least squares, passing exactly through the clamps,
+#                     with optional weights on the data
+#     SCurve          least squares in 1, u, sin(2 pi u), 1 - cos(2 pi u),
+#                     u = x/100: the shape of an ideal rod's integral worth
+#                     (and, in the last term, of its addition rate), through
+#                     the clamps
+#     MonotoneSpline  a piecewise cubic through the points that never
+#                     overshoots them (PCHIP), so the integral worth stays
+#                     monotone
+#
+# Cubic curves are np.poly1d instances, so they go anywhere the usual fits
+# do. Pass a model to rodcal.reactivity_calc() or the rodbank fits to use it:
+#
+#     fits = rodcal.reactivity_calc(bottom, pulls, model=fitmodels.SCurve())
+#
+# Any curve can be plotted (render.py), tabulated (rodcal.tabular_data(),
+# worthtable.py), checked against the Tech Specs (rodcal.tech_specs()) and
+# exported (export.py). Code that works on the cubics' coefficients - the
+# Tech Specs sweep, inverse.MonotoneIndex and rodbank.RodHeightEvaluator -
+# takes them through polynomial(), which refuses other curves with a
+# ValueError saying so. The command-line tools, and the batch and history
+# stores, fit cubics.
+#
+# The linear models' design matrices on the height grids that tables and
+# inverse lookups use are computed once and cached, so tabulating a curve at
+# 0.001% is one matrix-vector product.
+
+import abc
+import collections
+import math
+
+import numpy as np
+
+# The heights the curves are defined over, in %
+RANGE = (0.0, 100.0)
+# Heights are scaled by this in the linear models' bases, so the columns of
+# the design matrices are all of order one
+SCALE = 100.0
+# Grid points for inverse lookups
+INVERSE_POINTS = 4097
+# Design matrices kept
+GRID_CACHE_SIZE = 32
+
+_grids = collections.OrderedDict()
+
+
+def heights(lo, hi, step):
+    """
+    Evenly spaced heights from lo to hi inclusive, counted in steps first so
+    the endpoints don't drift with rounding.
+    """
+    return np.linspace(lo, hi, int(round((hi - lo) / step)) + 1)
+
+def design(basis, lo, hi, step):
+    """
+    A basis's design matrices on a grid of heights, cached.
+
+    Args:
+        basis: A PolynomialBasis or CosineBasis.
+        lo, hi, step: The grid, as for heights().
+
+    Returns:
+        (x, values, derivatives): the heights, and the basis functions and
+        their derivatives at them, each shape (len(x), terms).
+    """
+    key = (basis.name, float(lo), float(hi), float(step))
+    if key in _grids:
+        return _grids[key]
+    x = heights(lo, hi, step)
+    result = (x, basis.matrix(x), basis.derivative_matrix(x))
+    if len(_grids) >= GRID_CACHE_SIZE:
+        _grids.popitem(last=False)
+    _grids[key] = result
+    return result
+
+
+def polynomial(fit, purpose):
+    """
+    A fit as a np.poly1d, for code that works on its coefficients.
+
+    Args:
+        fit: A np.poly1d (as the usual fits and Cubic and ClampedCubic give)
+            or its coefficients, or another model's curve.
+        purpose: What needs the coefficients, for the error message.
+
+    Raises:
+        ValueError: fit is a curve other than a polynomial.
+    """
+    if isinstance(fit, Curve) and not isinstance(fit, np.poly1d):
+        raise ValueError(
+            "{} needs polynomial fits, not a {}; fit with the cubic or "
+            "clamped cubic model".format(purpose, type(fit).__name__))
+    return np.poly1d(fit)
+
+
+class PolynomialBasis(object):
+    """
+    Powers of u = x/SCALE, highest first.
+    """
+    def __init__(self, degree=3):
+        self.degree = degree
+        self.name = "polynomial{}".format(degree)
+        self.powers = np.arange(degree, -1, -1)
+
+    def matrix(self, x):
+        u = np.asarray(x, dtype=float)[..., np.newaxis] / SCALE
+        return u ** self.powers
+
+    def derivative_matrix(self, x):
+        u = np.asarray(x, dtype=float)[..., np.newaxis] / SCALE
+        return (self.powers * u ** np.maximum(self.powers - 1, 0) /
+                SCALE)
+
+    def curve(self, coefficients):
+        # Back from u to x
+        return PolynomialCurve(coefficients / SCALE ** self.powers)
+
+
+class CosineBasis(object):
+    """
+    1, u, sin(2 pi u) and 1 - cos(2 pi u), with u = x/SCALE.
+    """
+    name = "cosine"
+
+    def matrix(self, x):
+        angle = 2 * math.pi * np.asarray(x, dtype=float) / SCALE
+        return np.stack((np.ones(angle.shape), angle / (2 * math.pi),
+                         np.sin(angle), 1 - np.cos(angle)), axis=-1)
+
+    def derivative_matrix(self, x):
+        angle = 2 * math.pi * np.asarray(x, dtype=float) / SCALE
+        return np.stack((np.zeros(angle.shape), np.ones(angle.shape),
+                         2 * math.pi * np.cos(angle),
+                         2 * math.pi * np.sin(angle)), axis=-1) / SCALE
+
+    def curve(self, coefficients):
+        return CosineCurve(coefficients)
+
+
+class Curve(object):
+    """
+    A fitted curve. Subclasses provide evaluate() and derivative(), and
+    can't be made without them; the rest is built on them.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def evaluate(self, x):
+        """
+        The curve's values at heights x, an array of any shape.
+        """
+
+    @abc.abstractmethod
+    def derivative(self, x):
+        """
+        The curve's slope at heights x, an array of any shape.
+        """
+
+    def table(self, lo, hi, step):
+        """
+        Tabulate the curve on a grid of heights, as for heights().
+
+        Returns:
+            (x, values) arrays.
+        """
+        x = heights(lo, hi, step)
+        return x, self.evaluate(x)
+
+    def inverse(self, y, lo=RANGE[0], hi=RANGE[1]):
+        """
+        Find the heights in [lo, hi] where the curve takes values y, for many
+        y at once, by interpolating in a table and polishing with Newton
+        steps.
+
+        Args:
+            y: Target values, scalar or array.
+            lo, hi: The range to look in, where the curve must be monotone.
+
+        Returns:
+            An array of heights shaped like y; NaN for targets the curve
+            doesn't reach in [lo, hi].
+
+        Raises:
+            ValueError: The curve isn't monotone on [lo, hi].
+        """
+        key = (float(lo), float(hi))
+        if not hasattr(self, "_inverse_tables"):
+            self._inverse_tables = {}
+        tables = self._inverse_tables
+        if key not in tables:
+            x, values = self.table(lo, hi, (hi - lo) / (INVERSE_POINTS - 1))
+            steps = np.diff(values)
+            if not (np.all(steps > 0) or np.all(steps < 0)):
+                raise ValueError("The curve is not monotone on [{}, {}]"
+                                 .format(lo, hi))
+            if steps[0] < 0:
+                x, values = x[::-1], values[::-1]
+            tables[key] = (x, values)
+        x_table, y_table = tables[key]
+
+        y = np.asarray(y, dtype=float)
+        x = np.interp(y, y_table, x_table)
+        for _ in xrange(2):
+            slope = self.derivative(x)
+            x = x - (self.evaluate(x) - y) / np.where(slope == 0, np.inf,
+                                                       slope)
+            x = np.clip(x, lo, hi)
+        return np.where((y < y_table[0]) | (y > y_table[-1]), np.nan, x)
+
+    def maximum(self, lo=RANGE[0], hi=RANGE[1], points=1001):
+        """
+        The curve's largest value on [lo, hi], found on a grid and refined
+        around the best point.
+
+        Returns:
+            (height, value).
+        """
+        x, values = self.table(lo, hi, (hi - lo) / (points - 1))
+        best = x[np.argmax(values)]
+        step = (hi - lo) / (points - 1)
+        for _ in xrange(3):
+            x = np.clip(np.linspace(best - step, best + step, 41), lo, hi)
+            values = self.evaluate(x)
+            best = x[np.argmax(values)]
+            step /= 20.0
+        return best, self.evaluate(best).item()
+
+    def __call__(self, x):
+        return self.evaluate(x)
+
+
+class PolynomialCurve(np.poly1d, Curve):
+    """
+    A polynomial fit: an np.poly1d, with the Curve methods.
+    """
+    def evaluate(self, x):
+        return np.poly1d.__call__(self, np.asarray(x, dtype=float))
+
+    def derivative(self, x):
+        return np.polyval(self.deriv().c, np.asarray(x, dtype=float))
+
+    def table(self, lo, hi, step):
+        basis = PolynomialBasis(self.order)
+        x, values, _ = design(basis, lo, hi, step)
+        return x, values.dot(self.c * SCALE ** basis.powers)
+
+    def maximum(self, lo=RANGE[0], hi=RANGE[1]):
+        # The turning points and the ends, exactly
+        candidates = [lo, hi] + [root.real for root in
+                                 np.atleast_1d(self.deriv().r)
+                                 if abs(root.imag) < 1e-12 and
+                                 lo <= root.real <= hi]
+        values = self.evaluate(candidates)
+        best = np.argmax(values)
+        return candidates[best], values[best].item()
+
+
+class LinearCurve(Curve):
+    """
+    A fit in a linear basis other than the polynomials.
+    """
+    def __init__(self, basis, coefficients):
+        self.basis = basis
+        self.coefficients = np.asarray(coefficients, dtype=float)
+
+    def evaluate(self, x):
+        return self.basis.matrix(x).dot(self.coefficients)
+
+    def derivative(self, x):
+        return self.basis.derivative_matrix(x).dot(self.coefficients)
+
+    def table(self, lo, hi, step):
+        x, values, _ = design(self.basis, lo, hi, step)
+        return x, values.dot(self.coefficients)
+
+
+class CosineCurve(LinearCurve):
+    """
+    a + b u + c sin(2 pi u) + d (1 - cos(2 pi u)), with u = x/100.
+    """
+    def __init__(self, coefficients):
+        LinearCurve.__init__(self, CosineBasis(), coefficients)
+
+    def tex(self):
+        a, b, c, d = self.coefficients
+        return ("${:.6g} + {:.6g} \\, u + {:.6g} \\, \\sin 2 \\pi u + {:.6g} "
+                "\\, (1 - \\cos 2 \\pi u), \\quad u = x / 100$".format(
+                    a, b, c, d))
+
+
+class SplineCurve(Curve):
+    """
+    A piecewise cubic Hermite curve through a set of points. Beyond the
+    points it continues in straight lines at the end slopes.
+    """
+    def __init__(self, x, y, slopes):
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.slopes = np.asarray(slopes, dtype=float)
+
+    def _pieces(self, x):
+        x = np.asarray(x, dtype=float)
+        i = np.clip(np.searchsorted(self.x, x) - 1, 0, len(self.x) - 2)
+        h = self.x[i + 1] - self.x[i]
+        t = np.clip((x - self.x[i]) / h, 0, 1)
+        # How far beyond the ends, for the straight-line extensions
+        beyond = (np.minimum(x - self.x[0], 0) +
+                  np.maximum(x - self.x[-1], 0))
+        return i, h, t, beyond
+
+    def evaluate(self, x):
+        i, h, t, beyond = self._pieces(x)
+        t2 = t * t
+        t3 = t2 * t
+        return ((2 * t3 - 3 * t2 + 1) * self.y[i] +
+                (t3 - 2 * t2 + t) * h * self.slopes[i] +
+                (-2 * t3 + 3 * t2) * self.y[i + 1] +
+                (t3 - t2) * h * self.slopes[i + 1] +
+                beyond * np.where(beyond < 0, self.slopes[0],
+                                  self.slopes[-1]))
+
+    def derivative(self, x):
+        i, h, t, beyond = self._pieces(x)
+        t2 = t * t
+        inside = ((6 * t2 - 6 * t) * (self.y[i] - self.y[i + 1]) / h +
+                  (3 * t2 - 4 * t + 1) * self.slopes[i] +
+                  (3 * t2 - 2 * t) * self.slopes[i + 1])
+        return np.where(beyond < 0, self.slopes[0],
+                        np.where(beyond > 0, self.slopes[-1], inside))
+
+    def tex(self):
+        return "monotone cubic spline through {} points".format(len(self.x))
+
+
+class Cubic(object):
+    """
+    A least-squares cubic, with the clamps as ordinary data points: what
+    np.polyfit(x, y, 3) gives, to within rounding.
+    """
+    name = "cubic"
+    basis = PolynomialBasis(3)
+    # Whether fits pass exactly through the clamps
+    exact_clamps = False
+
+    def fit(self, x, y, clamps=(), weights=None):
+        """
+        Fit a curve to data.
+
+        Args:
+            x, y: The data.
+            clamps: (x, y) points the curve is held to, e.g. (100, 0) for
+                the integral worth.
+            weights: Optional weights on the data points (not the clamps),
+                e.g. the inverse variances of the readings.
+
+        Returns:
+            The fitted curve.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        weights = (np.ones(len(x)) if weights is None else
+                   np.asarray(weights, dtype=float))
+        clamp_x = np.array([point[0] for point in clamps], dtype=float)
+        clamp_y = np.array([point[1] for point in clamps], dtype=float)
+        if not self.exact_clamps:
+            x = np.concatenate((x, clamp_x))
+            y = np.concatenate((y, clamp_y))
+            weights = np.concatenate((weights, np.ones(len(clamp_x))))
+            clamp_x = clamp_y = np.zeros(0)
+
+        root = np.sqrt(weights)
+        coefficients = _least_squares(
+            self.basis.matrix(x) * root[:, np.newaxis], y * root,
+            self.basis.matrix(clamp_x), clamp_y)
+        return self.basis.curve(coefficients)
+
+
+class ClampedCubic(Cubic):
+    """
+    A least-squares cubic through the clamps exactly, with optional weights.
+    """
+    name = "clamped cubic"
+    exact_clamps = True
+
+
+class SCurve(Cubic):
+    """
+    An ideal rod's S-curve, least squares through the clamps exactly: the
+    integral worth of a rod in a cosine flux is a + b u + c sin(2 pi u), and
+    its addition rate is a + d (1 - cos(2 pi u)), u = x/100.
+    """
+    name = "s-curve"
+    basis = CosineBasis()
+    exact_clamps = True
+
+
+class MonotoneSpline(object):
+    """
+    A monotone piecewise cubic (PCHIP) through the data and clamps: it keeps
+    to the shape of the points, without overshooting between them. Points at
+    the same height are averaged; weights are ignored.
+    """
+    name = "monotone spline"
+
+    def fit(self, x, y, clamps=(), weights=None):
+        x = np.concatenate((np.asarray(x, dtype=float),
+                            [point[0] for point in clamps]))
+        y = np.concatenate((np.asarray(y, dtype=float),
+                            [point[1] for point in clamps]))
+        x, index = np.unique(x, return_inverse=True)
+        y = np.bincount(index, y) / np.bincount(index)
+        if len(x) < 2:
+            raise ValueError("A spline needs at least two distinct heights")
+        return SplineCurve(x, y, _pchip_slopes(x, y))
+
+
+MODELS = collections.OrderedDict(
+    (model.name, model) for model in [Cubic(), ClampedCubic(), SCurve(),
+                                      MonotoneSpline()])
+
+
+def _least_squares(lhs, rhs, constraints, targets):
+    """
+    Solve lhs c = rhs in the least-squares sense subject to constraints c =
+    targets exactly, by solving within the constraints' null space.
+    """
+    if not len(constraints):
+        return np.linalg.lstsq(lhs, rhs, rcond=None)[0]
+    particular = np.linalg.lstsq(constraints, targets, rcond=None)[0]
+    _, s, vt = np.linalg.svd(constraints)
+    rank = np.sum(s > s[0] * max(constraints.shape) * np.finfo(float).eps)
+    null = vt[rank:].T
+    free = np.linalg.lstsq(lhs.dot(null), rhs - lhs.dot(particular),
+                           rcond=None)[0]
+    return particular + null.dot(free)
+
+def _pchip_slopes(x, y):
+    """
+    The slopes at the points of a monotone piecewise cubic through them
+    (Fritsch and Carlson, with the three-point ends scipy's PCHIP uses).
+    """
+    h = np.diff(x)
+    delta = np.diff(y) / h
+    if len(x) == 2:
+        return np.array([delta[0], delta[0]])
+
+    slopes = np.zeros(len(x))
+    w1 = 2 * h[1:] + h[:-1]
+    w2 = h[1:] + 2 * h[:-1]
+    same = (np.sign(delta[:-1]) * np.sign(delta[1:])) > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        harmonic = (w1 + w2) / (w1 / delta[:-1] + w2 / delta[1:])
+    slopes[1:-1] = np.where(same, harmonic, 0.0)
+
+    for end, h0, h1, d0, d1 in [(0, h[0], h[1], delta[0], delta[1]),
+                                (-1, h[-1], h[-2], delta[-1], delta[-2])]:
+        slope = ((2 * h0 + h1) * d0 - h0 * d1) / (h0 + h1)
+        if np.sign(slope) != np.sign(d0):
+            slope = 0.0
+        elif np.sign(d0) != np.sign(d1) and abs(slope) > abs(3 * d0):
+            slope = 3 * d0
+        slopes[end] = slope
+    return slopes
@@ -0,0 +1,523 @@
+# Calibration history
+#
+# Every calibration's raw pulls, fit coefficients, Tech Specs results and rod
+# bank fits, kept in one SQLite file so trends across years of calibrations
+# (rod worth drift, the core excess creeping up, shutdown margin shrinking)
+# are a query away, without re-parsing reports or refitting anything. The
+# fits and results are indexed by date (and the fits by rod), and queries
+# return numpy arrays ready to plot. Each calibration gets an ID, which names
+# its report and tables in place of the first unused number, with the
+# store's tag (report-h<ID>-<tag>.tex): a random one each store is given when
+# it's made, so that two stores' calibrations never share a name and a
+# corrected re-run replaces its own outputs. Usage:
+#
+#     python history.py add records.json [more.csv ...]
+#     python history.py list [--since 2015-01-01] [--until 2020-12-31]
+#     python history.py trend totalworth safecxs safesdm [--since ...]
+#     python history.py worth reg [--height 0]
+#
+# The store is rodcal-history.sqlite in the current directory, or --history
+# FILE. rodcal.py adds each calibration it runs.
+
+import argparse
+import datetime
+import json
+import os
+import re
+import sqlite3
+import uuid
+
+import numpy as np
+
+import batch
+import rodbank
+import rodcal
+
+RODS = ["safe", "shim", "reg"]
+
+FILENAME = "rodcal-history.sqlite"
+
+# The Tech Specs results kept, from rodcal.tech_specs(): (name, SQL type).
+# The TeX polynomials aren't; they're the fits, formatted.
+TECH_SPECS = ([(name, "REAL") for name in [
+                  "safeworth", "shimworth", "regworth", "totalworth",
+                  "safemaxdpp", "shimmaxdpp", "regmaxdpp",
+                  "safemaxdps", "shimmaxdps", "regmaxdps",
+                  "safecxsht", "shimcxsht", "safecxs", "shimcxs",
+                  "safesdm", "shimsdm", "safeosr", "shimosr"]] +
+              [(name, "INTEGER") for name in [
+                  "safedpsok", "shimdpsok", "regdpsok", "cxsok", "sdmok",
+                  "osrok"]] +
+              [("mostrxvrod", "TEXT")])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS calibrations (
+    id INTEGER PRIMARY KEY,
+    record_id TEXT NOT NULL UNIQUE,
+    date TEXT NOT NULL,
+    added TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS calibrations_date ON calibrations (date);
+
+CREATE TABLE IF NOT EXISTS pulls (
+    calibration INTEGER NOT NULL REFERENCES calibrations (id),
+    rod TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    start REAL NOT NULL,
+    height REAL NOT NULL,
+    period REAL NOT NULL,
+    PRIMARY KEY (calibration, rod, number)
+);
+
+CREATE TABLE IF NOT EXISTS fits (
+    calibration INTEGER NOT NULL REFERENCES calibrations (id),
+    rod TEXT NOT NULL,
+    date TEXT NOT NULL,
+    integral3 REAL, integral2 REAL, integral1 REAL, integral0 REAL,
+    rate3 REAL, rate2 REAL, rate1 REAL, rate0 REAL,
+    PRIMARY KEY (calibration, rod)
+);
+CREATE INDEX IF NOT EXISTS fits_rod_date ON fits (rod, date);
+
+CREATE TABLE IF NOT EXISTS tech_specs (
+    calibration INTEGER PRIMARY KEY REFERENCES calibrations (id),
+    date TEXT NOT NULL,
+    {tech_specs}
+);
+CREATE INDEX IF NOT EXISTS tech_specs_date ON tech_specs (date);
+
+CREATE TABLE IF NOT EXISTS bank_fits (
+    calibration INTEGER PRIMARY KEY REFERENCES calibrations (id),
+    date TEXT NOT NULL,
+    xenon_free REAL NOT NULL,
+    height3 REAL, height2 REAL, height1 REAL, height0 REAL,
+    excess3 REAL, excess2 REAL, excess1 REAL, excess0 REAL
+);
+CREATE INDEX IF NOT EXISTS bank_fits_date ON bank_fits (date);
+""".format(tech_specs=",\n    ".join("{} {}".format(name, kind)
+                                     for name, kind in TECH_SPECS))
+
+# Bumped when SCHEMA changes incompatibly
+VERSION = 1
+
+
+class History(object):
+    """
+    The calibration history store:
+
+        with History() as history:
+            calibration_id = history.add(record)
+            dates, values = history.trend("totalworth")
+    """
+    def __init__(self, filename=FILENAME):
+        """
+        Args:
+            filename: The SQLite file, created if it doesn't exist.
+
+        Raises:
+            ValueError: The file is from a newer version of this program.
+        """
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version > VERSION:
+            raise ValueError("{} is a version {} history; this program reads "
+                             "version {}".format(filename, version, VERSION))
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+            self.connection.execute("PRAGMA user_version = {}".format(VERSION))
+            self.connection.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('tag', ?)",
+                (uuid.uuid4().hex[:8],))
+        # The store's tag, for naming its calibrations' outputs
+        self.tag = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'tag'").fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, record, calibration=None, date=None):
+        """
+        Add a calibration, or replace one with the same record ID (as when a
+        mistyped entry is corrected), keeping its calibration ID.
+
+        Args:
+            record: A record dict, as batch.load_records() returns.
+            calibration: The dict rodcal.calibrate() returned for it, if it's
+                been run; otherwise the fits and Tech Specs are worked out
+                here.
+            date: The calibration's date, as "YYYY-MM-DD"; defaults to
+                record_date(record).
+
+        Returns:
+            The calibration ID.
+        """
+        date = date or record_date(record)
+        rod_pulls = batch.rod_pulls(record)
+        if calibration is None:
+            fits = [rodcal.reactivity_calc(pulls[0], pulls[1:])
+                    for pulls in rod_pulls]
+            [(safe_int, _, safe_add, _), (shim_int, _, shim_add, _),
+             (reg_int, _, reg_add, _)] = fits
+            results = rodcal.tech_specs(safe_int, safe_add, shim_int, shim_add,
+                                        reg_int, reg_add, rod_pulls[0][0],
+                                        rod_pulls[1][0],
+                                        record["withdrawal_times"])
+        else:
+            fits = calibration["fits"]
+            results = calibration["tech_specs"]
+
+        with self.connection:
+            cursor = self.connection.cursor()
+            row = cursor.execute("SELECT id FROM calibrations "
+                                 "WHERE record_id = ?",
+                                 (str(record["id"]),)).fetchone()
+            values = (str(record["id"]), date,
+                      datetime.datetime.now().isoformat(),
+                      json.dumps(record, sort_keys=True))
+            if row is None:
+                cursor.execute("INSERT INTO calibrations (record_id, date, "
+                               "added, record) VALUES (?, ?, ?, ?)", values)
+                calibration_id = cursor.lastrowid
+            else:
+                calibration_id = row[0]
+                cursor.execute("UPDATE calibrations SET record_id = ?, "
+                               "date = ?, added = ?, record = ? WHERE id = ?",
+                               values + (calibration_id,))
+                for table in "pulls", "fits", "tech_specs", "bank_fits":
+                    cursor.execute("DELETE FROM {} WHERE calibration = ?"
+                                   .format(table), (calibration_id,))
+
+            for rod, pulls, (integral_fit, _, addition_rate_fit, _) in zip(
+                    RODS, rod_pulls, fits):
+                starts = [pulls[0]] + [height for height, _ in pulls[1:-1]]
+                cursor.executemany(
+                    "INSERT INTO pulls VALUES (?, ?, ?, ?, ?, ?)",
+                    [(calibration_id, rod, number, start, height, period)
+                     for number, (start, (height, period)) in
+                     enumerate(zip(starts, pulls[1:]), 1)])
+                cursor.execute(
+                    "INSERT INTO fits VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (calibration_id, rod, date) +
+                    tuple(_builtin(c) for c in integral_fit.c) +
+                    tuple(_builtin(c) for c in addition_rate_fit.c))
+
+            names = [name for name, _ in TECH_SPECS]
+            cursor.execute(
+                "INSERT INTO tech_specs (calibration, date, {}) VALUES ({})"
+                .format(", ".join(names), ", ".join("?" * (len(names) + 2))),
+                (calibration_id, date) +
+                tuple(_builtin(results[name]) for name in names))
+
+            if record.get("banks"):
+                banks = [tuple(bank) for bank in record["banks"]]
+                hvsrho = rodbank.rod_height_vs_core_excess(banks)
+                rhovsp = rodbank.core_excess_vs_power(banks)
+                cursor.execute(
+                    "INSERT INTO bank_fits VALUES "
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (calibration_id, date, banks[0][2]) +
+                    tuple(_builtin(c) for c in hvsrho.c) +
+                    tuple(_builtin(c) for c in rhovsp.c))
+        return calibration_id
+
+    def calibrations(self, start=None, end=None):
+        """
+        List the calibrations, oldest first.
+
+        Args:
+            start, end: Only those from these dates ("YYYY-MM-DD"), inclusive.
+
+        Returns:
+            A list of dicts of each calibration's "id", "record_id" and
+            "date".
+        """
+        where, parameters = _between(start, end)
+        return [{"id": row[0], "record_id": row[1], "date": row[2]}
+                for row in self.connection.execute(
+                    "SELECT id, record_id, date FROM calibrations " + where +
+                    " ORDER BY date, id", parameters)]
+
+    def record(self, calibration_id):
+        """
+        The record a calibration was added from.
+
+        Raises:
+            KeyError: There's no such calibration.
+        """
+        row = self.connection.execute(
+            "SELECT record FROM calibrations WHERE id = ?",
+            (calibration_id,)).fetchone()
+        if row is None:
+            raise KeyError(calibration_id)
+        return json.loads(row[0])
+
+    def rod_pulls(self, calibration_id):
+        """
+        A calibration's pulls, as [safe, shim, reg], each in the form
+        rodcal.collect_rod() returns.
+
+        Raises:
+            KeyError: There's no such calibration.
+        """
+        rows = self.connection.execute(
+            "SELECT rod, start, height, period FROM pulls "
+            "WHERE calibration = ? ORDER BY rod, number",
+            (calibration_id,)).fetchall()
+        if not rows:
+            raise KeyError(calibration_id)
+        result = []
+        for rod in RODS:
+            pulls = [row[1:] for row in rows if row[0] == rod]
+            result.append([pulls[0][0]] + [(height, period)
+                                           for _, height, period in pulls])
+        return result
+
+    def trend(self, quantity, start=None, end=None):
+        """
+        One Tech Specs result over time, e.g. "totalworth", "safecxs",
+        "shimsdm" or "cxsok".
+
+        Args:
+            quantity: A name in TECH_SPECS.
+            start, end: Only calibrations from these dates, inclusive.
+
+        Returns:
+            (dates, values): arrays, oldest first, of datetime64[D] and of
+            the values.
+
+        Raises:
+            ValueError: quantity isn't in TECH_SPECS.
+        """
+        kinds = dict(TECH_SPECS)
+        if quantity not in kinds:
+            raise ValueError("Unknown quantity {}; choose from {}".format(
+                quantity, ", ".join(kinds)))
+        where, parameters = _between(start, end)
+        rows = self.connection.execute(
+            "SELECT date, {} FROM tech_specs {} ORDER BY date, calibration"
+            .format(quantity, where), parameters).fetchall()
+        dates = np.array([row[0] for row in rows], dtype="datetime64[D]")
+        if kinds[quantity] == "TEXT":
+            return dates, np.array([row[1] for row in rows], dtype=object)
+        return dates, np.array([row[1] for row in rows], dtype=float)
+
+    def fits(self, rod, start=None, end=None):
+        """
+        A rod's fits over time.
+
+        Args:
+            rod: "safe", "shim" or "reg".
+            start, end: Only calibrations from these dates, inclusive.
+
+        Returns:
+            (dates, integral, rate): arrays, oldest first, of datetime64[D],
+            and of the integral worth and addition rate fit coefficients,
+            each shape (calibrations, 4) with the highest power first as in
+            np.poly1d.c.
+        """
+        where, parameters = _between(start, end, "AND")
+        rows = self.connection.execute(
+            "SELECT date, integral3, integral2, integral1, integral0, rate3, "
+            "rate2, rate1, rate0 FROM fits WHERE rod = ? {} "
+            "ORDER BY date, calibration".format(where),
+            (rod,) + parameters).fetchall()
+        dates = np.array([row[0] for row in rows], dtype="datetime64[D]")
+        coefficients = np.array([row[1:] for row in rows],
+                                dtype=float).reshape(-1, 8)
+        return dates, coefficients[:, :4], coefficients[:, 4:]
+
+    def worth(self, rod, height=0.0, start=None, end=None):
+        """
+        A rod's fitted integral worth above a height, over time: with the
+        default height of 0%, its total worth.
+
+        Returns:
+            (dates, worths): arrays, oldest first, of datetime64[D] and of
+            dollars.
+        """
+        dates, integral, _ = self.fits(rod, start, end)
+        worths = np.zeros(len(integral))
+        for column in xrange(4):
+            worths = worths * height + integral[:, column]
+        return dates, worths
+
+    def bank_fits(self, start=None, end=None):
+        """
+        The rod bank fits over time, from calibrations with bank data.
+
+        Returns:
+            (dates, xenon_free, height_vs_excess, excess_vs_power): arrays,
+            oldest first, of datetime64[D], of the xenon-free core excess,
+            and of rodbank.rod_height_vs_core_excess() and
+            rodbank.core_excess_vs_power() coefficients, each shape
+            (calibrations, 4).
+        """
+        where, parameters = _between(start, end)
+        rows = self.connection.execute(
+            "SELECT date, xenon_free, height3, height2, height1, height0, "
+            "excess3, excess2, excess1, excess0 FROM bank_fits {} "
+            "ORDER BY date, calibration".format(where), parameters).fetchall()
+        dates = np.array([row[0] for row in rows], dtype="datetime64[D]")
+        values = np.array([row[1:] for row in rows], dtype=float).reshape(-1, 9)
+        return dates, values[:, 0], values[:, 1:5], values[:, 5:]
+
+    def artifact_name(self, calibration_id):
+        """
+        What a calibration's outputs are named by: hID-TAG, the h keeping
+        them apart from the kind-N.tex of runs without a history and the
+        store's tag from other stores' calibrations of the same ID.
+
+        Args:
+            calibration_id: As add() returns.
+        """
+        return "h{}-{}".format(calibration_id, self.tag)
+
+    def artifact(self, calibration_id, kind, directory="."):
+        """
+        The filename for one of a calibration's outputs, kind-NAME.tex, NAME
+        as artifact_name() gives it.
+
+        Args:
+            calibration_id: As add() returns.
+            kind: What it is, e.g. "report", "worthtable" or "banktable".
+            directory: Where it goes; the filename includes it unless it is
+                the current directory.
+        """
+        name = self.artifact_name(calibration_id)
+        return os.path.normpath(os.path.join(
+            directory, "{}-{}.tex".format(kind, name)))
+
+
+def record_date(record):
+    """
+    A record's date, as "YYYY-MM-DD": its "date", if it has one, or else the
+    date its ID starts with (as in "20210125" or "20210125-143000"), or else
+    today's.
+    """
+    if record.get("date"):
+        return str(record["date"])
+    match = re.match(r"(\d{4})-?(\d{2})-?(\d{2})", str(record["id"]))
+    if match:
+        try:
+            return datetime.date(*[int(part) for part in
+                                   match.groups()]).isoformat()
+        except ValueError:
+            pass
+    return datetime.date.today().isoformat()
+
+def _between(start, end, conjunction="WHERE"):
+    """
+    An SQL condition on the date column, and its parameters.
+    """
+    conditions = []
+    parameters = ()
+    if start:
+        conditions.append("date >= ?")
+        parameters += (str(start),)
+    if end:
+        conditions.append("date <= ?")
+        parameters += (str(end),)
+    if not conditions:
+        return "", parameters
+    return conjunction + " " + " AND ".join(conditions), parameters
+
+def _builtin(value):
+    """
+    A numpy scalar (e.g. a np.bool_ Tech Specs flag) as the Python value
+    sqlite3 can store.
+    """
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+def per_year(dates, values):
+    """
+    The least-squares rate of change of values over dates, per year, or NaN
+    with fewer than two distinct dates.
+    """
+    days = (dates - dates.min()).astype(float) if len(dates) else dates
+    values = np.asarray(values, dtype=float)
+    keep = np.isfinite(values)
+    if len(np.unique(days[keep])) < 2:
+        return float("nan")
+    return np.polyfit(days[keep], values[keep], 1)[0] * 365.25
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep and query the history of control rod "
+                    "calibrations.")
+    parser.add_argument("--history", default=FILENAME, metavar="FILE",
+                        help="the history store (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command")
+
+    add = commands.add_parser("add", help="add calibration records")
+    add.add_argument("files", nargs="+",
+                     help="JSON or CSV files of calibration records, as for "
+                          "batch.py")
+
+    for name, text in [("list", "list the calibrations"),
+                       ("trend", "show Tech Specs results over time"),
+                       ("worth", "show a rod's fitted worth over time")]:
+        command = commands.add_parser(name, help=text)
+        command.add_argument("--since", metavar="YYYY-MM-DD")
+        command.add_argument("--until", metavar="YYYY-MM-DD")
+        if name == "trend":
+            command.add_argument("quantities", nargs="+",
+                                 help="e.g. totalworth safecxs shimsdm")
+        elif name == "worth":
+            command.add_argument("rod", choices=RODS)
+            command.add_argument("--height", type=float, default=0.0,
+                                 help="worth above this height, in %% "
+                                      "(default: 0, the total worth)")
+    args = parser.parse_args()
+
+    with History(args.history) as history:
+        if args.command == "add":
+            for filename in args.files:
+                for record in batch.load_records(filename):
+                    print "{}: calibration {}".format(record["id"],
+                                                      history.add(record))
+        elif args.command == "list":
+            for calibration in history.calibrations(args.since, args.until):
+                print "{id:6d}  {date}  {record_id}".format(**calibration)
+        elif args.command == "trend":
+            series = [history.trend(quantity, args.since, args.until)
+                      for quantity in args.quantities]
+            print "Date        " + "".join("{:>12}".format(quantity)
+                                           for quantity in args.quantities)
+            dates = series[0][0]
+            for row in xrange(len(dates)):
+                print "{}  ".format(dates[row]) + "".join(
+                    "{:>12}".format(_cell(values[row]))
+                    for _, values in series)
+            print "Per year    " + "".join(
+                "{:>12}".format("" if values.dtype == object else
+                                "{:+.4f}".format(per_year(dates, values)))
+                for dates, values in series)
+        else:
+            dates, worths = history.worth(args.rod, args.height, args.since,
+                                          args.until)
+            for date, worth in zip(dates, worths):
+                print "{}  ${:.3f}".format(date, worth)
+            print "Per year    {:+.4f} $".format(per_year(dates, worths))
+
+def _cell(value):
+    if isinstance(value, basestring):
+        return value
+    return "{:.3f}".format(value)
+
+if __name__ == "__main__":
+    main()
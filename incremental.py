@@ -0,0 +1,254 @@
+# Incremental calibration runs
+#
+# The calibration is a small dependency graph:
+#
+#     rod pulls -> fit-<rod> -> plots-<rod> ------------------+
+#                      |                                      |
+#                      +-> tables (worth tables .tex) ----+   |
+#                      +-> tech specs -> report (.tex) ---+---+-> PDFs
+#
+# Each stage's result is kept on disk under a hash of its inputs (including
+# the keys of the stages it depends on), so running the same calibration into
+# the same directory again only recomputes the stages downstream of whatever
+# input changed. Correcting one Reg pull, say, refits and replots the Reg rod
+# and regenerates the worth tables, the report and their PDFs, but reuses the
+# Safe and Shim fits and plots. The PDFs are cached by typesetting.py, by the
+# content of the .tex files and plots.
+#
+# Output filenames are fixed (worthtable.tex, report.tex, <rod>-<kind>.png)
+# so that a re-run updates the same files.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+import instrument
+import render
+import rodcal
+import typesetting
+
+RODS = ["safe", "shim", "reg"]
+
+# Bump this when a change to the calculations or the plots should invalidate
+# everything cached so far.
+VERSION = 1
+
+# The stage cache in each output directory
+CACHE_DIRNAME = ".stages"
+
+TABLE_FILENAME = "worthtable.tex"
+REPORT_FILENAME = "report.tex"
+
+
+class StageCache(object):
+    """
+    Results of pipeline stages, stored on disk by a hash of their inputs.
+
+    A stage produces a JSON-able value and optionally some files. Both are
+    kept: the value in a small manifest, the files by content hash, so a stage
+    whose inputs come back to an earlier state restores its earlier files
+    without recomputing them.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.recomputed = []
+        self.reused = []
+
+    def key(self, stage, *inputs):
+        """
+        Hash a stage's name and inputs: JSON-able values, the keys of the
+        stages it depends on, and (as ("file", path)) files it reads.
+        """
+        hasher = hashlib.sha1()
+        hasher.update(json.dumps([VERSION, stage], sort_keys=True))
+        for value in inputs:
+            if isinstance(value, tuple) and value[:1] == ("file",):
+                hasher.update("\0file\0" + _file_hash(value[1]))
+            else:
+                hasher.update("\0" + json.dumps(value, sort_keys=True,
+                                                default=_to_builtin))
+        return hasher.hexdigest()
+
+    def run(self, stage, key, compute, directory=".", outputs=()):
+        """
+        Return a stage's result from the cache, or compute and cache it.
+
+        Args:
+            stage: The stage's name, for the record of what ran.
+            key: The stage's key().
+            compute: A function of no arguments that computes the value and
+                writes the outputs.
+            directory: Where the outputs go.
+            outputs: The filenames, relative to directory, that compute()
+                writes.
+
+        Returns:
+            The value compute() returned, as it comes back from JSON.
+        """
+        manifest_filename = os.path.join(self.cache_dir, key + ".json")
+        manifest = None
+        if os.path.exists(manifest_filename):
+            with open(manifest_filename) as f:
+                manifest = json.load(f)
+            if not all(os.path.exists(self._blob(digest))
+                       for digest in manifest["outputs"].values()):
+                manifest = None
+
+        if manifest is not None:
+            for name, digest in manifest["outputs"].items():
+                path = os.path.join(directory, name)
+                if not (os.path.exists(path) and _file_hash(path) == digest):
+                    shutil.copyfile(self._blob(digest), path)
+            self.reused.append(stage)
+            return manifest["value"]
+
+        with instrument.stage(stage):
+            value = compute()
+        manifest = {"stage": stage,
+                    "value": json.loads(json.dumps(value,
+                                                   default=_to_builtin)),
+                    "outputs": {}}
+        for name in outputs:
+            path = os.path.join(directory, name)
+            digest = _file_hash(path)
+            if not os.path.exists(self._blob(digest)):
+                _write_atomic(self._blob(digest), path)
+            manifest["outputs"][name] = digest
+
+        fd, temp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.rename(temp, manifest_filename)
+
+        self.recomputed.append(stage)
+        return manifest["value"]
+
+    def _blob(self, digest):
+        return os.path.join(self.cache_dir, "files", digest)
+
+
+def _file_hash(path):
+    hasher = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 16), ""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+def _write_atomic(destination, source):
+    """
+    Copy source to destination by way of a temporary file renamed into place.
+    """
+    directory = os.path.dirname(destination)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, temp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    os.close(fd)
+    shutil.copyfile(source, temp)
+    os.rename(temp, destination)
+
+def _to_builtin(value):
+    """
+    json.dump fallback for numpy values: scalars, arrays and poly1d fits.
+    """
+    if isinstance(value, np.poly1d):
+        return value.coeffs.tolist()
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+def _fit(value):
+    """
+    Rebuild reactivity_calc()'s 4-tuple from its cached JSON form.
+    """
+    integral_fit, integral, addition_rate_fit, addition_rate = value
+    return (np.poly1d(integral_fit), [tuple(point) for point in integral],
+            np.poly1d(addition_rate_fit),
+            [tuple(point) for point in addition_rate])
+
+def calibrate(rod_pulls, withdrawal_times, directory=".", typeset_pdf=True,
+              cache_dir=None):
+    """
+    Run the calculation stages of the calibration, as rodcal.calibrate()
+    does, recomputing only the stages whose inputs have changed since the last
+    run into the same directory.
+
+    Args:
+        rod_pulls: [safe, shim, reg], each in the form rodcal.collect_rod()
+            returns.
+        withdrawal_times: List containing the time it takes to pull the [safe,
+            shim, reg] rods all the way out, in seconds.
+        directory: Where to write the plots, tables and report.
+        typeset_pdf: Whether to typeset the tables and report.
+        cache_dir: Where to keep the stage cache; defaults to CACHE_DIRNAME
+            in directory.
+
+    Returns:
+        A dict as rodcal.calibrate() returns, plus the names of the stages
+        that were "recomputed" and those "reused" from the cache.
+    """
+    cache = StageCache(cache_dir or os.path.join(directory, CACHE_DIRNAME))
+    if not os.path.isdir(cache.cache_dir):
+        os.makedirs(cache.cache_dir)
+
+    fit_keys = []
+    fits = []
+    for rod, pulls in zip(RODS, rod_pulls):
+        key = cache.key("fit", pulls)
+        fit = _fit(cache.run("fit-" + rod, key,
+                             lambda pulls=pulls: rodcal.reactivity_calc(
+                                 pulls[0], pulls[1:])))
+        cache.run("plots-" + rod, cache.key("plots", rod, key),
+                  lambda rod=rod, fit=fit: render.render_rod(rod, *fit,
+                                                              directory=
+                                                              directory),
+                  directory,
+                  ["{}-{}.png".format(rod, kind) for kind, _, _ in
+                   render.KINDS])
+        fit_keys.append(key)
+        fits.append(fit)
+
+    [(safe_int, _, safe_add, _), (shim_int, _, shim_add, _),
+     (reg_int, _, reg_add, _)] = fits
+
+    def tables():
+        return rodcal.write_tables(
+            rodcal.tabular_data([safe_int, shim_int, reg_int]), safe_int(0),
+            shim_int(0), reg_int(0),
+            filename=os.path.join(directory, TABLE_FILENAME))
+    cache.run("tables", cache.key("tables", fit_keys,
+                                  ("file", "template-worthtable.tex")),
+              tables, directory, [TABLE_FILENAME])
+
+    specs_key = cache.key("tech specs", fit_keys, withdrawal_times)
+    results = cache.run(
+        "tech specs", specs_key,
+        lambda: rodcal.tech_specs(safe_int, safe_add, shim_int, shim_add,
+                                  reg_int, reg_add, rod_pulls[0][0],
+                                  rod_pulls[1][0], withdrawal_times))
+
+    # write_report() formats the values in place, so give it a copy
+    cache.run("report", cache.key("report", specs_key,
+                                  ("file", "template-report.tex")),
+              lambda: rodcal.write_report(
+                  dict(results),
+                  filename=os.path.join(directory, REPORT_FILENAME)),
+              directory, [REPORT_FILENAME])
+
+    table_filename = os.path.join(directory, TABLE_FILENAME)
+    report_filename = os.path.join(directory, REPORT_FILENAME)
+    if typeset_pdf:
+        with instrument.stage("typesetting"):
+            table_filename, report_filename = typesetting.typeset_all(
+                [(table_filename, "template-worthtable.tex", ()),
+                 (report_filename, "template-report.tex", rodcal.PLOTS)])
+
+    return {"fits": fits,
+            "tech_specs": results,
+            "table_filename": table_filename,
+            "report_filename": report_filename,
+            "recomputed": cache.recomputed,
+            "reused": cache.reused}
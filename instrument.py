@@ -0,0 +1,158 @@
+# Per-stage timing and profiling
+#
+# Wrap a stage of the pipeline in stage() to record how long it took and how
+# much memory it used:
+#
+#     with instrument.stage("plotting"):
+#         ...
+#
+# Tracing is off unless turned on, by configure() (the --trace and --profile
+# options of rodcal.py and batch.py) or the environment:
+#
+#     RODCAL_TRACE=trace.jsonl    append one JSON object per stage to this file
+#                                 ("-" for standard error)
+#     RODCAL_PROFILE=profiles/    also write a cProfile dump for each top-level
+#                                 stage into this directory
+#
+# Each trace line has the stage name, the calibration ID, the start time, the
+# duration in seconds, the resident memory before and after and their
+# difference in bytes, the process ID, and any extra fields given to stage().
+# Worker processes inherit the settings, so their stages land in the same
+# trace.
+
+import contextlib
+import cProfile
+import json
+import os
+import re
+import resource
+import sys
+import threading
+import time
+
+_settings = {"trace": os.environ.get("RODCAL_TRACE") or None,
+             "profile": os.environ.get("RODCAL_PROFILE") or None,
+             "calibration": None}
+_lock = threading.Lock()
+_local = threading.local()
+_counter = [0]
+
+
+def configure(trace=None, profile=None):
+    """
+    Turn tracing on. Settings left as None keep their current values (from
+    the environment, if set there).
+
+    Args:
+        trace: The file to append trace lines to, or "-" for standard error.
+        profile: A directory to write per-stage cProfile dumps into.
+    """
+    if trace is not None:
+        _settings["trace"] = trace
+        os.environ["RODCAL_TRACE"] = trace
+    if profile is not None:
+        _settings["profile"] = profile
+        os.environ["RODCAL_PROFILE"] = profile
+
+def set_calibration(calibration_id):
+    """
+    Set the calibration ID recorded with each stage from now on.
+    """
+    _settings["calibration"] = calibration_id
+
+def enabled():
+    return bool(_settings["trace"] or _settings["profile"])
+
+def _rss():
+    """
+    The current resident set size in bytes, or the peak if the current size
+    isn't available on this platform.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on OS X
+        return peak if sys.platform == "darwin" else peak * 1024
+
+@contextlib.contextmanager
+def stage(name, **fields):
+    """
+    Time a stage of the pipeline, when tracing is on; otherwise do nothing.
+
+    Args:
+        name: The stage name, e.g. "plotting" or "pdflatex".
+        fields: Extra values to record, e.g. the file a stage writes.
+    """
+    if not enabled():
+        yield
+        return
+
+    depth = getattr(_local, "depth", 0)
+    _local.depth = depth + 1
+    profiler = None
+    if _settings["profile"] and depth == 0:
+        profiler = cProfile.Profile()
+
+    rss_before = _rss()
+    start = time.time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+        duration = time.time() - start
+        rss_after = _rss()
+        _local.depth = depth
+
+        record = {"stage": name,
+                  "calibration": _settings["calibration"],
+                  "start": start,
+                  "duration": duration,
+                  "rss_before": rss_before,
+                  "rss_after": rss_after,
+                  "memory_delta": rss_after - rss_before,
+                  "pid": os.getpid(),
+                  "depth": depth}
+        record.update(fields)
+        if profiler:
+            record["profile"] = _dump_profile(profiler, name)
+        _write(record)
+
+def _dump_profile(profiler, name):
+    """
+    Write a cProfile dump for a stage.
+
+    Returns:
+        The dump's filename.
+    """
+    directory = _settings["profile"]
+    with _lock:
+        _counter[0] += 1
+        number = _counter[0]
+    filename = os.path.join(directory, "{}-{}-{}-{}.prof".format(
+        re.sub(r"[^\w.-]", "_", str(_settings["calibration"] or "run")),
+        os.getpid(), number, re.sub(r"[^\w.-]", "_", name)))
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass  # another process made it first
+    profiler.dump_stats(filename)
+    return filename
+
+def _write(record):
+    if not _settings["trace"]:
+        return
+    line = json.dumps(record, sort_keys=True) + "\n"
+    with _lock:
+        if _settings["trace"] == "-":
+            sys.stderr.write(line)
+        else:
+            # One write per line in append mode, so lines from several
+            # processes don't interleave
+            with open(_settings["trace"], "a") as f:
+                f.write(line)
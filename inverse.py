@@ -0,0 +1,402 @@
+# Inverse rod worth queries: reactivity -> rod height
+#
+# The fits from reactivity_calc() give worth as a function of height. Going the
+# other way means solving a cubic, which np.roots does one query at a time. A
+# MonotoneIndex tabulates the fit once on a dense grid, after checking that it
+# is monotone there so the inverse is unique, and answers any number of
+# queries at once by interpolating in the table and polishing the result with
+# one Newton step. Least-squares cubics usually turn over inside the range
+# asked for (rod worth fits at around 92-95%, and the reg rod's near the
+# bottom too), so by default the index covers the longest monotone stretch of
+# it, between turning points, and says which that is.
+#
+# Error bound: with a grid spacing of h, linear interpolation of the inverse
+# is off in height by at most
+#     e0 = h^2 * max|f'|^2 * max|f''| / (8 * min|f'|^3)
+# and the Newton step reduces that to at most
+#     e1 = max|f''| * e0^2 / (2 * min|f'|)
+# where the maxima and minima are over the stretch the answer is in. Near a
+# turning point min|f'| goes to zero and the bound with it to infinity, so
+# MonotoneIndex works it out only over the stretch around the steepest point
+# where |f'| is at least BOUND_SLOPE of its steepest ([bound_lo, bound_hi]):
+# error_bound holds for answers there, and error_bounds() gives it per
+# target, inf for the rest. For typical rod worth cubics on the default
+# 4097-point grid that stretch runs from the bottom of the calibration to
+# about 90-92%, with a bound of at most about 2e-4 % (the reg rod's) to 2e-6
+# % (the safe and shim rods'). In practice answers agree with np.roots to
+# around 1e-7 % all the way up to the turning point.
+#
+# The same index inverts the rod bank fits: rodbank.rod_height() gives the
+# banked height for a core excess and power, and an ExcessQuery gives the
+# core excess a logged banked height implies at its power, for a whole log at
+# once, flagging samples outside the range the fits were made over. Usage:
+#
+#     python inverse.py records.json log.csv [--columns 0,1,2] [-o out.csv]
+#
+# The log has time, banked height in % and power in kW in the given columns;
+# the record's bank data gives the fits. The output adds each sample's
+# implied core excess, xenon worth (the xenon-free core excess less the
+# implied one) and whether it is outside the fitted range.
+
+import argparse
+import sys
+
+import numpy as np
+
+import fitmodels
+
+# Output rows formatted at once by main()
+ROWS = 4096
+# Where the error bound is worked out: |f'| at least this much of its largest
+BOUND_SLOPE = 0.05
+
+
+class MonotoneIndex(object):
+    """
+    The inverse of a function that is monotone on an interval, tabulated for
+    fast vectorized lookups.
+
+    Attributes:
+        lo, hi: The interval the index covers: the one asked for, or the
+            longest monotone stretch of it.
+        y_min, y_max: The range of function values it can invert.
+        bound_lo, bound_hi: The stretch of [lo, hi] the error bound is
+            worked out over (see BOUND_SLOPE).
+        error_bound: The largest error in x of invert() for answers in
+            [bound_lo, bound_hi], from the bound above.
+    """
+    def __init__(self, poly, lo, hi, points=4097, strict=False):
+        """
+        Args:
+            poly: The function, as a np.poly1d.
+            lo, hi: The interval to index.
+            points: The number of grid points.
+            strict: Refuse to index a function that turns inside [lo, hi],
+                rather than indexing the longest stretch between its turning
+                points.
+
+        Raises:
+            ValueError: The function isn't strictly monotone on [lo, hi] (or,
+                unless strict, on any stretch of it), or isn't a polynomial.
+        """
+        # Other curves from fitmodels.py have their own inverse()
+        self.poly = fitmodels.polynomial(poly, "MonotoneIndex")
+        self.deriv = self.poly.deriv()
+        self.lo = float(lo)
+        self.hi = float(hi)
+
+        # A turning point strictly inside the interval makes the inverse
+        # ambiguous. (One at an end, like a rod worth curve flattening out at
+        # the top, is fine.)
+        turning = sorted(r.real for r in np.atleast_1d(self.deriv.r)
+                         if abs(r.imag) < 1e-12 and self.lo < r.real < self.hi)
+        if turning and not strict:
+            ends = [self.lo] + turning + [self.hi]
+            self.lo, self.hi = max(zip(ends[:-1], ends[1:]),
+                                   key=lambda pair: pair[1] - pair[0])
+            turning = []
+        x = np.linspace(self.lo, self.hi, points)
+        y = self.poly(x)
+        steps = np.diff(y)
+        if turning or not (np.all(steps > 0) or np.all(steps < 0)):
+            raise ValueError(
+                "{} is not monotone on [{}, {}]; it turns at {}".format(
+                    self.poly, self.lo, self.hi,
+                    ", ".join("{:.3f}".format(r) for r in turning) or
+                    "a point between grid points"))
+
+        # np.interp wants the values it looks up in increasing order
+        if steps[0] < 0:
+            x, y = x[::-1], y[::-1]
+        self._x = x
+        self._y = y
+        self.y_min = y[0]
+        self.y_max = y[-1]
+
+        # The bound is over the stretch around the steepest point where the
+        # slope stays above BOUND_SLOPE of it, and the grid cells at its ends
+        slope = np.abs(self.deriv(x))
+        curvature = np.abs(self.deriv.deriv()(x))
+        peak = slope.argmax()
+        shallow = np.flatnonzero(slope < BOUND_SLOPE * slope[peak])
+        before = shallow[shallow < peak]
+        after = shallow[shallow > peak]
+        first = before[-1] + 1 if len(before) else 0
+        last = after[0] - 1 if len(after) else len(x) - 1
+        self.bound_lo, self.bound_hi = sorted([x[first], x[last]])
+        self._bound_y = (y[first], y[last])
+        cells = slice(max(first - 1, 0), last + 2)
+        h = (self.hi - self.lo) / (points - 1)
+        min_slope = slope[cells].min()
+        interpolation = (h ** 2 * slope[cells].max() ** 2 *
+                         curvature[cells].max() / (8 * min_slope ** 3))
+        self.error_bound = (curvature[cells].max() * interpolation ** 2 /
+                            (2 * min_slope))
+
+    def invert(self, y):
+        """
+        Find x in [lo, hi] where the function equals y, for many y at once.
+
+        Args:
+            y: Target values, scalar or array.
+
+        Returns:
+            An array of x with the same shape as y. Targets outside
+            [y_min, y_max] give NaN.
+        """
+        y = np.asarray(y, dtype=float)
+        x = np.interp(y, self._y, self._x)
+
+        # One Newton step; the interpolated x is already close enough for it
+        # to converge quadratically.
+        slope = self.deriv(x)
+        x = x - (self.poly(x) - y) / np.where(slope == 0, np.inf, slope)
+        x = np.clip(x, self.lo, self.hi)
+
+        return np.where((y < self.y_min) | (y > self.y_max), np.nan, x)
+
+    def error_bounds(self, y):
+        """
+        The error bound on invert() for each target.
+
+        Args:
+            y: Target values, scalar or array.
+
+        Returns:
+            An array with the same shape as y: error_bound where the answer is
+            in [bound_lo, bound_hi], inf elsewhere in [lo, hi], and NaN for
+            targets outside [y_min, y_max].
+        """
+        y = np.asarray(y, dtype=float)
+        bounded = (y >= self._bound_y[0]) & (y <= self._bound_y[1])
+        return np.where((y < self.y_min) | (y > self.y_max), np.nan,
+                        np.where(bounded, self.error_bound, np.inf))
+
+    def invert_exact(self, y):
+        """
+        Find x in [lo, hi] where the function equals y by solving for the
+        roots, one target at a time. Slow; for checking invert().
+
+        Args:
+            y: Target values, scalar or array.
+
+        Returns:
+            An array of x with the same shape as y, NaN where there is no root
+            in [lo, hi].
+        """
+        y = np.asarray(y, dtype=float)
+        result = np.empty(y.shape)
+        for i, target in np.ndenumerate(y):
+            roots = [r.real for r in np.atleast_1d((self.poly - target).r)
+                     if abs(r.imag) < 1e-9 and
+                     self.lo - 1e-9 <= r.real <= self.hi + 1e-9]
+            result[i] = roots[0] if roots else np.nan
+        return result
+
+
+class WorthQuery(object):
+    """
+    Inverse queries on one rod's integral worth fit. The integral worth at a
+    height is the worth still to be withdrawn above it, so it falls from the
+    rod's total worth at the bottom to zero at the top.
+
+        query = WorthQuery(safe_int, lo=47.3)
+        query.height_for_worth([1.00, 0.50])         # $1.00 and $0.50 left
+        query.height_for_insertion(60.0, 0.25)       # pull from 60% for $0.25
+
+    A cubic fit usually turns over a few % short of the top; the query then
+    covers heights up to there, query.index.hi, and gives NaN above it.
+    """
+    def __init__(self, integral_fit, lo=0.0, hi=100.0, points=4097):
+        """
+        Args:
+            integral_fit: The integral rod worth fit from reactivity_calc(), as
+                a np.poly1d.
+            lo, hi: The heights to cover, in %. Cubic fits often turn over
+                below the calibrated range, so start from the bottom of the
+                calibration. Only the longest monotone stretch of [lo, hi]
+                is covered (see MonotoneIndex).
+            points: The number of grid points in the index.
+
+        Raises:
+            ValueError: The fit isn't monotone on any stretch of [lo, hi].
+        """
+        self.index = MonotoneIndex(integral_fit, lo, hi, points)
+        self.fit = self.index.poly
+        self.error_bound = self.index.error_bound
+
+    def height_for_worth(self, worth):
+        """
+        The heights at which the given worths remain to be withdrawn.
+
+        Args:
+            worth: Remaining worth in dollars, scalar or array.
+
+        Returns:
+            Heights in %, NaN where the worth is out of range.
+        """
+        return self.index.invert(worth)
+
+    def height_for_insertion(self, start, reactivity):
+        """
+        The heights to withdraw to from start to insert the given reactivity.
+
+        Args:
+            start: The starting height in %, scalar or array.
+            reactivity: The reactivity to insert, in dollars, scalar or array.
+                start and reactivity broadcast together.
+
+        Returns:
+            Heights in %, NaN where start is outside the covered heights or
+            the insertion would run past them.
+        """
+        return self.index.invert(self.worth(start) -
+                                 np.asarray(reactivity, dtype=float))
+
+    def worth(self, height):
+        """
+        The forward direction, for convenience: remaining worth at heights,
+        NaN outside the covered heights.
+        """
+        height = np.asarray(height, dtype=float)
+        return np.where((height < self.index.lo) | (height > self.index.hi),
+                        np.nan, self.fit(height))
+
+
+class ExcessQuery(object):
+    """
+    The inverse of rodbank.rod_height(): the five-watt core excess implied by
+    banked rod heights observed at powers, e.g. from a day of logged data.
+
+        query = ExcessQuery.from_banks(rod_banks)
+        excess, outside = query.excess(heights, powers)
+        xenon = query.xenon_free - excess
+
+    hvsrho() maps the core excess at power, rhovsp(power) - rhovsp(0) more
+    than the five-watt core excess, to the banked height. Its inverse comes
+    from a MonotoneIndex, so each sample is an interpolation and a Newton
+    step, not a root solve.
+    """
+    def __init__(self, hvsrho, rhovsp, excess_range, power_range,
+                 xenon_free=None, points=4097):
+        """
+        Args:
+            hvsrho: The output of rodbank.rod_height_vs_core_excess, as a
+                np.poly1d.
+            rhovsp: The output of rodbank.core_excess_vs_power.
+            excess_range: The (lowest, highest) core excess at power that
+                hvsrho was fitted over, in dollars; heights outside what it
+                gives there are outside the fitted range.
+            power_range: The (lowest, highest) power rhovsp was fitted over,
+                in kW.
+            xenon_free: The measured five-watt core excess without xenon, for
+                working out xenon worth.
+            points: The number of grid points in the index.
+
+        Raises:
+            ValueError: hvsrho isn't monotone on any stretch of
+                excess_range, or a fit isn't a polynomial.
+        """
+        self.index = MonotoneIndex(hvsrho, excess_range[0], excess_range[1],
+                                   points)
+        self.rhovsp = fitmodels.polynomial(rhovsp, "ExcessQuery")
+        self.power_range = (float(power_range[0]), float(power_range[1]))
+        self.xenon_free = xenon_free
+        self.height_range = (self.index.y_min, self.index.y_max)
+        self.error_bound = self.index.error_bound
+        # rhovsp(power) - rhovsp(0)
+        self._power_excess = self.rhovsp - self.rhovsp(0)
+
+    @classmethod
+    def from_banks(cls, rod_banks, points=4097):
+        """
+        Fit rod bank data as rodbank.py does and index the fits over the
+        ranges the data cover.
+
+        Args:
+            rod_banks: A list of (power in kW, banked height in %, core
+                excess in $), the first at (near) zero power, without xenon.
+        """
+        import rodbank
+        powers = [bank[0] for bank in rod_banks]
+        excesses = [bank[2] for bank in rod_banks]
+        return cls(rodbank.rod_height_vs_core_excess(rod_banks),
+                   rodbank.core_excess_vs_power(rod_banks),
+                   (min(excesses), max(excesses)), (min(powers), max(powers)),
+                   rod_banks[0][2], points)
+
+    def excess(self, height, power):
+        """
+        The five-watt core excess implied by each banked height at its power.
+
+        Args:
+            height: Banked rod heights in %, scalar or array.
+            power: The powers they were observed at, in kW; broadcast against
+                height.
+
+        Returns:
+            (excess, outside): the core excesses in dollars, NaN where the
+            height is beyond what the fit gives over its range, and whether
+            each sample is outside the fitted range of heights or powers.
+        """
+        height = np.asarray(height, dtype=float)
+        power = np.asarray(power, dtype=float)
+        excess = self.index.invert(height) - self._power_excess(power)
+        outside = (np.isnan(excess) | (power < self.power_range[0]) |
+                   (power > self.power_range[1]))
+        return excess, outside
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Infer core excess and xenon from logged banked rod "
+                    "heights and powers.")
+    parser.add_argument("records",
+                        help="a JSON or CSV record file (as for batch.py); "
+                             "the first record with bank data gives the fits")
+    parser.add_argument("log",
+                        help="CSV log of time, banked height (%%) and power "
+                             "(kW), optionally after a header line")
+    parser.add_argument("--columns", default="0,1,2",
+                        help="the time, height and power columns (default: "
+                             "0,1,2)")
+    parser.add_argument("-o", "--output",
+                        help="write the results as CSV here (default: "
+                             "standard output)")
+    args = parser.parse_args()
+
+    import batch
+    import periodlog
+    banks = [record["banks"] for record in batch.load_records(args.records)
+             if record.get("banks")]
+    if not banks:
+        parser.error("no record in {} has bank data".format(args.records))
+    query = ExcessQuery.from_banks([tuple(bank) for bank in banks[0]])
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    samples = flagged = 0
+    try:
+        out.write("time,height,power,excess,xenon,outside\n")
+        columns = [int(column) for column in args.columns.split(",")]
+        for times, heights, powers in periodlog.read_csv(args.log, columns):
+            excess, outside = query.excess(heights, powers)
+            rows = np.column_stack([times, heights, powers, excess,
+                                    query.xenon_free - excess, outside])
+            # A block of rows per % operation, as texwriter.py does
+            for start in xrange(0, len(rows), ROWS):
+                block = rows[start:start + ROWS]
+                out.write(("%.6g,%.4f,%.6g,%.5f,%.5f,%d\n" * len(block)) %
+                          tuple(block.ravel()))
+            samples += len(times)
+            flagged += outside.sum()
+    finally:
+        if args.output:
+            out.close()
+    sys.stderr.write("{} samples, {} outside the fitted range (heights "
+                     "{:.1f}-{:.1f}%, powers {:g}-{:g} kW)\n".format(
+                         samples, flagged, query.height_range[0],
+                         query.height_range[1], query.power_range[0],
+                         query.power_range[1]))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+# Point kinetics, to cross-check measured periods
+#
+# Solves the six-group point kinetics equations, with the same delayed
+# neutron data (a nucdata.DataSet) as the inhour equation, for a step
+# insertion of reactivity from a critical reactor. The equations are linear with constant
+# coefficients once the rod stops, so rather than stepping them through time
+# each pull's 7x7 kinetics matrix is diagonalized (all the pulls of all the
+# rods at once, as one stack of matrices) and the power at any time is a sum
+# of seven exponentials. The largest eigenvalue is the inverse of the stable
+# period.
+#
+# check() simulates each pull with the reactivity the fitted integral worth
+# curve gives it, and flags pulls whose measured period is far from the
+# simulated one: a misread period, or a height entered wrong, stands out from
+# the smooth curve through its neighbours. A cubic can't follow the ends of
+# the S-curve closely, so short pulls near the ends miss it by a few cents
+# even when read correctly; pulls are only flagged if their reactivity is off
+# by more than FLOOR as well. It also reports how far a period
+# read over the measurement window would be from the stable period, for
+# pulls too short for the delayed neutron transients to die away. Usage:
+#
+#     python kinetics.py records.json [--tolerance 0.25] [--floor 0.05]
+#                                     [--data-sets FILE [--data-set NAME]]
+
+import argparse
+
+import numpy as np
+
+import nucdata
+import rodcal
+
+RODS = ["safe", "shim", "reg"]
+
+# Relative difference between measured and simulated periods to flag
+TOLERANCE = 0.25
+# ... as long as the reactivities differ by more than this, in dollars
+FLOOR = 0.05
+# The period is read over this window, in seconds after the pull
+SETTLE = 30.0
+WINDOW = 60.0
+
+
+def kinetics_matrix(reactivity, data=None):
+    """
+    The point kinetics matrix for the state [power, precursor groups], in
+    the units of data.kernel(): reactivity in dollars, and precursors
+    scaled by beta_eff.
+
+    Args:
+        reactivity: Reactivity in dollars, a scalar or an array of any shape.
+        data: The delayed neutron data; defaults to nucdata.DEFAULT.
+
+    Returns:
+        The matrices, shape reactivity.shape + (groups + 1, groups + 1).
+    """
+    prompt, fractions, decays = (data or nucdata.DEFAULT).kernel()
+    rho = np.asarray(reactivity, dtype=float)
+    fractions = np.asarray(fractions)
+    decays = np.asarray(decays)
+    size = len(decays) + 1
+
+    matrix = np.zeros(rho.shape + (size, size))
+    matrix[..., 0, 0] = (rho - fractions.sum()) / prompt
+    matrix[..., 0, 1:] = decays
+    matrix[..., 1:, 0] = fractions / prompt
+    groups = np.arange(1, size)
+    matrix[..., groups, groups] = -decays
+    return matrix
+
+def modes(reactivity, data=None):
+    """
+    Decompose the power following a step insertion from critical, at unit
+    power with the precursors in equilibrium, into exponentials: the power at
+    time t is sum(amplitudes * exp(rates * t)).
+
+    Args:
+        reactivity: Reactivity in dollars, a scalar or an array of any shape.
+        data: The delayed neutron data; defaults to nucdata.DEFAULT.
+
+    Returns:
+        (rates, amplitudes), each shape reactivity.shape + (groups + 1,),
+        rates in 1/s in decreasing order.
+    """
+    matrix = kinetics_matrix(reactivity, data)
+    rates, vectors = np.linalg.eig(matrix)
+    # The roots of the inhour equation are all real
+    rates = rates.real
+    vectors = vectors.real
+
+    prompt, fractions, decays = (data or nucdata.DEFAULT).kernel()
+    initial = np.concatenate(([1.0], np.asarray(fractions) /
+                              (prompt * np.asarray(decays))))
+    initial = np.broadcast_to(initial, matrix.shape[:-1])
+    weights = np.linalg.solve(vectors, initial[..., np.newaxis])[..., 0]
+    amplitudes = vectors[..., 0, :] * weights
+
+    order = np.argsort(-rates, axis=-1)
+    return (np.take_along_axis(rates, order, axis=-1),
+            np.take_along_axis(amplitudes, order, axis=-1))
+
+def stable_period(reactivity, data=None):
+    """
+    The stable period, in seconds, following a step insertion: the inverse
+    of the inhour equation. Negative for negative reactivity.
+    """
+    rates, _ = modes(reactivity, data)
+    with np.errstate(divide="ignore"):
+        return 1.0 / rates[..., 0]
+
+def power(reactivity, times, data=None):
+    """
+    The power following a step insertion from critical, relative to the
+    power before it.
+
+    Args:
+        reactivity: Reactivity in dollars, shape S.
+        times: Seconds after the insertion, shape (T,).
+        data: The delayed neutron data; defaults to nucdata.DEFAULT.
+
+    Returns:
+        The power at each time, shape S + (T,).
+    """
+    rates, amplitudes = modes(reactivity, data)
+    times = np.asarray(times, dtype=float)
+    return np.einsum("...j,...jt->...t", amplitudes,
+                     np.exp(rates[..., np.newaxis] * times))
+
+def apparent_period(reactivity, settle=SETTLE, window=WINDOW, data=None):
+    """
+    The period that would be read from the power over a window after a step
+    insertion, before the transients have entirely died away.
+
+    Args:
+        reactivity: Reactivity in dollars, a scalar or an array of any shape.
+        settle: When the window starts, in seconds after the insertion.
+        window: The window's length, in seconds.
+        data: The delayed neutron data; defaults to nucdata.DEFAULT.
+
+    Returns:
+        The apparent period in seconds, shaped like reactivity.
+    """
+    trace = power(reactivity, [settle, settle + window], data)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return window / np.log(trace[..., 1] / trace[..., 0])
+
+def check(rod_pulls, tolerance=TOLERANCE, floor=FLOOR, settle=SETTLE,
+          window=WINDOW, data=None):
+    """
+    Cross-check every pull of a calibration against the point kinetics
+    simulation of the reactivity the fitted integral worth gives it.
+
+    Args:
+        rod_pulls: [safe, shim, reg], each in the form rodcal.collect_rod()
+            returns.
+        tolerance: The relative difference between measured and simulated
+            periods to flag.
+        floor: The least difference between the measured and fitted
+            reactivities, in dollars, to flag.
+        settle, window: The window the period is read over, as for
+            apparent_period().
+        data: The delayed neutron data for the inhour equation and the
+            simulation alike; defaults to nucdata.DEFAULT.
+
+    Returns:
+        A list with a dict for each pull: the "rod", its "pull" number from
+        1, the "start" and "end" heights, the "measured" period and the
+        "reactivity" the inhour equation gives it, the "fitted" reactivity
+        and the "simulated" stable period, the "difference" between the
+        measured and simulated periods relative to the measured one, the
+        "transient" relative difference between the apparent and stable
+        periods for the measured reactivity, and whether it's "flagged".
+    """
+    rods, numbers, starts, ends, periods, fitted = [], [], [], [], [], []
+    for rod, pulls in zip(RODS, rod_pulls):
+        integral_fit = rodcal.reactivity_calc(pulls[0], pulls[1:],
+                                              data=data)[0]
+        heights = [pulls[0]] + [height for height, _ in pulls[1:]]
+        for number in xrange(1, len(pulls)):
+            rods.append(rod)
+            numbers.append(number)
+            starts.append(heights[number - 1])
+            ends.append(heights[number])
+            periods.append(pulls[number][1])
+            fitted.append(integral_fit(heights[number - 1]) -
+                          integral_fit(heights[number]))
+
+    periods = np.array(periods)
+    reactivity = rodcal.inhour(periods, data)
+    fitted = np.array(fitted)
+    simulated = stable_period(fitted, data)
+    apparent = apparent_period(reactivity, settle, window, data)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        difference = (simulated - periods) / periods
+        transient = (apparent - periods) / periods
+    # A fitted reactivity that isn't positive gives no rising period at all
+    flagged = ((~(np.abs(difference) <= tolerance) | (simulated <= 0)) &
+               (np.abs(fitted - reactivity) > floor))
+
+    return [{"rod": rods[i], "pull": numbers[i], "start": starts[i],
+             "end": ends[i], "measured": periods[i],
+             "reactivity": reactivity[i], "fitted": fitted[i],
+             "simulated": simulated[i], "difference": difference[i],
+             "transient": transient[i], "flagged": bool(flagged[i])}
+            for i in xrange(len(periods))]
+
+def main():
+    import batch
+
+    parser = argparse.ArgumentParser(
+        description="Cross-check measured periods against point kinetics.")
+    parser.add_argument("files", nargs="+",
+                        help="JSON or CSV files of calibration records, as "
+                             "for batch.py")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE,
+                        help="relative period difference to flag "
+                             "(default: {})".format(TOLERANCE))
+    parser.add_argument("--floor", type=float, default=FLOOR,
+                        help="reactivity difference in dollars below which "
+                             "pulls aren't flagged (default: {})"
+                             .format(FLOOR))
+    parser.add_argument("--settle", type=float, default=SETTLE,
+                        help="start of the period measurement, in seconds "
+                             "after the pull (default: {:g})".format(SETTLE))
+    parser.add_argument("--window", type=float, default=WINDOW,
+                        help="length of the period measurement, in seconds "
+                             "(default: {:g})".format(WINDOW))
+    parser.add_argument("--all", action="store_true",
+                        help="list every pull, not only the flagged ones")
+    parser.add_argument("--data-sets", metavar="FILE",
+                        help="a JSON list of delayed neutron data sets (see "
+                             "nucdata.py) to use in place of the default")
+    parser.add_argument("--data-set", metavar="NAME",
+                        help="which of them to use (default: the first)")
+    args = parser.parse_args()
+
+    data = None
+    if args.data_sets:
+        data_sets = nucdata.load(args.data_sets)
+        if args.data_set is not None:
+            data_sets = [data_set for data_set in data_sets
+                         if data_set.name == args.data_set]
+        if not data_sets:
+            parser.error("no data set {!r} in {}".format(args.data_set,
+                                                         args.data_sets))
+        data = data_sets[0]
+
+    for filename in args.files:
+        for record in batch.load_records(filename):
+            pulls = check(batch.rod_pulls(record), args.tolerance,
+                          args.floor, args.settle, args.window, data)
+            flagged = sum(pull["flagged"] for pull in pulls)
+            print "{}: {} of {} pulls flagged".format(record["id"], flagged,
+                                                      len(pulls))
+            for pull in pulls:
+                if not (args.all or pull["flagged"]):
+                    continue
+                print ("  {flag} {rod:<4} {pull:2d} {start:5.1f}-{end:5.1f}%"
+                       "  measured {measured:8.2f} s  simulated "
+                       "{simulated:8.2f} s ({difference:+.0%})  window "
+                       "{transient:+.1%}").format(
+                           flag="!" if pull["flagged"] else " ", **pull)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+# Deferred imports
+#
+# numpy and matplotlib take far longer to import than the rest of the program
+# takes to start, and the console tools don't need them until data entry is
+# done (rodbank never needs matplotlib at all). A LazyModule stands in for a
+# module and imports it the first time one of its attributes is used.
+
+import importlib
+
+
+class LazyModule(object):
+    """
+    A placeholder for a module that is imported on first attribute access:
+
+        np = LazyModule("numpy")    # nothing imported yet
+        np.arange(10)               # numpy is imported here
+    """
+    def __init__(self, name):
+        """
+        Args:
+            name: The full name of the module, e.g. "matplotlib.pyplot".
+        """
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is None:
+            module = importlib.import_module(self.__dict__["_name"])
+            self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        if self.__dict__["_module"] is None:
+            return "<lazy module {!r} (not loaded)>".format(
+                self.__dict__["_name"])
+        return repr(self.__dict__["_module"])
@@ -0,0 +1,402 @@
+# Delayed neutron data sets
+#
+# The point-kinetics parameters the inhour equation turns stable periods into
+# reactivity with: each delayed neutron group's half-life and fraction, beta
+# effective and the prompt neutron lifetime. rodcal.py uses DEFAULT; any
+# calculation that takes a data set can be rerun under another one (another
+# library, another fuel loading) to see how much the answers depend on it.
+#
+# A sensitivity run reprocesses archived calibrations under each of several
+# data sets, over a pool of worker processes, and collects how much each
+# one's rod worths, margins and peak addition rates move relative to DEFAULT.
+# Usage:
+#
+#     python nucdata.py records.json [--history FILE] [--data-sets sets.json]
+#                       [--perturb beta_eff=0.95,1.05 ...] [-j 8] [-o out.npz]
+#
+# A data sets file is a JSON list of objects with a "name" and any of
+# "t_half", "beta_i", "beta_eff" and "l_p"; what an object leaves out is
+# DEFAULT's. --perturb scales one parameter (all its groups at once, for
+# t_half and beta_i) by each factor given, one data set per factor.
+
+import argparse
+import json
+import math
+import multiprocessing
+
+from lazy import LazyModule
+
+np = LazyModule("numpy")
+
+PARAMETERS = ["t_half", "beta_i", "beta_eff", "l_p"]
+RODS = ["safe", "shim", "reg"]
+
+# The Tech Specs values a sensitivity run compares
+QUANTITIES = ["safeworth", "shimworth", "regworth", "totalworth",
+              "safemaxdps", "shimmaxdps", "regmaxdps", "safecxs", "shimcxs",
+              "safesdm", "shimsdm", "safeosr", "shimosr"]
+
+# data set key -> (prompt term, group fractions, group decay constants), all
+# in dollars, shared by every copy of a data set in this process
+_kernels = {}
+
+
+class DataSet(object):
+    """
+    One set of point-kinetics parameters. Data sets with the same parameters
+    are equal, whatever their names, and share a cached kernel.
+    """
+    def __init__(self, name, t_half, beta_i, beta_eff, l_p):
+        """
+        Args:
+            name: What to call it in output.
+            t_half: Each delayed neutron group's half-life, in seconds.
+            beta_i: Each group's delayed neutron fraction.
+            beta_eff: The effective delayed neutron fraction, which a dollar
+                of reactivity is.
+            l_p: The prompt neutron lifetime, in seconds.
+
+        Raises:
+            ValueError: If there aren't as many fractions as half-lives, or
+                a parameter isn't positive.
+        """
+        self.name = name
+        self.t_half = tuple(float(t) for t in t_half)
+        self.beta_i = tuple(float(beta) for beta in beta_i)
+        self.beta_eff = float(beta_eff)
+        self.l_p = float(l_p)
+        if len(self.t_half) != len(self.beta_i):
+            raise ValueError("{}: {} half-lives but {} group fractions".format(
+                name, len(self.t_half), len(self.beta_i)))
+        if min(self.t_half + self.beta_i + (self.beta_eff, self.l_p)) <= 0:
+            raise ValueError("{}: parameters must be positive".format(name))
+        self.lambda_i = tuple(math.log(2)/t for t in self.t_half)
+        # (fraction, decay constant) per group, for reactivity()
+        self.groups = zip(self.beta_i, self.lambda_i)
+
+    @property
+    def key(self):
+        return (self.t_half, self.beta_i, self.beta_eff, self.l_p)
+
+    def __eq__(self, other):
+        return isinstance(other, DataSet) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "DataSet({!r})".format(self.name)
+
+    def reactivity(self, period):
+        """
+        The six-group (or n-group) inhour equation for one stable period,
+        with the same arithmetic rodcal.reactivity_calc() has always used.
+        An array of periods gets exactly the same arithmetic elementwise.
+
+        Args:
+            period: The stable period in seconds, or an array of them.
+
+        Returns:
+            The reactivity in dollars, with the same shape as period.
+        """
+        reactivity_dkk = (self.l_p/period +
+                          sum(beta / (1.0 + lambda_ * period)
+                              for beta, lambda_ in self.groups))
+        return reactivity_dkk / self.beta_eff
+
+    def inhour(self, period):
+        """
+        The inhour equation for any number of stable periods. Agrees with
+        reactivity() to within rounding.
+
+        Args:
+            period: The stable period in seconds, as a scalar or an array of
+                any shape.
+
+        Returns:
+            The reactivity in dollars, with the same shape as period.
+        """
+        prompt, fractions, decays = self.kernel()
+        period = np.asarray(period, dtype=float)
+        result = prompt / period
+        # One group at a time, into one scratch array, rather than
+        # materializing every group's term at once
+        term = np.empty_like(period)
+        for fraction, decay in zip(fractions, decays):
+            np.multiply(period, decay, out=term)
+            term += 1.0
+            np.divide(fraction, term, out=term)
+            result = result + term
+        return result
+
+    def kernel(self):
+        """
+        The inhour equation's constants with beta_eff divided in, so that
+        reactivity in dollars is prompt/T + sum(fractions/(1 + decays*T)).
+        Computed once per data set.
+
+        Returns:
+            (prompt, fractions, decays).
+        """
+        kernel = _kernels.get(self.key)
+        if kernel is None:
+            kernel = (self.l_p / self.beta_eff,
+                      tuple(beta / self.beta_eff for beta in self.beta_i),
+                      self.lambda_i)
+            _kernels[self.key] = kernel
+        return kernel
+
+    def replace(self, name, **changes):
+        """
+        A copy with some parameters changed, e.g.
+        DEFAULT.replace("low beta", beta_eff=0.0070).
+        """
+        parameters = dict((parameter, getattr(self, parameter))
+                          for parameter in PARAMETERS)
+        for parameter in changes:
+            if parameter not in parameters:
+                raise ValueError("unknown parameter {!r}".format(parameter))
+        parameters.update(changes)
+        return DataSet(name, **parameters)
+
+    def scaled(self, parameter, factor):
+        """
+        A copy with one parameter (every group of it, for t_half and beta_i)
+        multiplied by factor, named for the change.
+        """
+        value = getattr(self, parameter)
+        if isinstance(value, tuple):
+            value = [v * factor for v in value]
+        else:
+            value = value * factor
+        return self.replace("{} x{:g}".format(parameter, factor),
+                            **{parameter: value})
+
+    def to_dict(self):
+        data = {"name": self.name}
+        for parameter in PARAMETERS:
+            value = getattr(self, parameter)
+            data[parameter] = list(value) if isinstance(value, tuple) else value
+        return data
+
+    @classmethod
+    def from_dict(cls, data, base=None):
+        """
+        A data set from a dict of its "name" and parameters, as in a data
+        sets file; parameters it leaves out are base's (DEFAULT's).
+        """
+        return (base or DEFAULT).replace(
+            data.get("name", "unnamed"),
+            **dict((key, value) for key, value in data.items()
+                   if key != "name"))
+
+
+# Values for the six delayed neutron groups - ref. Lamarsh, Table 3.5
+DEFAULT = DataSet("Lamarsh Table 3.5",
+                  t_half=[55.72, 22.72, 6.22, 2.30, 0.610, 0.230],
+                  beta_i=[0.000215, 0.001424, 0.001274, 0.002568, 0.000748,
+                          0.000273],
+                  beta_eff=0.0075,
+                  l_p=0.000108)
+
+
+def load(filename):
+    """
+    Read a data sets file: a JSON list of objects as for DataSet.from_dict().
+
+    Returns:
+        A list of DataSet.
+    """
+    with open(filename) as f:
+        return [DataSet.from_dict(data) for data in json.load(f)]
+
+def evaluate(calibrations, data_sets):
+    """
+    Calibrations' Tech Specs values under each of several data sets. Only
+    the reactivity of each pull depends on the data set, so each rod's fits
+    for every calibration and data set are made in one stacked solve (per
+    number of pulls), and the Tech Specs in one sweep.tech_spec_values().
+
+    Args:
+        calibrations: A list of (rod_pulls, withdrawal_times): [safe, shim,
+            reg], each in the form rodcal.collect_rod() returns, and their
+            withdrawal times in seconds.
+        data_sets: A list of DataSet.
+
+    Returns:
+        An array of the QUANTITIES, shape (calibrations, data sets,
+        QUANTITIES).
+    """
+    import rodcal
+    import sweep
+    count, sets = len(calibrations), len(data_sets)
+    fits = {}
+    for r, rod in enumerate(RODS):
+        int_c = np.empty((count, sets, 4))
+        add_c = np.empty((count, sets, 4))
+        groups = {}
+        for i, (rod_pulls, _) in enumerate(calibrations):
+            groups.setdefault(len(rod_pulls[r]) - 1, []).append(i)
+        for indices in groups.itervalues():
+            bottom = [calibrations[i][0][r][0] for i in indices]
+            pulls = np.array([calibrations[i][0][r][1:] for i in indices],
+                             dtype=float)
+            # One row per (calibration, data set)
+            reactivity = np.array([data.inhour(pulls[..., 1])
+                                   for data in data_sets]).transpose(1, 0, 2)
+            int_fits, _, add_fits, _ = rodcal.reactivity_fits_batch(
+                np.repeat(bottom, sets), np.repeat(pulls[..., 0], sets, axis=0),
+                reactivity.reshape(-1, pulls.shape[1]))
+            int_c[indices] = int_fits.reshape(len(indices), sets, 4)
+            add_c[indices] = add_fits.reshape(len(indices), sets, 4)
+        fits[rod] = (int_c.reshape(-1, 4), add_c.reshape(-1, 4))
+
+    critical = np.repeat([[rod_pulls[0][0], rod_pulls[1][0]]
+                          for rod_pulls, _ in calibrations], sets, axis=0)
+    times = np.repeat([times for _, times in calibrations], sets, axis=0)
+    values = sweep.tech_spec_values(fits, critical[:, 0], critical[:, 1],
+                                    list(times.T))
+    return np.column_stack([values[quantity] for quantity in QUANTITIES]
+                           ).reshape(count, sets, len(QUANTITIES))
+
+def _evaluate_star(args):
+    return evaluate(*args)
+
+def sensitivity(calibrations, data_sets, baseline=DEFAULT, processes=None):
+    """
+    Reprocess every calibration under every data set, in chunks of
+    calibrations over a pool of worker processes, and compare each against
+    the baseline data set.
+
+    Args:
+        calibrations: A list of (rod_pulls, withdrawal_times), as for
+            evaluate().
+        data_sets: A list of DataSet.
+        baseline: The data set the others are compared against.
+        processes: The number of workers; defaults to the number of CPUs. 1
+            runs everything in this process.
+
+    Returns:
+        (values, deltas): arrays of shape (calibrations, data sets,
+        QUANTITIES), the values under each data set and how far each is from
+        the same calibration's value under the baseline.
+    """
+    sets = [baseline] + list(data_sets)
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1 or len(calibrations) < 2:
+        values = evaluate(calibrations, sets)
+    else:
+        # A few chunks per worker, to even out their loads
+        chunk = -(-len(calibrations) // (4 * processes))
+        jobs = [(calibrations[start:start + chunk], sets)
+                for start in xrange(0, len(calibrations), chunk)]
+        pool = multiprocessing.Pool(processes)
+        try:
+            values = np.concatenate(pool.map(_evaluate_star, jobs))
+        finally:
+            pool.close()
+            pool.join()
+    return values[:, 1:], values[:, 1:] - values[:, :1]
+
+def summary(data_sets, deltas):
+    """
+    Describe a sensitivity run: for each data set, the mean and the largest
+    change in each quantity over the calibrations.
+
+    Returns:
+        The summary text.
+    """
+    lines = []
+    for n, data in enumerate(data_sets):
+        lines.append("{} (vs. {}):".format(data.name, DEFAULT.name))
+        for q, quantity in enumerate(QUANTITIES):
+            delta = deltas[:, n, q]
+            worst = delta[np.argmax(np.abs(delta))] if len(delta) else 0.0
+            lines.append("  {:<12} mean {:+9.4f}  largest {:+9.4f}".format(
+                quantity, np.mean(delta) if len(delta) else 0.0, worst))
+    return "\n".join(lines)
+
+def parse_perturbation(text):
+    """
+    Parse a --perturb option, PARAMETER=FACTOR,FACTOR,...
+
+    Returns:
+        A list of DataSet, DEFAULT scaled by each factor.
+
+    Raises:
+        ValueError: If it isn't in that form.
+    """
+    parameter, _, factors = text.partition("=")
+    if parameter not in PARAMETERS or not factors:
+        raise ValueError("expected one of {} and =FACTOR,...; got {!r}"
+                         .format(", ".join(PARAMETERS), text))
+    return [DEFAULT.scaled(parameter, float(factor))
+            for factor in factors.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reprocess calibrations under other delayed neutron data "
+                    "and compare the results.")
+    parser.add_argument("files", nargs="*",
+                        help="JSON or CSV files of calibration records (as "
+                             "for batch.py)")
+    parser.add_argument("--history", metavar="FILE",
+                        help="also reprocess every calibration in this "
+                             "history store (see history.py)")
+    parser.add_argument("--data-sets", metavar="FILE",
+                        help="a JSON list of data sets to compare")
+    parser.add_argument("--perturb", metavar="PARAMETER=FACTORS",
+                        action="append", default=[],
+                        help="compare DEFAULT with one parameter scaled by "
+                             "each factor, e.g. beta_eff=0.95,1.05")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="number of worker processes (default: all CPUs)")
+    parser.add_argument("-o", "--output", metavar="FILE",
+                        help="save the values and deltas as a .npz file")
+    args = parser.parse_args()
+
+    data_sets = load(args.data_sets) if args.data_sets else []
+    try:
+        for text in args.perturb:
+            data_sets.extend(parse_perturbation(text))
+    except ValueError as e:
+        parser.error(str(e))
+    if not data_sets:
+        parser.error("nothing to compare: give --data-sets or --perturb")
+
+    import batch
+    ids = []
+    calibrations = []
+    for filename in args.files:
+        for record in batch.load_records(filename):
+            ids.append(str(record["id"]))
+            calibrations.append((batch.rod_pulls(record),
+                                 record["withdrawal_times"]))
+    if args.history:
+        import history
+        with history.History(args.history) as store:
+            for calibration in store.calibrations():
+                record = store.record(calibration["id"])
+                ids.append(str(record["id"]))
+                calibrations.append((store.rod_pulls(calibration["id"]),
+                                     record["withdrawal_times"]))
+    if not calibrations:
+        parser.error("no calibrations: give record files or --history")
+
+    values, deltas = sensitivity(calibrations, data_sets,
+                                 processes=args.processes)
+    print "{} calibrations x {} data sets".format(len(calibrations),
+                                                  len(data_sets))
+    print summary(data_sets, deltas)
+    if args.output:
+        np.savez(args.output, values=values, deltas=deltas,
+                 quantities=QUANTITIES, calibrations=ids,
+                 data_sets=[data.name for data in data_sets])
+        print "Saved " + args.output
+
+if __name__ == "__main__":
+    main()
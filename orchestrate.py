@@ -0,0 +1,305 @@
+# Concurrent generation of a calibration's outputs
+#
+# Once the rods are fitted, the plots, the worth tables, the report and the
+# rod bank table don't depend on each other, except that the report includes
+# the plots. They run as concurrent tasks: plotting in worker processes,
+# everything else in threads, which mostly wait on pdflatex subprocesses.
+# Each task starts as soon as the tasks it needs are done, so a calibration
+# takes about as long as its slowest chain of tasks (plots, then the report)
+# rather than the sum of them all. Finished PDFs can be opened as soon as
+# they're ready, without waiting for the viewer, and a summary at the end
+# says what succeeded and what didn't.
+#
+# (This is the job asyncio would do, but this code runs on Python 2.)
+
+import multiprocessing
+import multiprocessing.pool
+import threading
+import time
+
+import export
+import instrument
+import render
+import rodbank
+import rodcal
+
+RODS = ["safe", "shim", "reg"]
+
+
+class Task(object):
+    """
+    One unit of work and what became of it: status is "pending", "ok",
+    "failed" or "skipped" (because a task it needed didn't succeed).
+    """
+    def __init__(self, name, func, args, kwargs, after=(), process=False,
+                 then=None):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.after = list(after)
+        self.process = process
+        self.then = then
+
+        self.status = "pending"
+        self.result = None
+        self.error = None
+        # A problem with the follow-up, which doesn't fail the task
+        self.note = None
+        self.start = None
+        self.end = None
+        self.done = threading.Event()
+
+    @property
+    def seconds(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class Orchestrator(object):
+    """
+    Run a set of tasks concurrently, each once the tasks it depends on have
+    succeeded:
+
+        orchestrator = Orchestrator()
+        orchestrator.add("plots", render.render_plots, fits, process=True)
+        orchestrator.add("report", rodcal.tex_report, results,
+                         after=["plots"], then=rodcal.open_file)
+        tasks = orchestrator.run()
+    """
+    def __init__(self, processes=None):
+        """
+        Args:
+            processes: The number of worker processes for process tasks;
+                defaults to one per process task, up to the number of CPUs. 1
+                runs them in this process, one at a time.
+        """
+        self.processes = processes
+        self.tasks = []
+        self._by_name = {}
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def add(self, name, func, *args, **kwargs):
+        """
+        Add a task, to run func(*args, **kwargs).
+
+        Keyword args (not passed to func):
+            after: Names of tasks that must succeed first.
+            process: Whether to run in a worker process, for CPU-bound work.
+                func, its arguments and its result must then be picklable.
+            then: A function to call with the result once the task succeeds,
+                e.g. to open the file it made. Its failure is noted but
+                doesn't fail the task.
+
+        Returns:
+            The Task.
+        """
+        after = kwargs.pop("after", ())
+        process = kwargs.pop("process", False)
+        then = kwargs.pop("then", None)
+        task = Task(name, func, args, kwargs, after, process, then)
+        for dependency in task.after:
+            if dependency not in self._by_name:
+                raise ValueError("{} depends on unknown task {}"
+                                 .format(name, dependency))
+        self.tasks.append(task)
+        self._by_name[name] = task
+        return task
+
+    def run(self):
+        """
+        Run every task and wait for them all to finish.
+
+        Returns:
+            The tasks, in the order they were added.
+        """
+        process_tasks = sum(task.process for task in self.tasks)
+        processes = self.processes or min(process_tasks,
+                                          multiprocessing.cpu_count())
+        if process_tasks and processes > 1:
+            self._pool = multiprocessing.Pool(processes)
+        # A thread per task, so tasks waiting on others can't hold up the
+        # ones they're waiting for
+        threads = multiprocessing.pool.ThreadPool(len(self.tasks) or 1)
+        try:
+            threads.map(self._run, self.tasks)
+        finally:
+            threads.close()
+            threads.join()
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+        return self.tasks
+
+    def _run(self, task):
+        try:
+            for name in task.after:
+                dependency = self._by_name[name]
+                dependency.done.wait()
+                if dependency.status != "ok":
+                    task.status = "skipped"
+                    task.error = "{} {}".format(name, dependency.status)
+                    return
+
+            task.start = time.time()
+            try:
+                with instrument.stage(task.name):
+                    task.result = self._call(task)
+                task.status = "ok"
+            except Exception as e:
+                task.status = "failed"
+                task.error = "{}: {}".format(type(e).__name__, e)
+            task.end = time.time()
+
+            if task.status == "ok" and task.then is not None:
+                try:
+                    task.then(task.result)
+                except Exception as e:
+                    task.note = "{}: {}".format(type(e).__name__, e)
+        finally:
+            task.done.set()
+
+    def _call(self, task):
+        if not task.process:
+            return task.func(*task.args, **task.kwargs)
+        if self._pool is not None:
+            return self._pool.apply(task.func, task.args, task.kwargs)
+        # Process tasks in this process take turns: they aren't written to
+        # share it (e.g. render.py's one figure per process)
+        with self._lock:
+            return task.func(*task.args, **task.kwargs)
+
+
+def summary(tasks, elapsed=None):
+    """
+    Describe how each task went, one line each.
+
+    Args:
+        tasks: The tasks, as returned by Orchestrator.run().
+        elapsed: The total wall time in seconds, to report alongside.
+
+    Returns:
+        The summary text.
+    """
+    failures = sum(task.status != "ok" for task in tasks)
+    if failures:
+        head = "{} of {} tasks did not complete".format(failures, len(tasks))
+    else:
+        head = "All {} tasks completed".format(len(tasks))
+    if elapsed is not None:
+        head += " in {:.1f} s".format(elapsed)
+
+    width = max([len(task.name) for task in tasks] + [0])
+    lines = [head]
+    for task in tasks:
+        line = "  {:<{}}  {:<7}".format(task.name, width, task.status.upper())
+        if task.seconds is not None:
+            line += " {:6.2f} s".format(task.seconds)
+        if task.status == "ok":
+            line += "  " + _describe(task.result)
+        else:
+            line += "  " + str(task.error)
+        if task.note:
+            line += " (follow-up failed: {})".format(task.note)
+        lines.append(line.rstrip())
+    return "\n".join(lines)
+
+def _describe(result):
+    if isinstance(result, basestring):
+        return result
+    if isinstance(result, (list, tuple)):
+        return ", ".join(str(item) for item in result)
+    return ""
+
+def calibrate(rod_pulls, withdrawal_times, directory=".", banks=None,
+              viewer=None, processes=None, filenames=None, exports=(),
+              name=None):
+    """
+    Run a calibration once data entry is done, as rodcal.calibrate() does,
+    but generating the plots, worth tables, report and (with bank data) rod
+    bank table concurrently, and opening each PDF as soon as it's ready.
+
+    Args:
+        rod_pulls: [safe, shim, reg], each in the form rodcal.collect_rod()
+            returns.
+        withdrawal_times: List containing the time it takes to pull the [safe,
+            shim, reg] rods all the way out, in seconds.
+        directory: Where to write everything.
+        banks: Optional rod bank data, as entered into rodbank.main(): a list
+            of (power in kW, banked height in %, core excess in $).
+        viewer: A function to call with each finished PDF's filename, e.g.
+            rodcal.open_file.
+        processes: The number of processes to render the plots with.
+        filenames: The .tex files to write for the "table", "report" and
+            "bank" table, e.g. named by history.History.artifact(); each
+            defaults to the first available in directory.
+        exports: Formats to also write the results in (see export.py),
+            before any of the tasks start.
+        name: What to name the exported files by, as for export.write().
+
+    Returns:
+        (calibration, tasks): a dict as rodcal.calibrate() returns, with None
+        for any filename whose task didn't succeed, and the
+        "export_filenames", and the tasks, for summary().
+    """
+    # Fitting takes milliseconds; everything else waits on it
+    with instrument.stage("reactivity calculation"):
+        fits = [rodcal.reactivity_calc(rod[0], rod[1:]) for rod in rod_pulls]
+    [(safe_int, _, safe_add, _), (shim_int, _, shim_add, _),
+     (reg_int, _, reg_add, _)] = fits
+    results = rodcal.tech_specs(safe_int, safe_add, shim_int, shim_add,
+                                reg_int, reg_add, rod_pulls[0][0],
+                                rod_pulls[1][0], withdrawal_times)
+    worth_tables = rodcal.tabular_data([safe_int, shim_int, reg_int])
+
+    # Milliseconds, so the numbers are out before the first pdflatex starts
+    exported = []
+    if exports:
+        with instrument.stage("export"):
+            exported = export.write(directory, exports, results, worth_tables,
+                                    export.bank_data(banks) if banks else None,
+                                    name)
+
+    filenames = filenames or {}
+    orchestrator = Orchestrator(processes)
+    plots = []
+    for rod, fit in zip(RODS, fits):
+        plots.append("plots-" + rod)
+        orchestrator.add(plots[-1], render.render_rod, rod, *fit,
+                         directory=directory, process=True)
+    tables = orchestrator.add(
+        "worth tables", rodcal.tex_tables, worth_tables, safe_int(0),
+        shim_int(0), reg_int(0), directory, filenames.get("table"),
+        then=viewer)
+    # tex_report() formats the values in place, so give it a copy
+    report = orchestrator.add("report", rodcal.tex_report, dict(results),
+                              directory, filenames.get("report"),
+                              after=plots, then=viewer)
+    if banks:
+        orchestrator.add("bank table", bank_table, banks, directory,
+                         filenames.get("bank"), then=viewer)
+
+    tasks = orchestrator.run()
+    return ({"fits": fits,
+             "tech_specs": results,
+             "table_filename": tables.result,
+             "report_filename": report.result,
+             "export_filenames": exported}, tasks)
+
+def bank_table(banks, directory=".", filename=None):
+    """
+    Generate and typeset the banked rod height table, as rodbank.main() does.
+
+    Args:
+        filename: The .tex file to write, as for rodbank.tex().
+
+    Returns:
+        The filename of the typeset PDF.
+    """
+    hvsrho = rodbank.rod_height_vs_core_excess(banks)
+    rhovsp = rodbank.core_excess_vs_power(banks)
+    return rodbank.tex(banks[0][2], rodbank.table(hvsrho, rhovsp), directory,
+                       filename=filename)
@@ -0,0 +1,416 @@
+# Stable periods from data acquisition power logs
+#
+# Reads a power (or count rate) log in one pass, a chunk at a time, so logs
+# of any size take a bounded amount of memory: binary logs are memory-mapped
+# and CSV logs are read a block of lines at a time. Each chunk is reduced to
+# least-squares sums of log power against time over short blocks of time.
+# Everything after that works on the block sums, which are small: sliding
+# window fits of log power are differences of their cumulative sums, and the
+# fit over any stretch of blocks is the sum of theirs.
+#
+# A pull shows up as a run of windows where the power rises exponentially:
+# significantly, and fitting an exponential as well as the noise allows.
+# The period settles from short to its stable value as the delayed neutron
+# transients die away, so the stable region is the last stretch of the run
+# where the window periods agree, to within a tolerance or their noise; the
+# period is fitted over that whole region. Usage:
+#
+#     python periodlog.py log.csv [--bottom 12.3 --heights 20.1,31.5,...]
+#     python periodlog.py log.bin --dtype f4 [--rate 1000]
+#
+# CSV logs have time in seconds and power in columns (by default the first
+# two), optionally after a header line. Binary logs are flat arrays of
+# (time, power) records of the given dtype, or of power alone with --rate.
+# With the critical height and the height after each pull, the periods go
+# straight into rodcal.reactivity_calc().
+
+import argparse
+
+import numpy as np
+
+import rodcal
+
+# Block length for the sums, in seconds
+BLOCK = 0.5
+# Sliding windows for finding rising power, in seconds: short ones for short
+# periods, long ones to see long periods through the noise
+WINDOWS = (5.0, 15.0, 45.0)
+# The periods that count as a pull, in seconds
+MIN_PERIOD = 1.0
+MAX_PERIOD = 2000.0
+# Least slope of log power, in standard errors, for a window to count as
+# rising
+MIN_SIGNIFICANCE = 20.0
+# Most scatter of log power about a window's fit, as a multiple of the log's
+# noise, for the window to count as exponential
+MAX_SCATTER = 1.2
+# How closely window periods in the stable region must agree, beyond noise
+SETTLE_TOLERANCE = 0.05
+# Shortest stable region to report, in seconds and as a fraction of its
+# period: a short window early in a long pull can see a stretch where the
+# period hasn't yet noticeably changed
+MIN_DURATION = 5.0
+MIN_PERIODS = 0.1
+
+# Records per chunk for binary logs, and bytes per chunk for CSV logs
+CHUNK_RECORDS = 1 << 20
+CHUNK_BYTES = 16 << 20
+
+# The sums kept for each block: n, t, y, t^2, t*y, y^2, with y = ln(power)
+N, T, Y, TT, TY, YY = range(6)
+
+
+class BlockSums(object):
+    """
+    Least-squares sums of log power against time, per block of time,
+    accumulated from chunks of samples in time order.
+    """
+    def __init__(self, block=BLOCK):
+        self.block = block
+        self.origin = None
+        self.chunks = []
+
+    def add(self, times, power):
+        """
+        Add a chunk of samples. Samples with no power (zero or negative
+        counts) are skipped.
+        """
+        times = np.asarray(times, dtype=float)
+        power = np.asarray(power, dtype=float)
+        if self.origin is None and len(times):
+            self.origin = times[0]
+        keep = power > 0
+        t = times[keep] - self.origin
+        if not len(t):
+            return
+        y = np.log(power[keep])
+
+        index = np.floor(t / self.block).astype(np.int64)
+        first = index[0]
+        index -= first
+        length = index[-1] + 1
+        sums = np.empty((length, 6))
+        for column, values in ((N, None), (T, t), (Y, y), (TT, t * t),
+                               (TY, t * y), (YY, y * y)):
+            sums[:, column] = np.bincount(index, values, minlength=length)
+        self.chunks.append((first, sums))
+
+    def result(self):
+        """
+        Returns:
+            An array of the sums for every block, shape (blocks, 6); blocks
+            with no samples are all zeros.
+        """
+        if not self.chunks:
+            return np.zeros((0, 6))
+        length = max(first + len(sums) for first, sums in self.chunks)
+        total = np.zeros((length, 6))
+        for first, sums in self.chunks:
+            # A block split between chunks gets both parts
+            total[first:first + len(sums)] += sums
+        return total
+
+
+def read_binary(filename, dtype="f8", rate=None, chunk=CHUNK_RECORDS):
+    """
+    Memory-map a binary log and yield it a chunk at a time.
+
+    Args:
+        filename: A flat array of (time, power) records, or of power alone
+            if rate is given.
+        dtype: The numpy dtype of each value, e.g. "f4" or "<f8".
+        rate: Samples per second for a log of power alone, which starts at
+            time 0.
+        chunk: Records per chunk.
+
+    Yields:
+        (times, power) arrays.
+    """
+    data = np.memmap(filename, dtype=dtype, mode="r")
+    if rate is None:
+        data = data[:len(data) // 2 * 2].reshape(-1, 2)
+    for start in xrange(0, len(data), chunk):
+        block = np.array(data[start:start + chunk], dtype=float)
+        if rate is None:
+            yield block[:, 0], block[:, 1]
+        else:
+            yield (np.arange(start, start + len(block)) / float(rate),
+                   block)
+
+def read_csv(filename, columns=(0, 1), chunk=CHUNK_BYTES):
+    """
+    Read a CSV log a block of lines at a time.
+
+    Args:
+        filename: Comma- or whitespace-separated numbers, one sample per line,
+            optionally after a header line.
+        columns: The (time, power) column numbers, or any others to read.
+        chunk: About how many bytes to read at once.
+
+    Yields:
+        (times, power) arrays, or an array per column of columns.
+
+    Raises:
+        ValueError: A line after the header isn't all numbers, or has a
+            different number of them than the first.
+    """
+    with open(filename) as f:
+        first = f.readline()
+        number = 1
+        if not _numeric(first):
+            # A header; the first line of numbers says how many columns
+            first = f.readline()
+            number = 2
+        width = len(first.replace(",", " ").split())
+        if not width:
+            # No samples at all
+            return
+        lines = [first]
+        while True:
+            lines.extend(f.readlines(chunk))
+            if not lines:
+                break
+            values = np.fromstring("".join(lines).replace(",", " "),
+                                   sep=" ")
+            if len(values) != len(lines) * width:
+                # np.fromstring() stops at the first thing that isn't a
+                # number; blank lines are the only harmless reason
+                _check_lines(filename, lines, number, width)
+            values = values.reshape(-1, width)
+            yield tuple(values[:, column] for column in columns)
+            number += len(lines)
+            lines = []
+
+def _check_lines(filename, lines, number, width):
+    """
+    Raise ValueError for the first of lines (numbered from number) that
+    isn't blank or width numbers.
+    """
+    for i, line in enumerate(lines):
+        fields = line.replace(",", " ").split()
+        if fields and (len(fields) != width or not _numeric(line)):
+            raise ValueError(
+                "{}, line {}: expected {} numbers, got {!r}".format(
+                    filename, number + i, width, line.rstrip()))
+
+def _numeric(line):
+    try:
+        [float(field) for field in line.replace(",", " ").split()]
+        return True
+    except ValueError:
+        return False
+
+def window_fits(sums, blocks):
+    """
+    Fit log power against time over every run of consecutive blocks.
+
+    Args:
+        sums: Block sums, as returned by BlockSums.result().
+        blocks: The window length, in blocks.
+
+    Returns:
+        (slope, error, scatter, count) for each window, each shape
+        (len(sums) - blocks + 1,): the slope in 1/s (the inverse period), its
+        standard error, the standard deviation of log power about the fit,
+        and the number of samples.
+    """
+    cumulative = np.concatenate((np.zeros((1, 6)), np.cumsum(sums, axis=0)))
+    return _fit(cumulative[blocks:] - cumulative[:-blocks])
+
+def _fit(sums):
+    n, t, y = sums[..., N], sums[..., T], sums[..., Y]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        stt = n * sums[..., TT] - t * t
+        sty = n * sums[..., TY] - t * y
+        syy = n * sums[..., YY] - y * y
+        slope = sty / stt
+        # The residual sum of squares, times n
+        residual = np.maximum(syy - slope * sty, 0)
+        error = np.sqrt(residual / ((n - 2) * stt))
+        scatter = np.sqrt(residual / (n * (n - 2)))
+    return slope, error, scatter, n
+
+def find_periods(sums, block=BLOCK, windows=WINDOWS, min_period=MIN_PERIOD,
+                 max_period=MAX_PERIOD, min_significance=MIN_SIGNIFICANCE,
+                 max_scatter=MAX_SCATTER, tolerance=SETTLE_TOLERANCE,
+                 min_duration=MIN_DURATION, min_periods=MIN_PERIODS):
+    """
+    Find the stable period after each pull.
+
+    Args:
+        sums: Block sums, as returned by BlockSums.result().
+        block: The block length they were summed over, in seconds.
+        windows: The sliding window lengths to look with, in seconds.
+        min_period, max_period: The periods that count as a pull.
+        min_significance: The least slope of log power, in standard errors,
+            for a window to count as rising.
+        max_scatter: The most scatter about a window's fit, as a multiple of
+            the log's noise, for it to count as exponential.
+        tolerance: How closely the window periods in the stable region must
+            agree with each other, beyond their noise.
+        min_duration: The shortest stable region to report, in seconds...
+        min_periods: ... and as a fraction of its period.
+
+    Returns:
+        A list of dicts, one per pull in time order: the "period" in seconds
+        fitted over the stable region, which runs from "start" to "end"
+        (seconds from the start of the log), and the number of "samples" in
+        it.
+    """
+    windows = sorted(max(int(round(window / block)), 2) for window in windows)
+    if len(sums) < windows[0]:
+        return []
+    # The noise in log power: most short windows are steady or smoothly
+    # rising, so fit as well as the noise allows
+    _, _, scatter, count = window_fits(sums, windows[0])
+    noise = np.median(scatter[count >= 3])
+
+    found = []
+    for blocks in windows:
+        if len(sums) >= blocks:
+            found.extend(_stable_regions(
+                sums, blocks, noise, min_period, max_period, min_significance,
+                max_scatter, tolerance))
+
+    # Short windows find short periods, long windows long ones, and some
+    # pulls are found with more than one. Keep the fits over the most samples.
+    found.sort(key=lambda region: -region[2][N])
+    periods = []
+    for begin, finish, region in found:
+        period = 1.0 / _fit(region)[0]
+        duration = (finish - begin) * block
+        if duration < max(min_duration, min_periods * period):
+            continue
+        if any(begin < other["end"] / block and other["start"] / block <
+               finish for other in periods):
+            continue
+        periods.append({"period": period,
+                        "start": begin * block,
+                        "end": finish * block,
+                        "samples": int(region[N])})
+    periods.sort(key=lambda found: found["start"])
+    return periods
+
+def _stable_regions(sums, blocks, noise, min_period, max_period,
+                    min_significance, max_scatter, tolerance):
+    """
+    Find the stable regions with one window length.
+
+    Returns:
+        A list of (first block, end block, summed sums) for each region.
+    """
+    slope, error, scatter, count = window_fits(sums, blocks)
+    with np.errstate(invalid="ignore"):
+        rising = ((count >= 3) & (slope >= 1.0 / max_period) &
+                  (slope <= 1.0 / min_period) &
+                  (slope >= min_significance * error) &
+                  (scatter <= max_scatter * noise))
+
+    # Runs of consecutive rising windows: [starts[i], ends[i])
+    edges = np.diff(np.concatenate(([0], rising.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    regions = []
+    for start, end in zip(starts, ends):
+        run = slope[start:end]
+        # The stable slope, from the later half of the run, and the last
+        # stretch of windows that agree with it
+        stable = np.median(run[len(run) // 2:])
+        agrees = (np.abs(run - stable) <=
+                  np.maximum(tolerance * stable, 3 * error[start:end]))
+        if not agrees.any():
+            continue
+        last = np.flatnonzero(agrees)[-1]
+        breaks = np.flatnonzero(~agrees[:last])
+        first = breaks[-1] + 1 if len(breaks) else 0
+
+        # Every block the stable windows cover
+        begin, finish = start + first, start + last + blocks
+        regions.append((begin, finish, sums[begin:finish].sum(axis=0)))
+    return regions
+
+def log_periods(chunks, block=BLOCK, **options):
+    """
+    Find the stable periods in a log, in one pass.
+
+    Args:
+        chunks: (times, power) arrays in time order, e.g. from read_binary()
+            or read_csv().
+        block: The block length to sum over, in seconds.
+        options: Passed to find_periods().
+
+    Returns:
+        As for find_periods().
+    """
+    sums = BlockSums(block)
+    for times, power in chunks:
+        sums.add(times, power)
+    return find_periods(sums.result(), block, **options)
+
+def rod_pulls(bottom, heights, periods):
+    """
+    Pair the heights after each pull with the periods found in the log, in
+    the form rodcal.collect_rod() returns.
+
+    Raises:
+        ValueError: There isn't a period for every height.
+    """
+    if len(heights) != len(periods):
+        raise ValueError("{} heights but {} periods in the log".format(
+            len(heights), len(periods)))
+    return [bottom] + [(height, found["period"])
+                       for height, found in zip(heights, periods)]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Find the stable period after each pull in a power log.")
+    parser.add_argument("log", help="a CSV or binary power log")
+    parser.add_argument("--dtype",
+                        help="read a binary log of this dtype, e.g. f4")
+    parser.add_argument("--rate", type=float,
+                        help="samples per second of a binary log of power "
+                             "alone")
+    parser.add_argument("--columns", default="0,1",
+                        help="time and power columns of a CSV log "
+                             "(default: 0,1)")
+    parser.add_argument("--windows", default=",".join(
+                            "{:g}".format(window) for window in WINDOWS),
+                        help="comma-separated sliding windows in seconds "
+                             "(default: %(default)s)")
+    parser.add_argument("--max-period", type=float, default=MAX_PERIOD,
+                        help="longest period to look for, in seconds "
+                             "(default: {:g})".format(MAX_PERIOD))
+    parser.add_argument("--bottom", type=float,
+                        help="critical height the pulls start from, in %% "
+                             "(needed with --heights)")
+    parser.add_argument("--heights",
+                        help="comma-separated heights after each pull, in "
+                             "%%, to calculate the rod's worth")
+    args = parser.parse_args()
+    if args.heights and args.bottom is None:
+        parser.error("--heights needs --bottom")
+
+    if args.dtype or args.rate:
+        chunks = read_binary(args.log, args.dtype or "f8", args.rate)
+    else:
+        chunks = read_csv(args.log, [int(column) for column in
+                                     args.columns.split(",")])
+    periods = log_periods(chunks, windows=[float(window) for window in
+                                           args.windows.split(",")],
+                          max_period=args.max_period)
+
+    for number, found in enumerate(periods, 1):
+        print "Pull {:2d}: {:10.0f} ms  ({:.0f}-{:.0f} s, {} samples)".format(
+            number, found["period"] * 1000, found["start"], found["end"],
+            found["samples"])
+
+    if args.heights:
+        heights = [float(height) for height in args.heights.split(",")]
+        pulls = rod_pulls(args.bottom, heights, periods)
+        integral_fit = rodcal.reactivity_calc(pulls[0], pulls[1:])[0]
+        print
+        print "Total worth: ${:.2f}".format(integral_fit(0))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+# Headless plot rendering
+#
+# Plots are drawn on matplotlib Figure objects with the Agg canvas directly,
+# never through pyplot, so no GUI backend is loaded and no figures pile up in
+# pyplot's registry. Each process keeps one figure and clears it between
+# plots, which keeps memory flat however many calibrations go through.
+
+import multiprocessing
+import os
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+import instrument
+
+RODS = ["safe", "shim", "reg"]
+
+# Each plot: (filename suffix, which half of the reactivity_calc() 4-tuple,
+# y axis label)
+KINDS = [("integral", 0, "Integral Worth ($)"),
+         ("rate", 2, "Insertion Rate ($/%)")]
+
+# The figure this process draws on, created on first use
+_figure = None
+
+
+def _blank_figure():
+    """
+    Return this process's figure, cleared and ready to draw on.
+    """
+    global _figure
+    if _figure is None:
+        _figure = Figure()
+        FigureCanvasAgg(_figure)
+    _figure.clf()
+    return _figure
+
+def _draw(axes, fit, data, ylabel):
+    """
+    Draw one fit, in a blue line, over its data, in black circles.
+    """
+    r = np.arange(0, 100, 0.1)
+    # A np.poly1d or any curve from fitmodels.py, or cubic coefficients
+    curve = fit if callable(fit) else np.poly1d(fit)
+    axes.plot(r, curve(r), "b-")
+    x, y = zip(*data)
+    axes.plot(x, y, "ko")
+    axes.set_xlabel("Rod Height (%)")
+    axes.set_ylabel(ylabel)
+
+def render_one(filename, fit, data, ylabel):
+    """
+    Render a single plot of a fit and its data to an image file.
+
+    Args:
+        filename: The image to write.
+        fit: A np.poly1d polynomial, or its coefficients, or a curve from
+            fitmodels.py.
+        data: A list of (%height, value) tuples the fit was computed from.
+        ylabel: The y axis label.
+
+    Returns:
+        filename.
+    """
+    figure = _blank_figure()
+    _draw(figure.add_subplot(111), fit, data, ylabel)
+    figure.tight_layout(pad=0)
+    with instrument.stage("savefig", file=filename):
+        figure.savefig(filename)
+    figure.clf()
+    return filename
+
+def _render_one_star(args):
+    return render_one(*args)
+
+def render_rod(rod, integral_fit, integral, addition_rate_fit, addition_rate,
+               directory="."):
+    """
+    Render the integral worth and addition rate plots for one rod, as
+    rodcal.plot() does.
+
+    Args:
+        rod: "safe", "shim", or "reg"
+        integral_fit, integral, addition_rate_fit, addition_rate: The 4-tuple
+            returned by rodcal.reactivity_calc().
+        directory: Where to save the images.
+
+    Returns:
+        The two image filenames.
+    """
+    return [render_one(*job) for job in
+            _jobs([rod], [(integral_fit, integral, addition_rate_fit,
+                           addition_rate)], directory)]
+
+def _jobs(rods, fits, directory):
+    return [(os.path.join(directory, "{}-{}.png".format(rod, kind)),
+             fit[index], fit[index + 1], ylabel)
+            for rod, fit in zip(rods, fits)
+            for kind, index, ylabel in KINDS]
+
+def render_plots(fits, directory=".", processes=None, combined=False,
+                 pool=None):
+    """
+    Render all six plots of a calibration, in parallel.
+
+    Args:
+        fits: [safe, shim, reg], each the 4-tuple returned by
+            rodcal.reactivity_calc().
+        directory: Where to save the images.
+        processes: The number of worker processes; defaults to one per plot,
+            up to the number of CPUs. 1 renders everything in this process.
+        combined: Also render all six plots as panels of one image,
+            calibration.png.
+        pool: An existing multiprocessing pool to render with, e.g. to share
+            one across many calibrations. Overrides processes.
+
+    Returns:
+        The image filenames, in the order of rodcal.PLOTS, followed by the
+        combined image if there is one.
+    """
+    jobs = _jobs(RODS, fits, directory)
+
+    if pool is not None:
+        filenames = pool.map(_render_one_star, jobs)
+    else:
+        processes = processes or min(len(jobs), multiprocessing.cpu_count())
+        if processes == 1:
+            filenames = map(_render_one_star, jobs)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                filenames = pool.map(_render_one_star, jobs)
+            finally:
+                pool.close()
+                pool.join()
+
+    if combined:
+        filenames.append(render_combined(
+            fits, os.path.join(directory, "calibration.png")))
+    return filenames
+
+def render_combined(fits, filename):
+    """
+    Render all six plots as a grid of panels in a single image: one row per
+    rod, integral worth on the left and addition rate on the right.
+
+    Args:
+        fits: [safe, shim, reg], each the 4-tuple returned by
+            rodcal.reactivity_calc().
+        filename: The image to write.
+
+    Returns:
+        filename.
+    """
+    # A fresh figure, since it isn't the size of the single plots
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    width, height = figure.get_size_inches()
+    figure.set_size_inches(2 * width, 3 * height)
+
+    for row, (rod, fit) in enumerate(zip(RODS, fits)):
+        for column, (kind, index, ylabel) in enumerate(KINDS):
+            axes = figure.add_subplot(len(RODS), len(KINDS),
+                                      row * len(KINDS) + column + 1)
+            _draw(axes, fit[index], fit[index + 1], ylabel)
+            axes.set_title("{} Rod".format(rod.capitalize()))
+
+    figure.tight_layout()
+    with instrument.stage("savefig", file=filename):
+        figure.savefig(filename)
+    return filename
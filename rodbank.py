@@ -2,43 +2,58 @@
 # Reuven Z. Lazarus, 2013
 # rlazarus@alumni.reed.edu
 
-import subprocess
-
-import numpy as np
+import argparse
 
 import rodcal
+import typesetting
+from lazy import LazyModule
+
+np = LazyModule("numpy")
+fitmodels = LazyModule("fitmodels")
+texwriter = LazyModule("texwriter")
 
 POWERS = [0, 20, 40, 50, 60, 80, 100, 120, 140, 150, 160, 180, 200, 220, 230]
 CORE_EXCESSES = [0.05 * i for i in xrange(0, 41)]  # 0.00, 0.05, ..., 2.00
 
-def rod_height_vs_core_excess(rod_banks):
+# Python number types RodHeightEvaluator evaluates without numpy
+SCALARS = frozenset([float, int, long])
+# Queries RodHeightEvaluator remembers, per generation
+CACHE_SIZE = 1024
+
+def rod_height_vs_core_excess(rod_banks, model=None):
     """
     Calculate the cubic of best fit for the banked rod heights vs. core excess.
 
     Args:
         rod_banks: Data collected from the reactor. A list of tuples of
             (power in kW, banked height in %, core excess in $).
+        model: A model from fitmodels.py to fit with instead.
 
     Returns:
-        The cubic of best fit, as a poly1d instance.
+        The cubic of best fit, as a poly1d instance (with a model, its curve).
     """
     x = [t[2] for t in rod_banks]
     y = [t[1] for t in rod_banks]
+    if model is not None:
+        return model.fit(x, y)
     return np.poly1d(np.polyfit(x, y, 3))
 
-def core_excess_vs_power(rod_banks):
+def core_excess_vs_power(rod_banks, model=None):
     """
     Calculate the cubic of best fit for the core excess vs. power.
 
     Args:
         rod_banks: Data collected from the reactor. A list of tuples of
             (power in kW, banked height in %, core excess in $).
+        model: A model from fitmodels.py to fit with instead.
 
     Returns:
-        The cubic of best fit, as a poly1d instance.
+        The cubic of best fit, as a poly1d instance (with a model, its curve).
     """
     x = [t[0] for t in rod_banks]
     y = [t[2] for t in rod_banks]
+    if model is not None:
+        return model.fit(x, y)
     return np.poly1d(np.polyfit(x, y, 3))
 
 def rod_height(core_excess, power, hvsrho, rhovsp):
@@ -57,22 +72,133 @@ def rod_height(core_excess, power, hvsrho, rhovsp):
     reactivity = rhovsp(power) + core_excess - rhovsp(0)
     return hvsrho(reactivity)
 
-def table(hvsrho, rhovsp):
+class RodHeightEvaluator(object):
     """
-    Generate the table of banked rod heights for all core excesses and powers.
+    rod_height() for one pair of fits, built once for calling in tight loops
+    (a simulator, an operator aid):
+
+        evaluator = RodHeightEvaluator(hvsrho, rhovsp)
+        evaluator(1.25, 100)                     # a float
+        evaluator(excesses[:, None], powers)     # an array, broadcast
+
+    rhovsp(0) is folded into the fit, so each height is two cubics. Python
+    numbers are evaluated by Horner's rule in plain floats, without numpy's
+    per-call overhead; arrays (or numpy scalars) go through numpy, broadcast
+    like a ufunc. Results agree with rod_height() to within rounding.
+    """
+    def __init__(self, hvsrho, rhovsp, cache_size=CACHE_SIZE):
+        """
+        Args:
+            hvsrho: The output of rod_height_vs_core_excess.
+            rhovsp: The output of core_excess_vs_power.
+            cache_size: How many (core excess, power) queries to remember
+                the heights of, or 0 not to. The cache is in two generations
+                of up to cache_size each: hits are a dict lookup, and a
+                query goes once it's gone unused for two generations,
+                which approximates forgetting the least recently used.
+
+        Raises:
+            ValueError: A fit isn't a polynomial (see fitmodels.py).
+        """
+        # Padded to cubics, highest power first
+        self.height_coeffs = _cubic(hvsrho)
+        # rhovsp(power) - rhovsp(0): the same cubic without its constant
+        self.excess_coeffs = _cubic(rhovsp)[:3] + (0.0,)
+        self.cache_size = cache_size
+        self._recent = {}
+        self._older = {}
+
+    def __call__(self, core_excess, power):
+        """
+        The target rod height in % for a five-watt core excess in dollars
+        and a target power in kW, or an array of them.
+        """
+        if type(core_excess) in SCALARS and type(power) in SCALARS:
+            if not self.cache_size:
+                return self._scalar(core_excess, power)
+            key = (core_excess, power)
+            height = self._recent.get(key)
+            if height is not None:
+                return height
+            height = self._older.get(key)
+            if height is None:
+                height = self._scalar(core_excess, power)
+            if len(self._recent) >= self.cache_size:
+                self._older = self._recent
+                self._recent = {}
+            self._recent[key] = height
+            return height
+        return self.array(core_excess, power)
+
+    def _scalar(self, core_excess, power):
+        a3, a2, a1, _ = self.excess_coeffs
+        b3, b2, b1, b0 = self.height_coeffs
+        x = ((a3 * power + a2) * power + a1) * power + core_excess
+        return ((b3 * x + b2) * x + b1) * x + b0
+
+    def array(self, core_excess, power):
+        """
+        The target rod heights for arrays of core excesses and powers,
+        broadcast against each other.
+        """
+        power = np.asarray(power, dtype=float)
+        a3, a2, a1, _ = self.excess_coeffs
+        b3, b2, b1, b0 = self.height_coeffs
+        x = ((a3 * power + a2) * power + a1) * power + core_excess
+        return ((b3 * x + b2) * x + b1) * x + b0
+
+def _cubic(poly):
+    """
+    A fit's coefficients as a tuple of four floats, highest power first.
+    """
+    coeffs = [float(c) for c in
+              fitmodels.polynomial(poly, "RodHeightEvaluator").c]
+    return tuple([0.0] * (4 - len(coeffs)) + coeffs)
+
+def table(hvsrho, rhovsp, powers=POWERS, core_excesses=CORE_EXCESSES):
+    """
+    Generate the table of banked rod heights for all core excesses and powers,
+    evaluated as one array over the whole grid.
 
     Args:
         hvsrho: The output of rod_height_vs_core_excess.
         rhovsp: The output of core_excess_vs_power.
+        powers: The target powers in kW, one per column.
+        core_excesses: The five-watt core excesses in dollars, one per row.
 
     Returns:
-        [[rod height for each power] for each core excess]
+        An array of rod heights, shape (len(core_excesses), len(powers)).
+    """
+    powers = np.asarray(powers, dtype=float)
+    core_excesses = np.asarray(core_excesses, dtype=float)
+    # The same arithmetic as rod_height(), broadcast over the grid
+    reactivity = (rhovsp(powers)[np.newaxis, :] +
+                  core_excesses[:, np.newaxis] - rhovsp(0))
+    return hvsrho(reactivity)
+
+def grid(power_step, excess_step, max_power=POWERS[-1],
+         max_excess=CORE_EXCESSES[-1]):
     """
-    return [[rod_height(core_excess, power, hvsrho, rhovsp)
-             for power in POWERS]
-            for core_excess in CORE_EXCESSES]
+    Make evenly spaced table axes at any resolution, e.g. grid(1, 0.001) for
+    every kW and every tenth of a cent.
 
-def tex(xenon_free, data):
+    Args:
+        power_step: The spacing of the target powers, in kW.
+        excess_step: The spacing of the core excesses, in dollars.
+        max_power: The highest target power; the powers start from 0.
+        max_excess: The highest core excess; the excesses start from $0.
+
+    Returns:
+        (powers, core_excesses), arrays to pass to table() and tex().
+    """
+    # Count the steps first so the endpoints don't drift with rounding
+    powers = np.linspace(0, max_power, int(round(max_power / power_step)) + 1)
+    core_excesses = np.linspace(0, max_excess,
+                                int(round(max_excess / excess_step)) + 1)
+    return powers, core_excesses
+
+def tex(xenon_free, data, directory=".", powers=POWERS,
+        core_excesses=CORE_EXCESSES, filename=None):
     """
     Generate and typeset a printable table of estimated banked rod heights for
     the back of the logbook.
@@ -80,52 +206,75 @@ def tex(xenon_free, data):
     Args:
         xenon_free: The experimentally-determined 5 W core excess without xenon.
         data: The output of table().
+        directory: Where to write the table.
+        powers, core_excesses: The axes data was generated with.
+        filename: The .tex file to write; defaults to the first available
+            banktable-N.tex in directory.
 
     Returns:
         The filename of the final typeset PDF.
     """
-    # We'll want to bold the rows near the xenon-free core excess
-    with open("template-banktable.tex") as f:
-        tex = f.read()
-
-    replacements = {}
-    replacements["numpowers"] = len(POWERS)
-    replacements["powers"] = " & ".join(r"\textbf{" + str(x) + "}"
-                                        for x in POWERS)
-    replacements["tablebody"] = ""
-
-    for i, core_excess in enumerate(CORE_EXCESSES):
-        bold = (abs(core_excess - xenon_free) <= 0.05)
-
-        if bold:
-            replacements["tablebody"] += r"\textbf{"
-        replacements["tablebody"] += r"\${:.2f}".format(core_excess)
-        if bold:
-            replacements["tablebody"] += "}"
-
-        for height in data[i]:
-            replacements["tablebody"] += " & "
-
-            if height < 100.5:
-                if bold:
-                    replacements["tablebody"] += r"\textbf{"
-                replacements["tablebody"] += str(int(round(height)))
-                if bold:
-                    replacements["tablebody"] += "}"
-
-        replacements["tablebody"] += r"\\"
-
-    tex = tex % replacements
+    return typesetting.typeset(write_tex(xenon_free, data, directory, powers,
+                                         core_excesses, filename),
+                               "template-banktable.tex")
 
-    filename = rodcal.available_filename("banktable")
-    with open(filename, 'w') as f:
-        f.write(tex)
+def write_tex(xenon_free, data, directory=".", powers=POWERS,
+              core_excesses=CORE_EXCESSES, filename=None):
+    """
+    Generate the table for tex() without typesetting it.
 
-    subprocess.call(["pdflatex", filename, "-interaction", "batchmode"])
+    Returns:
+        The filename of the generated .tex file.
+    """
+    replacements = {}
+    replacements["numpowers"] = len(powers)
+    replacements["powers"] = " & ".join(r"\textbf{" + "{:g}".format(x) + "}"
+                                        for x in powers)
 
-    return filename.replace("tex", "pdf")
+    # We'll want to bold the rows near the xenon-free core excess
+    core_excesses = np.asarray(core_excesses, dtype=float)
+    bold = np.abs(core_excesses - xenon_free) <= 0.05
+    # Cents, or as many more places as a finer grid needs. The body is
+    # written straight to the file as it's formatted.
+    replacements["tablebody"] = texwriter.bank_table(
+        data, core_excesses, bold, _decimals(core_excesses, 2))
+
+    return texwriter.template("template-banktable.tex").fill(
+        filename or rodcal.available_filename("banktable", directory),
+        replacements)
+
+def _decimals(values, minimum):
+    """
+    The fewest decimal places, at least minimum, that show every one of values
+    exactly.
+    """
+    values = np.asarray(values, dtype=float)
+    decimals = minimum
+    while decimals < 6 and not np.allclose(values, np.round(values, decimals),
+                                           rtol=0, atol=1e-9):
+        decimals += 1
+    return decimals
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Generate the banked rod height table for the logbook.")
+    parser.add_argument("--power-step", type=float,
+                        help="target power spacing in kW (default: the "
+                             "logbook's powers)")
+    parser.add_argument("--excess-step", type=float,
+                        help="core excess spacing in dollars (default: $0.05)")
+    args = parser.parse_args()
+
+    # Each axis keeps the logbook's values unless its step is given
+    powers, core_excesses = POWERS, CORE_EXCESSES
+    if args.power_step or args.excess_step:
+        fine_powers, fine_excesses = grid(args.power_step or 10,
+                                          args.excess_step or 0.05)
+        if args.power_step:
+            powers = fine_powers
+        if args.excess_step:
+            core_excesses = fine_excesses
+
     # Data entry
     print "For each power, enter the banked rod height and core excess from"
     print "Page 4 of SOP 34A (Control Rod Calibration Form)."
@@ -143,7 +292,8 @@ def main():
     rhovsp = core_excess_vs_power(rod_banks)
     xenon_free = rod_banks[0][2]
 
-    filename = tex(xenon_free, table(hvsrho, rhovsp))
+    filename = tex(xenon_free, table(hvsrho, rhovsp, powers, core_excesses),
+                   powers=powers, core_excesses=core_excesses)
     print "Filename: " + filename
     rodcal.open_file(filename)
 
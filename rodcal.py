@@ -2,28 +2,49 @@
 # Reuven Z. Lazarus, 2013
 # rlazarus@alumni.reed.edu
 
+import argparse
+import json
 import math
 import os
 import re
 import subprocess
 import sys
-
-import numpy as np
-import matplotlib.pyplot as plt
+import time
+
+import instrument
+import nucdata
+import typesetting
+from lazy import LazyModule
+
+# Loaded when first used, so the prompts come up without waiting for them
+np = LazyModule("numpy")
+batch = LazyModule("batch")
+export = LazyModule("export")
+history = LazyModule("history")
+incremental = LazyModule("incremental")
+orchestrate = LazyModule("orchestrate")
+render = LazyModule("render")
+stream = LazyModule("stream")
+texwriter = LazyModule("texwriter")
 
 # Constants
 
 beta = 0.0065
-beta_eff = 0.0075
-l_p = 0.000108  # seconds
 
-# values for the six delayed neutron groups - ref. Lamarsh, Table 3.5
-t_half = [55.72, 22.72, 6.22, 2.30, 0.610, 0.230]
-lambda_i = [math.log(2)/x for x in t_half]
-beta_i = [0.000215, 0.001424, 0.001274, 0.002568, 0.000748, 0.000273]
+# The default delayed neutron data (see nucdata.py); the calculations below
+# take any other data set as data=
+beta_eff = nucdata.DEFAULT.beta_eff
+l_p = nucdata.DEFAULT.l_p  # seconds
+t_half = list(nucdata.DEFAULT.t_half)
+lambda_i = list(nucdata.DEFAULT.lambda_i)
+beta_i = list(nucdata.DEFAULT.beta_i)
+
+# The images plot() saves, which the report includes
+PLOTS = ["safe-integral.png", "safe-rate.png", "shim-integral.png",
+         "shim-rate.png", "reg-integral.png", "reg-rate.png"]
 
 
-def reactivity_calc(bottom, pulls):
+def reactivity_calc(bottom, pulls, model=None, data=None):
     """
     Perform the actual rod worth calculations for a single control rod.
 
@@ -32,12 +53,18 @@ def reactivity_calc(bottom, pulls):
             the calibration.
         pulls: A list of (height, period): the height at the top of the pull and
             the stable period observed following it.
+        model: A model from fitmodels.py to fit the curves with, in place of
+            least-squares cubics.
+        data: The delayed neutron data, a nucdata.DataSet; defaults to
+            nucdata.DEFAULT.
 
     Returns:
         A 4-tuple: (integral rod worth polynomial, integral rod worth data,
                     reactivity addition rate polynomial, addition rate data).
-        Polynomials are instances of np.poly1d. Data are lists of tuples.
+        Polynomials are instances of np.poly1d (with a model, its curves).
+        Data are lists of tuples.
     """
+    data = data or nucdata.DEFAULT
     # Calculate the reactivity insertion for each rod pull
     reactivity = []  # (%height start, %height end, $)
     for (i, (end, period)) in enumerate(pulls):
@@ -46,11 +73,7 @@ def reactivity_calc(bottom, pulls):
         else:
             start = pulls[i - 1][0]
 
-        reactivity_dkk = (l_p/period +
-                          sum(beta / (1.0 + lambda_ * period) for beta, lambda_
-                              in zip(beta_i, lambda_i)))
-        reactivity_dollar = reactivity_dkk / beta_eff
-        reactivity.append((start, end, reactivity_dollar))
+        reactivity.append((start, end, data.reactivity(period)))
 
     # Calculate the integral rod worth after each pull, and the average
     # reactivity addition rate during each pull.
@@ -71,6 +94,14 @@ def reactivity_calc(bottom, pulls):
     addition_rate.insert(0, (0.0, 0.0))
     addition_rate.append((100.0, 0.0))
 
+    if model is not None:
+        x, y = zip(*integral[:-1])
+        integral_fit = model.fit(x, y, clamps=integral[-1:])
+        x, y = zip(*addition_rate[1:-1])
+        addition_rate_fit = model.fit(x, y, clamps=[addition_rate[0],
+                                                    addition_rate[-1]])
+        return (integral_fit, integral, addition_rate_fit, addition_rate)
+
     # Fit the integral worth to a cubic
     x, y = zip(*integral)
     integral_fit = np.poly1d(np.polyfit(x, y, 3))
@@ -81,7 +112,170 @@ def reactivity_calc(bottom, pulls):
 
     return (integral_fit, integral, addition_rate_fit, addition_rate)
 
-def plot(rod, integral_fit, integral, addition_rate_fit, addition_rate):
+def inhour(period, data=None):
+    """
+    Evaluate the six-group inhour equation for one or many stable periods.
+
+    Args:
+        period: The stable period in seconds, as a scalar or an array of any
+            shape.
+        data: The delayed neutron data; defaults to nucdata.DEFAULT.
+
+    Returns:
+        The reactivity in dollars, with the same shape as period.
+    """
+    return (data or nucdata.DEFAULT).inhour(period)
+
+def reactivity_calc_batch(bottom, heights, periods, data=None):
+    """
+    Perform the rod worth calculations for many control rods at once. This is
+    the array equivalent of reactivity_calc(), for rods that all have the same
+    number of pulls; the results agree with it to within rounding.
+
+    Args:
+        bottom: The lowest indicated rod height for each rod, shape (rods,).
+        heights: The height at the top of each pull, shape (rods, pulls).
+        periods: The stable period in seconds following each pull, shape
+            (rods, pulls).
+        data: The delayed neutron data; defaults to nucdata.DEFAULT.
+
+    Returns:
+        A 4-tuple: (integral rod worth coefficients, integral rod worth data,
+                    reactivity addition rate coefficients, addition rate data).
+        Coefficients have shape (rods, 4), highest power first, as in
+        np.poly1d.c. Data have shape (rods, points, 2), each point being a
+        (%height, value) pair in the same order reactivity_calc() returns.
+    """
+    return reactivity_fits_batch(bottom, heights, inhour(periods, data))
+
+def reactivity_fits_batch(bottom, heights, reactivity_dollar):
+    """
+    The rest of reactivity_calc_batch() once the inhour equation has turned
+    the periods into reactivity, e.g. to fit the same pulls under several
+    delayed neutron data sets at once (see nucdata.py).
+
+    Args:
+        bottom, heights: As for reactivity_calc_batch().
+        reactivity_dollar: The reactivity inserted by each pull, in dollars,
+            shape (rods, pulls).
+
+    Returns:
+        As reactivity_calc_batch().
+    """
+    heights = np.asarray(heights, dtype=float)
+    bottom = np.asarray(bottom, dtype=float).reshape(-1, 1)
+    rods, pulls = heights.shape
+
+    # Reactivity insertion for each rod pull
+    start = np.concatenate((bottom, heights[:, :-1]), axis=1)
+
+    # Integral worth after each pull is everything still to be pulled above it
+    worth = np.cumsum(reactivity_dollar[:, ::-1], axis=1)[:, ::-1]
+    rate = reactivity_dollar / (heights - start)
+
+    # Clamp as in reactivity_calc(): integral worth zero when fully withdrawn,
+    # addition rate zero at the top and bottom
+    full = np.full((rods, 1), 100.0)
+    zero = np.zeros((rods, 1))
+    integral = np.stack((np.concatenate((start, full), axis=1),
+                         np.concatenate((worth, zero), axis=1)), axis=-1)
+    addition_rate = np.stack(
+        (np.concatenate((zero, (start + heights) / 2.0, full), axis=1),
+         np.concatenate((zero, rate, zero), axis=1)), axis=-1)
+
+    # Fit both curves for every rod in a single stacked least-squares solve.
+    # The integral data are one point short, so pad them with an all-zero row,
+    # which leaves the least-squares solution unchanged.
+    padding = np.zeros((rods, 1, 2))
+    data = np.concatenate((np.concatenate((integral, padding), axis=1),
+                           addition_rate), axis=0)
+    points = np.repeat([pulls + 1, pulls + 2], rods)
+    coeffs = _cubic_fit_batch(data[..., 0], data[..., 1], points)
+
+    return (coeffs[:rods], integral, coeffs[rods:], addition_rate)
+
+def reactivity_calc_many(rod_pulls, data=None):
+    """
+    Run reactivity_calc() over any number of rods. Rods are grouped by their
+    number of pulls and each group's reactivities, integral worths and
+    addition rates are worked out as arrays, with the same arithmetic in the
+    same order as reactivity_calc(); each rod's cubics are then fitted with
+    np.polyfit() as there, so the results are identical, not just close.
+    (reactivity_calc_batch() is faster but agrees only to within rounding.)
+
+    Args:
+        rod_pulls: A list of rods, each in the form collect_rod() returns:
+            [bottom, (height, period), (height, period), ...].
+        data: The delayed neutron data; defaults to nucdata.DEFAULT.
+
+    Returns:
+        A list with one 4-tuple per rod, exactly as reactivity_calc() would
+        return it.
+    """
+    data = data or nucdata.DEFAULT
+    groups = {}
+    for i, rod in enumerate(rod_pulls):
+        groups.setdefault(len(rod) - 1, []).append(i)
+
+    results = [None] * len(rod_pulls)
+    for count, indices in groups.iteritems():
+        bottom = np.array([[rod_pulls[i][0]] for i in indices], dtype=float)
+        pulls = np.array([rod_pulls[i][1:] for i in indices], dtype=float)
+        heights = pulls[..., 0]
+        start = np.concatenate((bottom, heights[:, :-1]), axis=1)
+        # DataSet.reactivity() broadcasts with the same operations
+        reactivity = data.reactivity(pulls[..., 1])
+
+        # Summed first to last, as reactivity_calc()'s sum() does
+        worth = np.empty_like(reactivity)
+        for j in xrange(count):
+            total = reactivity[:, j]
+            for k in xrange(j + 1, count):
+                total = total + reactivity[:, k]
+            worth[:, j] = total
+        middle = (start + heights) / 2.0
+        rate = reactivity / (heights - start)
+
+        for j, i in enumerate(indices):
+            integral = zip(start[j], worth[j]) + [(100.0, 0.0)]
+            addition_rate = ([(0.0, 0.0)] + zip(middle[j], rate[j]) +
+                             [(100.0, 0.0)])
+            x, y = zip(*integral)
+            integral_fit = np.poly1d(np.polyfit(x, y, 3))
+            x, y = zip(*addition_rate)
+            addition_rate_fit = np.poly1d(np.polyfit(x, y, 3))
+            results[i] = (integral_fit, integral, addition_rate_fit,
+                          addition_rate)
+    return results
+
+def _cubic_fit_batch(x, y, points):
+    """
+    Least-squares cubic fits for a stack of data sets, mirroring np.polyfit.
+
+    Args:
+        x, y: Arrays of shape (fits, points). Rows may be padded at the end;
+            padding is excluded from the fit.
+        points: The number of real (unpadded) points in each row. Also sets
+            the same singular-value cutoff np.polyfit applies.
+
+    Returns:
+        Coefficients of shape (fits, 4), highest power first.
+    """
+    lhs = x[..., np.newaxis] ** np.arange(3, -1, -1)
+    lhs[np.arange(x.shape[1]) >= points[:, np.newaxis]] = 0.0
+
+    # Scale the columns to improve the condition number, as np.polyfit does
+    scale = np.sqrt((lhs * lhs).sum(axis=1))
+    lhs /= scale[:, np.newaxis, :]
+
+    u, s, vt = np.linalg.svd(lhs, full_matrices=False)
+    cutoff = (points * np.finfo(float).eps)[:, np.newaxis] * s[:, :1]
+    s_inv = np.where(s > cutoff, 1.0 / np.where(s > cutoff, s, 1.0), 0.0)
+    coeffs = np.einsum("fji,fj,fkj,fk->fi", vt, s_inv, u, y)
+    return coeffs / scale
+
+def plot(rod, integral_fit, integral, addition_rate_fit, addition_rate,
+         directory="."):
     """
     Generate graphs from the integral fit and reactivity addition rate.
 
@@ -91,31 +285,47 @@ def plot(rod, integral_fit, integral, addition_rate_fit, addition_rate):
         integral: A list of tuples: the raw data from which the fit was computed.
         addition_rate_fit: A np.poly1d polynomial.
         addition_rate: Data for the fit.
+        directory: Where to save the images.
     """
-    r = np.arange(0,100,0.1)
-
-    plt.figure()
-    # Plot the fit in a blue line
-    plt.plot(r, np.poly1d(integral_fit)(r), "b-")
-    # Plot the data in black circles
-    x, y = zip(*integral)
-    plt.plot(x, y, "ko")
-
-    plt.xlabel("Rod Height (%)")
-    plt.ylabel("Integral Worth ($)")
-    plt.tight_layout(pad=0)
-    plt.savefig("{}-integral.png".format(rod))
-
-    plt.figure()
-    plt.plot(r, np.poly1d(addition_rate_fit)(r), "b-")
+    # Rendered off-screen, without pyplot; see render.py
+    render.render_rod(rod, integral_fit, integral, addition_rate_fit,
+                      addition_rate, directory)
 
-    x, y = zip(*addition_rate)
-    plt.plot(x, y, "ko")
+def tex_polynomial(poly):
+    """
+    Typeset a cubic fit for the report, as a TeX math expression. Other
+    curves from fitmodels.py describe themselves.
+    """
+    if not isinstance(poly, np.poly1d):
+        return poly.tex()
+    patterns = ["{:.6} \, x^3", "{:.6} \, x^2", "{:.6} \, x", "{:.6} "]
+    strings = [p.format(poly.c[i]) for i,p in enumerate(patterns)]
+    for i in xrange(len(strings)):
+        strings[i] = strings[i].format(poly.c[i])
+        # Render the scientific notation nicely
+        strings[i] = re.sub("(.+)e([+-])0*([^ ]+) ",
+                            r"(\1 \\times 10^{\2\3})",
+                            strings[i])
+    return "$" + " + ".join(strings) + "$"
+
+def poly_coefficients(poly):
+    """
+    A fit's coefficients as a list of floats, highest power first, or None
+    for other curves from fitmodels.py.
+    """
+    if not isinstance(poly, np.poly1d):
+        return None
+    return [float(c) for c in poly.c]
 
-    plt.xlabel("Rod Height (%)")
-    plt.ylabel("Insertion Rate ($/%)")
-    plt.tight_layout(pad=0)
-    plt.savefig("{}-rate.png".format(rod))
+def max_addition_rate(fit):
+    """
+    The peak of a reactivity addition rate fit, in $/%.
+    """
+    if isinstance(fit, np.poly1d):
+        # Find the extremes of the addition-rate curve; take the one in range
+        clamp = lambda x: 0 <= x <= 100
+        return fit(filter(clamp, fit.deriv().r)[0])
+    return fit.maximum(0.0, 100.0)[1]
 
 def tech_specs(safe_int, safe_add, shim_int, shim_add, reg_int, reg_add,
                safe_critical, shim_critical, withdrawal_times):
@@ -124,8 +334,9 @@ def tech_specs(safe_int, safe_add, shim_int, shim_add, reg_int, reg_add,
     summarizing is necessary.
 
     Args:
-        safe_int: The safe rod's integral rod worth fit, as a numpy poly1d.
-        safe_add: The safe rod's reactivity addition rate fit, as a poly1d.
+        safe_int: The safe rod's integral rod worth fit, as a numpy poly1d
+            or another curve from fitmodels.py.
+        safe_add: The safe rod's reactivity addition rate fit, likewise.
         shim_int: The shim rod's integral rod worth fit.
         shim_add: The shim rod's reactivity addition rate fit.
         reg_int: The reg rod's integral rod worth fit.
@@ -136,26 +347,22 @@ def tech_specs(safe_int, safe_add, shim_int, shim_add, reg_int, reg_add,
             shim, reg] rods all the way out, in seconds.
 
     Returns:
-        A dict of the values to go into the report.
+        A dict of the values to go into the report. Each fit is there both
+        TeXified, e.g. "safeintpoly", and as a list of its coefficients,
+        highest power first, e.g. "safeintpoly_coefficients" (None for
+        curves other than polynomials).
     """
     result = {}
 
-    # TeXify the polynomials
+    # TeXify the polynomials, and keep their coefficients for other programs
     for key, poly in [("safeintpoly", safe_int),
                       ("safeaddpoly", safe_add),
                       ("shimintpoly", shim_int),
                       ("shimaddpoly", shim_add),
                       ("regintpoly", reg_int),
                       ("regaddpoly", reg_add)]:
-        patterns = ["{:.6} \, x^3", "{:.6} \, x^2", "{:.6} \, x", "{:.6} "]
-        strings = [p.format(poly.c[i]) for i,p in enumerate(patterns)]
-        for i in xrange(len(strings)):
-            strings[i] = strings[i].format(poly.c[i])
-            # Render the scientific notation nicely
-            strings[i] = re.sub("(.+)e([+-])0*([^ ]+) ",
-                                r"(\1 \\times 10^{\2\3})",
-                                strings[i])
-        result[key] = "$" + " + ".join(strings) + "$"
+        result[key] = tex_polynomial(poly)
+        result[key + "_coefficients"] = poly_coefficients(poly)
 
     # Find the total rod worths
     result["safeworth"] = safe_int(0.0)
@@ -165,11 +372,9 @@ def tech_specs(safe_int, safe_add, shim_int, shim_add, reg_int, reg_add,
                             result["regworth"])
 
     # Find the highest reactivity addition rate ($/%)
-    # Find the extremes of the addition-rate curve; take the one in range
-    clamp = lambda x: 0 <= x <= 100
-    result["safemaxdpp"] = safe_add(filter(clamp, safe_add.deriv().r)[0]) * 100
-    result["shimmaxdpp"] = shim_add(filter(clamp, shim_add.deriv().r)[0]) * 100
-    result["regmaxdpp"] = reg_add(filter(clamp, reg_add.deriv().r)[0]) * 100
+    result["safemaxdpp"] = max_addition_rate(safe_add) * 100
+    result["shimmaxdpp"] = max_addition_rate(shim_add) * 100
+    result["regmaxdpp"] = max_addition_rate(reg_add) * 100
 
     # Convert to cent/s using the withdrawal times
     result["safemaxdps"] = result["safemaxdpp"] * 100 / withdrawal_times[0]
@@ -214,7 +419,7 @@ def tech_specs(safe_int, safe_add, shim_int, shim_add, reg_int, reg_add,
 
     return result
 
-def tex_report(result):
+def tex_report(result, directory=".", filename=None):
     """
     Generate and typeset a printable report of the calibration, including rod
     worth summary and Tech Specs check. The inputs aren't reproduced; this is
@@ -223,9 +428,26 @@ def tex_report(result):
     Args:
         result: The results of the calibration; the dict returned by
             tech_specs().
+        directory: Where to write the report. The plots from plot() are
+            expected in the same directory.
+        filename: The .tex file to write, as for write_report().
     Returns:
         The filename of the final typeset PDF.
     """
+    return typesetting.typeset(write_report(result, directory, filename),
+                               "template-report.tex", PLOTS)
+
+def write_report(result, directory=".", filename=None):
+    """
+    Generate the report for tex_report() without typesetting it.
+
+    Args:
+        filename: The .tex file to write; defaults to the first available
+            report-N.tex in directory.
+
+    Returns:
+        The filename of the generated .tex file.
+    """
     # Format values for printing
     # Dollars
     for key in ("safeworth", "shimworth", "regworth", "totalworth", "safecxs",
@@ -250,41 +472,34 @@ def tex_report(result):
             result[key] = "PROBLEM"
 
     # And "mostrxvrod" is a string, so we leave it as is.
-    with open("template-report.tex") as f:
-        tex = f.read()
-
-    tex = tex % result
-
-    filename = available_filename("report")
-    with open(filename, 'w') as f:
-        f.write(tex)
-
-    subprocess.call(["pdflatex", filename, "-interaction", "batchmode"])
+    return texwriter.template("template-report.tex").fill(
+        filename or available_filename("report", directory), result)
 
-    return filename.replace("tex", "pdf")
-
-def tabular_data(cubics):
+def tabular_data(cubics, step=0.1):
     """
     Transforms a list of three cubics into lists of height-worth tuples for the
     tables in the back of the logbook. Safe and Shim tables start from 48%, Reg
-    table from 0%.
+    table from 0%. For the same tables as arrays, or as files other programs
+    can read, see worthtable.py.
 
     Args:
         cubics: [safe, shim, reg], where each is the integral rod worth fit, as
-            a numpy poly1d instance.
+            a numpy poly1d instance or another curve from fitmodels.py.
+        step: The spacing of the heights, in %.
 
     Returns:
-        [safe, shim, reg], where each is a list of (%, $) increasing by 0.1%
+        [safe, shim, reg], where each is a list of (%, $) increasing by step
             from 0.0% (for the reg) or 48.0% (for the Safe and Shim) to 100.0%.
     """
     result = []
     for n, p in enumerate(cubics):
-        range = np.arange(0.0 if n == 2 else 48.0, 100.0, 0.1)
+        range = np.arange(0.0 if n == 2 else 48.0, 100.0, step)
         table = zip(range, p(range))
         result.append(table)
     return result
 
-def tex_tables(tabular_data, safe_worth, shim_worth, reg_worth):
+def tex_tables(tabular_data, safe_worth, shim_worth, reg_worth,
+               directory=".", filename=None):
     """
     Generate and typeset a printable set of rod worth tables for the back of
     the logbook.
@@ -292,10 +507,29 @@ def tex_tables(tabular_data, safe_worth, shim_worth, reg_worth):
     Args:
         tabular_data: [safe, shim, reg], where each is the increasing list of
             (%, $) returned by tabular_data().
+        directory: Where to write the tables.
+        filename: The .tex file to write, as for write_tables().
 
     Returns:
         The filename of the final typeset PDF.
     """
+    return typesetting.typeset(write_tables(tabular_data, safe_worth,
+                                            shim_worth, reg_worth, directory,
+                                            filename),
+                               "template-worthtable.tex")
+
+def write_tables(tabular_data, safe_worth, shim_worth, reg_worth,
+                 directory=".", filename=None):
+    """
+    Generate the worth tables for tex_tables() without typesetting them.
+
+    Args:
+        filename: The .tex file to write; defaults to the first available
+            worthtable-N.tex in directory.
+
+    Returns:
+        The filename of the generated .tex file.
+    """
     COLUMNS = 8
     safe, shim, reg = tabular_data
     # First half, rounded up to nearest multiple of COLUMNS
@@ -303,25 +537,17 @@ def tex_tables(tabular_data, safe_worth, shim_worth, reg_worth):
     # Everything from there on
     regtwo = reg[len(regone):]
 
-    with open("template-worthtable.tex") as f:
-        tex = f.read()
-
-    tex = tex.replace("(safedata)", tex_one_table(safe, COLUMNS))
-    tex = tex.replace("(shimdata)", tex_one_table(shim, COLUMNS))
-    tex = tex.replace("(regdataone)", tex_one_table(regone, COLUMNS))
-    tex = tex.replace("(regdatatwo)", tex_one_table(regtwo, COLUMNS))
-
-    tex = tex.replace("(safeworth)", "\\${:.2f}".format(safe_worth))
-    tex = tex.replace("(shimworth)", "\\${:.2f}".format(shim_worth))
-    tex = tex.replace("(regworth)", "\\${:.2f}".format(reg_worth))  # twice
-
-    filename = available_filename("worthtable")
-    with open(filename, 'w') as f:
-        f.write(tex)
-
-    subprocess.call(["pdflatex", filename, "-interaction", "batchmode"])
-
-    return filename.replace("tex", "pdf")
+    # The tables are written straight to the file as they're formatted
+    template = texwriter.template("template-worthtable.tex", texwriter.PAREN)
+    filename = filename or available_filename("worthtable", directory)
+    return template.fill(filename, {
+        "safedata": texwriter.worth_table(safe, COLUMNS),
+        "shimdata": texwriter.worth_table(shim, COLUMNS),
+        "regdataone": texwriter.worth_table(regone, COLUMNS),
+        "regdatatwo": texwriter.worth_table(regtwo, COLUMNS),
+        "safeworth": "\\${:.2f}".format(safe_worth),
+        "shimworth": "\\${:.2f}".format(shim_worth),
+        "regworth": "\\${:.2f}".format(reg_worth)})  # twice
 
 def tex_one_table(data, columns):
     """
@@ -333,42 +559,136 @@ def tex_one_table(data, columns):
         columns: The number of tuples wide the table should be.
 
     Returns:
-        The rows of a LaTeX table 2*columns wide.
+        The rows of a LaTeX table 2*columns wide, each ending in LaTeX's \\\\
+        and a hard newline. write_tables() streams the same rows to the file
+        with texwriter.worth_table() instead.
     """
-    rows = int(math.ceil(float(len(data)) / columns))
-    cols = [data[i:i + rows] for i in xrange(0, len(data), rows)]
-    tex = ""
-    for i in xrange(rows):
-        tex += " & ".join("{0:.1f} & \\${1:.2f}".format(*col[i]) if
-                          i < len(col) else " & " for col in cols)
-        tex += "\\\\\n"  # that is, LaTeX's \\ and a hard newline
-    return tex
+    return "".join(texwriter.worth_table(data, columns))
 
-def available_filename(prefix):
+def available_filename(prefix, directory="."):
     """
     Return the first available filename of the form prefix.tex or prefix-N.tex
     where N is a positive integer.
 
     Args:
         prefix: How the filename should start.
+        directory: The directory the file will go in; the returned filename
+            includes it unless it is the current directory.
     """
-    if not os.path.exists("{}.tex".format(prefix)):
-        return "{}.tex".format(prefix)
+    filename = os.path.join(directory, "{}.tex".format(prefix))
+    if not os.path.exists(filename):
+        return os.path.normpath(filename)
 
     i = 1
     while True:
-        filename = "{}-{}.tex".format(prefix, i)
+        filename = os.path.join(directory, "{}-{}.tex".format(prefix, i))
         if not os.path.exists(filename):
-            return filename
+            return os.path.normpath(filename)
         i += 1
 
 
+def together_pulls(safe_critical, shim_critical, pulls):
+    """
+    Turn the pulls from a calibration of the Safe and Shim rods together into
+    separate pull lists for each rod. The Safe rod is pulled and the Shim rod
+    driven in to hold criticality, so each period measures the Safe rod's pull
+    and, read in reverse, the Shim rod's insertion.
+
+    Args:
+        safe_critical: The critical Safe rod height before the first pull.
+        shim_critical: The critical Shim rod height before the first pull.
+        pulls: A list of (safe height after pull, period in seconds, shim
+            height when stable).
+
+    Returns:
+        (safe, shim), each in the form collect_rod() returns.
+    """
+    safe = [safe_critical]
+    shim = [shim_critical]
+    for safe_height, period, shim_height in pulls:
+        safe.append((safe_height, period))
+        shim[0] = (shim[0], period)
+        shim.insert(0, shim_height)
+    return safe, shim
+
+def calibrate(rod_pulls, withdrawal_times, directory=".", typeset_pdf=True,
+              processes=None):
+    """
+    Run the calculation stages of the calibration once data entry is done:
+    fit each rod, plot the fits, and generate the worth tables and report.
+
+    Args:
+        rod_pulls: [safe, shim, reg], each in the form collect_rod() returns.
+        withdrawal_times: List containing the time it takes to pull the [safe,
+            shim, reg] rods all the way out, in seconds.
+        directory: Where to write the plots, tables and report.
+        typeset_pdf: Whether to typeset the tables and report (concurrently),
+            or only generate the .tex files.
+        processes: The number of processes to render the plots with; 1
+            renders them in this process.
+
+    Returns:
+        A dict with the fits ("fits": [safe, shim, reg], each the 4-tuple
+        returned by reactivity_calc()), the Tech Specs results ("tech_specs",
+        as returned by tech_specs()), and the "table_filename" and
+        "report_filename" of the typeset PDFs (or .tex files).
+    """
+    with instrument.stage("reactivity calculation"):
+        reactivity_results = [reactivity_calc(rod[0], rod[1:])
+                              for rod in rod_pulls]
+    [(safe_int, safe_int_data, safe_add, safe_add_data),
+     (shim_int, shim_int_data, shim_add, shim_add_data),
+     (reg_int, reg_int_data, reg_add, reg_add_data)] = reactivity_results
+
+    with instrument.stage("plotting"):
+        render.render_plots(reactivity_results, directory, processes)
+
+    with instrument.stage("table generation"):
+        safe_full = safe_int(0)
+        shim_full = shim_int(0)
+        reg_full = reg_int(0)
+        table_filename = write_tables(
+            tabular_data([safe_int, shim_int, reg_int]), safe_full, shim_full,
+            reg_full, directory)
+
+    with instrument.stage("report generation"):
+        results = tech_specs(safe_int, safe_add, shim_int, shim_add, reg_int,
+                             reg_add, rod_pulls[0][0], rod_pulls[1][0],
+                             withdrawal_times)
+        # write_report() formats the values in place, so give it a copy
+        report_filename = write_report(dict(results), directory)
+
+    if typeset_pdf:
+        with instrument.stage("typesetting"):
+            table_filename, report_filename = typesetting.typeset_all(
+                [(table_filename, "template-worthtable.tex", ()),
+                 (report_filename, "template-report.tex", PLOTS)])
+
+    return {"fits": reactivity_results,
+            "tech_specs": results,
+            "table_filename": table_filename,
+            "report_filename": report_filename}
+
 def collect_rod(start):
     result = [start]
+    # Running estimates after each pull, to catch a bad reading early
+    live = stream.RodStream(start)
     while True:
         height = float(raw_input("Height after pull (percent): "))
         period = float(raw_input("                Period (ms): ")) / 1000.0
+        try:
+            reactivity, rate = live.add(height, period)
+        except ValueError as e:
+            # A pull that doesn't move the rod up, e.g. a height typed twice
+            print "{}; enter the pull again.".format(e.args[0].capitalize())
+            print
+            continue
         result.append((height, period))
+        try:
+            print stream.describe(reactivity, rate, live.estimate())
+        except Exception as e:
+            # The estimates are only a check; they mustn't lose the pulls
+            print "  (no running estimate: {})".format(e)
         print
 
         # Stop if we're full out (100% +/- tolerance defined by SOP)
@@ -377,17 +697,31 @@ def collect_rod(start):
 
 
 def open_file(filename):
+    """
+    Open a file in the desktop's viewer for it, without waiting for the viewer
+    to start.
+
+    Raises:
+        OSError: The viewer couldn't be launched.
+    """
     if sys.platform.startswith("darwin"):
-        subprocess.call(["open", filename])
+        subprocess.Popen(["open", filename])
     elif sys.platform.startswith("win"):
         os.startfile(filename)
     elif sys.platform.startswith("linux"):
-        subprocess.call(["xdg-open", filename])
+        subprocess.Popen(["xdg-open", filename])
     # Couldn't identify the platform -- give up on opening the file.
 
 
-def main():
-    # Data entry stage
+def enter_data():
+    """
+    Prompt for the calibration data from SOP 34A.
+
+    Returns:
+        (rod_pulls, withdrawal_times): [safe, shim, reg], each in the form
+        collect_rod() returns, and the rod withdrawal times in seconds. None
+        if the calibration mode wasn't recognized.
+    """
     print "This program will prompt you to enter data from SOP 34A (Control Rod"
     print "Calibration Form). You should already have filled it out, through"
     print "the bottom of Page 3. Not all the values on the form will be used."
@@ -423,8 +757,7 @@ def main():
                             "Safe: ", "Shim: ", " Reg: "]
         print
 
-        safe = [critical_heights[0]]
-        shim = [critical_heights[1]]
+        pulls = []
         while True:
             safe_height = float(raw_input(" Safe height after pull (percent): "))
             period = (float(raw_input("                      Period (ms): ")) /
@@ -432,12 +765,13 @@ def main():
             shim_height = float(raw_input("Shim height when stable (percent): "))
             print
 
-            safe.append((safe_height, period))
-            shim[0] = (shim[0], period)
-            shim.insert(0, shim_height)
+            pulls.append((safe_height, period, shim_height))
             if safe_height > 99.4:
                 break
 
+        safe, shim = together_pulls(critical_heights[0], critical_heights[1],
+                                    pulls)
+
     elif together == "2":
         print "Critical rod heights with Safe at bottom (percent)"
         print "--------------------------------------------------"
@@ -458,33 +792,122 @@ def main():
         shim = collect_rod(critical_heights[1])
 
     else:
-        return
+        return None
 
-    rod_pulls = [safe, shim, reg]
+    return [safe, shim, reg], withdrawal_times
 
-    # Done with data entry: start calculating.
-    reactivity_results = [reactivity_calc(rod[0], rod[1:]) for rod in rod_pulls]
-    [(safe_int, safe_int_data, safe_add, safe_add_data),
-     (shim_int, shim_int_data, shim_add, shim_add_data),
-     (reg_int, reg_int_data, reg_add, reg_add_data)] = reactivity_results
+def main():
+    parser = argparse.ArgumentParser(
+        description="Calculate control rod worths from SOP 34A data.")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="append per-stage timings to FILE as JSON lines "
+                             "('-' for standard error)")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write a cProfile dump per stage into DIR")
+    parser.add_argument("--input", metavar="RECORD",
+                        help="read the data from a record file (as for "
+                             "batch.py; the first record is used) instead "
+                             "of prompting for it")
+    parser.add_argument("--output", metavar="DIR",
+                        help="write everything into DIR, saving the data as "
+                             "DIR/input.json; a later run into the same DIR "
+                             "only recomputes what its changes affect")
+    parser.add_argument("--history", metavar="FILE",
+                        help="the calibration history to record the run in "
+                             "(default: rodcal-history.sqlite)")
+    parser.add_argument("--no-history", action="store_true",
+                        help="don't record the run; name the outputs by the "
+                             "first unused number instead")
+    parser.add_argument("--export", metavar="FORMATS",
+                        help="also write the results as any of csv,json,html "
+                             "(comma-separated; see export.py)")
+    parser.add_argument("--no-pdf", action="store_true",
+                        help="only write the --export files: no plots, TeX "
+                             "or pdflatex")
+    args = parser.parse_args()
+    formats = []
+    if args.export:
+        try:
+            formats = export.parse_formats(args.export)
+        except ValueError as e:
+            parser.error(str(e))
+    if args.no_pdf and not formats:
+        parser.error("--no-pdf needs --export")
+    instrument.configure(args.trace, args.profile)
+
+    if args.input:
+        record = batch.load_records(args.input)[0]
+        rod_pulls = batch.rod_pulls(record)
+        withdrawal_times = record["withdrawal_times"]
+    else:
+        with instrument.stage("data entry"):
+            data = enter_data()
+        if data is None:
+            return
+        rod_pulls, withdrawal_times = data
+        record = batch.make_record(time.strftime("%Y%m%d-%H%M%S"), rod_pulls,
+                                   withdrawal_times)
+    instrument.set_calibration(record["id"])
+
+    # Done with data entry: record it, and name the outputs by its ID
+    filenames = {}
+    name = None
+    if not args.no_history:
+        with history.History(args.history or history.FILENAME) as store:
+            calibration_id = store.add(record)
+            print "Calibration {} in {}".format(calibration_id,
+                                                store.filename)
+            name = store.artifact_name(calibration_id)
+            for kind, prefix in [("table", "worthtable"),
+                                 ("report", "report"),
+                                 ("bank", "banktable")]:
+                filenames[kind] = store.artifact(calibration_id, prefix)
+
+    if args.output:
+        if not os.path.isdir(args.output):
+            os.makedirs(args.output)
+        # Correct this and re-run with --input to redo only what changed
+        with open(os.path.join(args.output, "input.json"), "w") as f:
+            json.dump(record, f, indent=2, sort_keys=True)
+
+    if args.no_pdf:
+        calibration = export.calibrate(rod_pulls, withdrawal_times,
+                                       args.output or ".", formats,
+                                       record.get("banks"), name)
+        for filename in calibration["filenames"]:
+            print "Filename: " + filename
+        return
+
+    if args.output:
+        calibration = incremental.calibrate(rod_pulls, withdrawal_times,
+                                            args.output)
+        print "Recomputed: " + (", ".join(calibration["recomputed"]) or
+                                "nothing")
+        if formats:
+            banks = record.get("banks")
+            for filename in export.write(
+                    args.output, formats, calibration["tech_specs"],
+                    tabular_data([fit[0] for fit in calibration["fits"]]),
+                    export.bank_data(banks) if banks else None,
+                    name):
+                print "Filename: " + filename
+        for filename in (calibration["table_filename"],
+                         calibration["report_filename"]):
+            print "Filename: " + filename
+            open_file(filename)
+        return
 
-    for rod, result in zip(["safe", "shim", "reg"], reactivity_results):
-        plot(*((rod,) + result))
-
-    safe_full = safe_int(0)
-    shim_full = shim_int(0)
-    reg_full = reg_int(0)
-    table_filename = tex_tables(tabular_data([safe_int, shim_int, reg_int]),
-                                safe_full, shim_full, reg_full)
-    print "Filename: " + table_filename
-    open_file(table_filename)
-
-    report_filename = tex_report(tech_specs(safe_int, safe_add, shim_int,
-                                            shim_add, reg_int, reg_add,
-                                            rod_pulls[0][0], rod_pulls[1][0],
-                                            withdrawal_times))
-    print "Filename: " + report_filename
-    open_file(report_filename)
+    # Generate everything concurrently, opening each PDF as it's ready
+    start = time.time()
+    calibration, tasks = orchestrate.calibrate(
+        rod_pulls, withdrawal_times, banks=record.get("banks"),
+        viewer=open_file, filenames=filenames, exports=formats,
+        name=name)
+    for filename in calibration["export_filenames"]:
+        print "Filename: " + filename
+    print orchestrate.summary(tasks, time.time() - start)
+    if any(task.status != "ok" for task in tasks):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main()
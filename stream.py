@@ -0,0 +1,329 @@
+# Live calibration of one rod, pull by pull
+#
+# Pulls are read as they're made, from a pipe, a file being written to, or a
+# local socket, and each one updates the rod's reactivity, integral worth and
+# cubic fits straight away, so an odd period shows up in the running
+# estimates mid-procedure rather than after the rod is fully out. Usage:
+#
+#     python stream.py --bottom 12.3 [FILE | -]      # a file, or a pipe
+#     python stream.py --bottom 12.3 --follow FILE   # tail a growing file
+#     python stream.py --bottom 12.3 --socket PATH   # listen on a Unix socket
+#
+# Each input line is a pull, "height period", with the height in % and the
+# period in ms as on SOP 34A, separated by whitespace or a comma. A line with
+# a single number gives the critical height the pulls start from, in place of
+# --bottom. Blank lines and lines starting with # are ignored, and a pull that
+# doesn't move the rod up is reported and skipped. Input ends at the first
+# pull above 99.4%, as in rodcal.collect_rod().
+#
+# The fits aren't redone from scratch for each pull. Both are least-squares
+# cubics, so they are kept as running sums for the normal equations, in the
+# height scaled to u = x/100 so the equations stay well conditioned. The
+# integral worth points are the trouble: each pull adds to every point below
+# it. But with T the worth measured so far and C_i the worth of the pulls
+# before point i, point i is T - C_i, so its share of the right-hand side is
+# T * sum(u_i^k) - sum(u_i^k * C_i), and both sums only ever gain terms.
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+
+import rodcal
+
+# Seconds between checks for new lines when following a file
+POLL_INTERVAL = 0.1
+
+
+class CubicSums(object):
+    """
+    The sums behind the normal equations of a least-squares cubic, in the
+    scaled height u = x/100.
+    """
+    def __init__(self):
+        # sum(u^k) for k = 0..6: the normal matrix is powers[k + l]
+        self.powers = [0.0] * 7
+        # sum(u^k * y) for k = 0..3: the right-hand side
+        self.moments = [0.0] * 4
+
+    def add(self, x, y=0.0):
+        """
+        Add a point, returning its [1, u, u^2, u^3].
+        """
+        u = x / 100.0
+        power = 1.0
+        powers = self.powers
+        for k in xrange(7):
+            powers[k] += power
+            if k < 4:
+                self.moments[k] += power * y
+            power *= u
+        return [1.0, u, u * u, u * u * u]
+
+    def solve(self, moments=None):
+        """
+        Solve the normal equations.
+
+        Args:
+            moments: The right-hand side, if not self.moments.
+
+        Returns:
+            The cubic as a np.poly1d in x, or None while there are too few
+            points to fit one.
+        """
+        if self.powers[0] < 4:
+            return None
+        p = self.powers
+        normal = np.array([p[0:4], p[1:5], p[2:6], p[3:7]])
+        coefficients = np.linalg.solve(
+            normal, self.moments if moments is None else moments)
+        # Back from u to x, highest power first
+        return np.poly1d((coefficients / 100.0 ** np.arange(4))[::-1])
+
+
+class RodStream(object):
+    """
+    One rod's calibration, updated as each pull comes in. The fits agree with
+    rodcal.reactivity_calc() on the same pulls, to within rounding.
+    """
+    def __init__(self, bottom):
+        """
+        Args:
+            bottom: The critical height the pulls start from, in %.
+        """
+        self.bottom = bottom
+        self.pulls = []
+        # The worth measured so far, in dollars
+        self.total = 0.0
+
+        # Integral worth: the points are (start of pull i, total - before_i),
+        # where before_i is the worth of the pulls before pull i; keep
+        # sum(u_i^k) and sum(u_i^k * before_i), and the clamp at 100%.
+        self.integral_sums = CubicSums()
+        self.integral_sums.add(100.0)
+        self.before = [0.0] * 4
+
+        # Addition rate, with its clamps at the bottom and top
+        self.rate_sums = CubicSums()
+        self.rate_sums.add(0.0)
+        self.rate_sums.add(100.0)
+
+    def add(self, height, period):
+        """
+        Add a pull.
+
+        Args:
+            height: The height at the top of the pull, in %.
+            period: The stable period following it, in seconds.
+
+        Returns:
+            The pull's (reactivity in dollars, addition rate in $/%).
+
+        Raises:
+            ValueError: The pull doesn't move the rod up. It isn't added.
+        """
+        start = self.pulls[-1][0] if self.pulls else self.bottom
+        if not height > start:
+            raise ValueError("a pull must move the rod up from {:g}%, not to "
+                             "{:g}%".format(start, height))
+        reactivity = float(rodcal.inhour(period))
+        rate = reactivity / (height - start)
+
+        terms = self.integral_sums.add(start)
+        for k in xrange(4):
+            self.before[k] += terms[k] * self.total
+        self.total += reactivity
+        self.rate_sums.add((start + height) / 2.0, rate)
+
+        self.pulls.append((height, period))
+        return reactivity, rate
+
+    def integral_fit(self):
+        """
+        The integral worth fit so far, as a np.poly1d, or None before there
+        are enough pulls.
+        """
+        # Every point but the clamp at 100% carries the total
+        counts = self.integral_sums.powers[:4]
+        moments = [self.total * (count - 1.0) - before
+                   for count, before in zip(counts, self.before)]
+        return self.integral_sums.solve(moments)
+
+    def addition_rate_fit(self):
+        """
+        The addition rate fit so far, as a np.poly1d, or None before there are
+        enough pulls.
+        """
+        return self.rate_sums.solve()
+
+    def estimate(self):
+        """
+        Running estimates after the latest pull.
+
+        Returns:
+            A dict of the worth "measured" so far, the fitted "total" worth
+            (the integral fit at 0%), the fitted "max_rate" and the "height"
+            it's at, all None before there are enough pulls.
+        """
+        estimate = {"measured": self.total, "total": None, "max_rate": None,
+                    "height": None}
+        integral_fit = self.integral_fit()
+        if integral_fit is not None:
+            estimate["total"] = integral_fit(0)
+        rate_fit = self.addition_rate_fit()
+        if rate_fit is not None:
+            heights = np.linspace(0, 100, 1001)
+            rates = rate_fit(heights)
+            estimate["max_rate"] = rates.max()
+            estimate["height"] = heights[rates.argmax()]
+        return estimate
+
+    def collected(self):
+        """
+        The pulls so far, in the form rodcal.collect_rod() returns.
+        """
+        return [self.bottom] + list(self.pulls)
+
+
+def describe(reactivity, rate, estimate):
+    """
+    One line of running estimates for the operator.
+    """
+    line = "  pull ${:.3f} at {:.3f} $/%  |  measured ${:.3f}".format(
+        reactivity, rate, estimate["measured"])
+    if estimate["total"] is not None:
+        line += "  fit total ${:.3f}".format(estimate["total"])
+    if estimate["max_rate"] is not None:
+        line += "  max {:.3f} $/% at {:.0f}%".format(estimate["max_rate"],
+                                                      estimate["height"])
+    return line
+
+def parse(line):
+    """
+    Parse an input line into a tuple of numbers, or None to skip it.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    return tuple(float(field) for field in line.replace(",", " ").split())
+
+def follow(f):
+    """
+    Yield lines from a file as they're written to it, like tail -f.
+    """
+    while True:
+        line = f.readline()
+        if line:
+            yield line
+        else:
+            time.sleep(POLL_INTERVAL)
+
+def listen(path):
+    """
+    Yield lines from the first client to connect to a Unix socket at path.
+    """
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if os.path.exists(path):
+        os.remove(path)
+    server.bind(path)
+    server.listen(1)
+    try:
+        connection, _ = server.accept()
+        f = connection.makefile("r")
+        try:
+            for line in iter(f.readline, ""):
+                yield line
+        finally:
+            f.close()
+            connection.close()
+    finally:
+        server.close()
+        os.remove(path)
+
+def run(lines, bottom=None, out=sys.stdout):
+    """
+    Calibrate a rod from a stream of input lines, printing running estimates
+    after each pull.
+
+    Args:
+        lines: An iterable of input lines.
+        bottom: The critical height the pulls start from, unless the input
+            gives it.
+        out: Where to print.
+
+    Returns:
+        The RodStream, or None if the input ended before any pulls.
+    """
+    rod = None if bottom is None else RodStream(bottom)
+    for line in lines:
+        values = parse(line)
+        if values is None:
+            continue
+        if len(values) == 1:
+            rod = RodStream(values[0])
+            continue
+        if rod is None:
+            raise ValueError("pull before the critical height: " +
+                             line.strip())
+
+        height, period = values[:2]
+        start = time.time()
+        try:
+            reactivity, rate = rod.add(height, period / 1000.0)
+        except ValueError as e:
+            print >>out, "Skipped {}: {}".format(line.strip(), e)
+            continue
+        estimate = rod.estimate()
+        elapsed = time.time() - start
+        print >>out, "{:6.1f}% {:9.0f} ms".format(height, period)
+        print >>out, describe(reactivity, rate, estimate) + \
+            "  ({:.0f} us)".format(elapsed * 1e6)
+        out.flush()
+
+        # Stop if we're full out (100% +/- tolerance defined by SOP)
+        if height > 99.4:
+            break
+    return rod
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Calibrate a rod live, printing running estimates of its "
+                    "worth after each pull.")
+    parser.add_argument("input", nargs="?", default="-",
+                        help="file to read pulls from, or - for standard "
+                             "input (the default)")
+    parser.add_argument("--bottom", type=float,
+                        help="critical height the pulls start from, in %%")
+    parser.add_argument("--follow", action="store_true",
+                        help="keep reading the file as it grows")
+    parser.add_argument("--socket", metavar="PATH",
+                        help="listen on a Unix socket at PATH and read pulls "
+                             "from the first connection")
+    args = parser.parse_args()
+
+    if args.socket:
+        lines = listen(args.socket)
+    elif args.input == "-":
+        lines = iter(sys.stdin.readline, "")
+    else:
+        f = open(args.input)
+        lines = follow(f) if args.follow else f
+
+    rod = run(lines, args.bottom)
+    if rod is None or not rod.pulls:
+        sys.exit("No pulls read")
+
+    integral_fit, _, addition_rate_fit, _ = rodcal.reactivity_calc(
+        rod.bottom, rod.pulls)
+    print
+    print "Total worth: ${:.2f}".format(integral_fit(0))
+    print "Integral worth fit: {}".format(
+        " ".join("{:.6g}".format(c) for c in integral_fit.c))
+    print "Addition rate fit:  {}".format(
+        " ".join("{:.6g}".format(c) for c in addition_rate_fit.c))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+# What-if sweeps of the Tech Specs checks
+#
+# rodcal.tech_specs() checks one calibration. For planning, sweep the same
+# checks over thousands of scenarios at once: other withdrawal times, other
+# critical heights, rods worth more or less than they were measured to be
+# (as after a core change), or perturbed fits from reactivity_calc_batch().
+# Every quantity and OK flag is computed as an array over the scenarios, and
+# the numbers are kept apart from the TeX formatting, so only the scenarios
+# that are reported pay for it. Usage:
+#
+#     python sweep.py records.json --safe-time 10:60:1 --shim-critical 40:70:0.5
+#                     [--safe-scale 0.9:1.1:0.01] [--reports 3 -o sweeps]
+#
+# Each swept axis is start:stop:step (inclusive) or a comma-separated list;
+# every combination of the axes' values is a scenario. Axes not swept stay at
+# the record's values. The output says, for each limit, which values of each
+# axis have a scenario that fails it.
+
+import argparse
+import os
+
+import numpy as np
+
+import fitmodels
+import rodcal
+
+RODS = ["safe", "shim", "reg"]
+
+# The Tech Specs limits: (flag, quantities, "<" or ">" the limit, limit,
+# description). A flag is OK when all its quantities are within the limit.
+LIMITS = [
+    ("safedpsok", ["safemaxdps"], "<", 12, "Safe addition rate"),
+    ("shimdpsok", ["shimmaxdps"], "<", 12, "Shim addition rate"),
+    ("regdpsok", ["regmaxdps"], "<", 12, "Reg addition rate"),
+    ("cxsok", ["safecxs", "shimcxs"], "<", 3, "Core excess"),
+    ("sdmok", ["safesdm", "shimsdm"], ">", 1, "Shutdown margin"),
+    ("osrok", ["safeosr", "shimosr"], ">", 0.5, "One-stuck-rod SDM"),
+]
+
+# What can be swept, with units: each rod's withdrawal time, the Safe and
+# Shim critical heights, and a factor on each rod's worth
+AXES = [("safe_time", "s"), ("shim_time", "s"), ("reg_time", "s"),
+        ("safe_critical", "%"), ("shim_critical", "%"),
+        ("safe_scale", ""), ("shim_scale", ""), ("reg_scale", "")]
+
+
+def tech_spec_values(fits, safe_critical, shim_critical, withdrawal_times):
+    """
+    The numeric part of rodcal.tech_specs(), over any number of scenarios.
+
+    Every input may be given per scenario or once for all of them; they're
+    broadcast against each other.
+
+    Args:
+        fits: A dict from rod to (integral coefficients, addition rate
+            coefficients), each of shape (scenarios, 4) or (4,), highest
+            power first as in np.poly1d.c.
+        safe_critical, shim_critical: Critical heights, shape (scenarios,)
+            or scalars.
+        withdrawal_times: The [safe, shim, reg] withdrawal times, each shape
+            (scenarios,) or a scalar.
+
+    Returns:
+        A dict from each of tech_specs()'s numeric keys, and each flag in
+        LIMITS, to an array over the scenarios; "safestuck" is whether the
+        Safe rod is the most reactive (mostrxvrod), and "ok" whether every
+        limit is met. Addition rates whose fit has no maximum within 0-100%
+        are NaN, and fail.
+    """
+    result = {}
+    for rod, time in zip(RODS, withdrawal_times):
+        int_c, add_c = [np.atleast_2d(np.asarray(c, dtype=float))
+                        for c in fits[rod]]
+        # The integral worth at 0% is the constant term
+        result[rod + "worth"] = int_c[:, -1]
+        result[rod + "maxdpp"] = _max_in_range(add_c) * 100
+        result[rod + "maxdps"] = (result[rod + "maxdpp"] * 100 /
+                                  np.asarray(time, dtype=float))
+    result["totalworth"] = (result["safeworth"] + result["shimworth"] +
+                            result["regworth"])
+
+    for rod, critical in [("safe", safe_critical), ("shim", shim_critical)]:
+        critical = np.asarray(critical, dtype=float)
+        result[rod + "cxsht"] = critical
+        result[rod + "cxs"] = _polyval(
+            np.atleast_2d(np.asarray(fits[rod][0], dtype=float)), critical)
+    result["safestuck"] = result["safeworth"] > result["shimworth"]
+    stuckrod = np.maximum(result["safeworth"], result["shimworth"])
+    for rod in ["safe", "shim"]:
+        result[rod + "sdm"] = result["totalworth"] - result[rod + "cxs"]
+        result[rod + "osr"] = result[rod + "sdm"] - stuckrod
+
+    # NaN compares False either way, so a missing value fails its limit
+    ok = True
+    for flag, quantities, sense, limit, _ in LIMITS:
+        passes = True
+        for name in quantities:
+            if sense == "<":
+                passes = passes & (result[name] < limit)
+            else:
+                passes = passes & (result[name] > limit)
+        result[flag] = passes
+        ok = ok & passes
+    result["ok"] = ok
+
+    shape = np.broadcast(*[np.asarray(value)
+                           for value in result.values()]).shape
+    return dict((name, np.broadcast_to(value, shape))
+                for name, value in result.items())
+
+def _polyval(coeffs, x):
+    """
+    Evaluate a stack of cubics, shape (n, 4), each at its own x, shape (n,).
+    """
+    result = coeffs[:, 0]
+    for i in xrange(1, coeffs.shape[1]):
+        result = result * x + coeffs[:, i]
+    return result
+
+def _max_in_range(coeffs):
+    """
+    The maximum of each cubic in a stack, shape (n, 4), at its turning points
+    within 0-100%. NaN where there is no turning point in range.
+    """
+    # Roots of the derivative, 3a x^2 + 2b x + c
+    a = 3 * coeffs[:, 0]
+    b = 2 * coeffs[:, 1]
+    c = coeffs[:, 2]
+    discriminant = b * b - 4 * a * c
+    root = np.sqrt(np.where(discriminant >= 0, discriminant, np.nan))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        candidates = np.stack([(-b + root) / (2 * a), (-b - root) / (2 * a)])
+        candidates = np.where(a == 0, -c / np.where(b == 0, np.nan, b),
+                              candidates)
+
+    values = np.stack([_polyval(coeffs, x) for x in candidates])
+    with np.errstate(invalid="ignore"):
+        in_range = (candidates >= 0) & (candidates <= 100)
+    values = np.where(in_range, values, -np.inf)
+    best = values.max(axis=0)
+    return np.where(np.isfinite(best), best, np.nan)
+
+def grid(fits, safe_critical, shim_critical, withdrawal_times, axes):
+    """
+    Sweep the Tech Specs checks over every combination of values of some
+    AXES, starting from one calibration.
+
+    Args:
+        fits: [safe, shim, reg], each a 4-tuple as reactivity_calc() returns.
+        safe_critical, shim_critical: The calibration's critical heights.
+        withdrawal_times: Its [safe, shim, reg] withdrawal times.
+        axes: A dict from names in AXES to sequences of values to sweep.
+
+    Returns:
+        (parameters, values): dicts from every name in AXES, and from every
+        name tech_spec_values() returns, to arrays over the scenarios.
+
+    Raises:
+        ValueError: An axis isn't one of AXES, or a fit isn't a polynomial.
+    """
+    nominal = {"safe_critical": safe_critical,
+               "shim_critical": shim_critical,
+               "safe_scale": 1.0, "shim_scale": 1.0, "reg_scale": 1.0}
+    for rod, time in zip(RODS, withdrawal_times):
+        nominal[rod + "_time"] = time
+    for name in axes:
+        if name not in nominal:
+            raise ValueError("can't sweep {}; choose from {}".format(
+                name, ", ".join(axis for axis, _ in AXES)))
+
+    names = [name for name, _ in AXES if name in axes]
+    mesh = np.meshgrid(*[np.asarray(axes[name], dtype=float)
+                         for name in names], indexing="ij")
+    scenarios = mesh[0].size if mesh else 1
+    parameters = dict((name, np.full(scenarios, float(value)))
+                      for name, value in nominal.items())
+    for name, values in zip(names, mesh):
+        parameters[name] = values.ravel()
+
+    # Scaling a rod's worth scales both its fits
+    scaled = {}
+    for rod, (integral_fit, _, addition_rate_fit, _) in zip(RODS, fits):
+        scale = parameters[rod + "_scale"][:, np.newaxis]
+        integral_fit = fitmodels.polynomial(integral_fit, "The sweep")
+        addition_rate_fit = fitmodels.polynomial(addition_rate_fit,
+                                                 "The sweep")
+        scaled[rod] = (scale * np.asarray(integral_fit.c, dtype=float),
+                       scale * np.asarray(addition_rate_fit.c, dtype=float))
+
+    values = tech_spec_values(scaled, parameters["safe_critical"],
+                              parameters["shim_critical"],
+                              [parameters[rod + "_time"] for rod in RODS])
+    values["fits"] = scaled
+    return parameters, values
+
+def failing(parameters, values, flag, axis):
+    """
+    The values of one axis at which some scenario fails a limit.
+
+    Args:
+        parameters, values: As grid() returns.
+        flag: A flag in LIMITS.
+        axis: A name in AXES.
+
+    Returns:
+        (swept, fails): the axis's distinct values, sorted, and whether each
+        has a failing scenario.
+    """
+    swept, index = np.unique(parameters[axis], return_inverse=True)
+    fails = np.bincount(index, ~values[flag], minlength=len(swept)) > 0
+    return swept, fails
+
+def report_values(values, index):
+    """
+    One scenario's results in the form rodcal.tech_specs() returns them,
+    ready for rodcal.write_report().
+
+    Args:
+        values: As grid() returns, or tech_spec_values() plus "fits" as
+            passed to it.
+        index: The scenario.
+    """
+    result = {}
+    for name, value in values.items():
+        if name not in ("fits", "safestuck", "ok"):
+            result[name] = value[index].item()
+    result["mostrxvrod"] = ("Safe Rod" if values["safestuck"][index]
+                            else "Shim Rod")
+    for rod in RODS:
+        for kind, coeffs in zip(["int", "add"], values["fits"][rod]):
+            coeffs = np.atleast_2d(coeffs)
+            poly = np.poly1d(coeffs[index if len(coeffs) > 1 else 0])
+            result[rod + kind + "poly"] = rodcal.tex_polynomial(poly)
+            result[rod + kind + "poly_coefficients"] = (
+                rodcal.poly_coefficients(poly))
+    return result
+
+def parse_axis(text):
+    """
+    Parse an axis given as start:stop:step, inclusive, or as a
+    comma-separated list of values.
+    """
+    if ":" in text:
+        start, stop, step = [float(part) for part in text.split(":")]
+        # Allow for rounding in the last step
+        return np.arange(start, stop + step / 2.0, step)
+    return np.array([float(value) for value in text.split(",")])
+
+def _ranges(swept, fails):
+    """
+    Describe where fails is True as ranges of the swept values.
+    """
+    edges = np.diff(np.concatenate(([0], fails.astype(np.int8), [0])))
+    ranges = []
+    for start, end in zip(np.flatnonzero(edges == 1),
+                          np.flatnonzero(edges == -1)):
+        if end - start == 1:
+            ranges.append("{:g}".format(swept[start]))
+        else:
+            ranges.append("{:g} to {:g}".format(swept[start], swept[end - 1]))
+    return ", ".join(ranges)
+
+def main():
+    import batch
+
+    parser = argparse.ArgumentParser(
+        description="Sweep the Tech Specs checks over what-if scenarios.")
+    parser.add_argument("files", nargs="+",
+                        help="JSON or CSV files of calibration records, as "
+                             "for batch.py")
+    for name, units in AXES:
+        parser.add_argument("--" + name.replace("_", "-"), metavar="RANGE",
+                            help="sweep the {}{} over start:stop:step or a "
+                                 "list".format(name.replace("_", " "),
+                                               " in " + units.replace(
+                                                   "%", "%%")
+                                               if units else ""))
+    parser.add_argument("--reports", type=int, default=0, metavar="N",
+                        help="write a report for each of the first N failing "
+                             "scenarios")
+    parser.add_argument("-o", "--output", default=".",
+                        help="directory for the reports (default: current)")
+    args = parser.parse_args()
+
+    axes = {}
+    for name, _ in AXES:
+        text = getattr(args, name)
+        if text:
+            axes[name] = parse_axis(text)
+
+    for filename in args.files:
+        for record in batch.load_records(filename):
+            rod_pulls = batch.rod_pulls(record)
+            fits = [rodcal.reactivity_calc(pulls[0], pulls[1:])
+                    for pulls in rod_pulls]
+            parameters, values = grid(fits, rod_pulls[0][0], rod_pulls[1][0],
+                                      record["withdrawal_times"], axes)
+            scenarios = len(values["ok"])
+            print "{}: {} of {} scenarios meet every limit".format(
+                record["id"], int(values["ok"].sum()), scenarios)
+            for flag, _, sense, limit, description in LIMITS:
+                fails = int((~values[flag]).sum())
+                print "  {:<20} {} {:<4g} fails in {} scenarios".format(
+                    description, sense, limit, fails)
+                if not fails:
+                    continue
+                for name in sorted(axes, key=[axis for axis, _ in
+                                              AXES].index):
+                    swept, failed = failing(parameters, values, flag, name)
+                    print "    at {}: {}".format(name, _ranges(swept,
+                                                                failed))
+
+            failures = np.flatnonzero(~values["ok"])[:args.reports]
+            if len(failures):
+                directory = os.path.join(args.output, str(record["id"]))
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+            for index in failures:
+                report = rodcal.write_report(report_values(values, index),
+                                             directory)
+                print "  Scenario {} ({}): {}".format(
+                    index, ", ".join("{}={:g}".format(name,
+                                                      parameters[name][index])
+                                     for name in sorted(axes)), report)
+            print
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+# Tests for archive.py's columnar store of ingested calibrations.
+# Usage:
+#
+#     python -m unittest discover tests
+
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import archive
+
+
+def worth_table(scale):
+    heights = np.arange(0.0, 100.0, 10.0)
+    return dict([(rod, (heights, scale * (100.0 - heights)))
+                 for rod in archive.RODS] + [("totals", {})])
+
+
+class ReingestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_changed_files_replace_their_rows(self):
+        with archive.Archive(self.directory) as store:
+            store.add("a/report-1.tex", "report", "a/1", {"totalworth": 7.0})
+            store.add("a/report-2.tex", "report", "a/2", {"totalworth": 8.0})
+            store.add("a/worthtable-1.tex", "worthtable", "a/1",
+                      worth_table(1.0))
+            # The same files again, changed
+            for scale in [2.0, 3.0]:
+                store.add("a/report-1.tex", "report", "a/1",
+                          {"totalworth": 7.0 * scale})
+                store.add("a/worthtable-1.tex", "worthtable", "a/1",
+                          worth_table(scale))
+
+        # Whole columns, and each calibration, hold only the latest rows,
+        # after reopening too
+        store = archive.Archive(self.directory)
+        np.testing.assert_array_equal(
+            store.store.column("report", "totalworth"), [8.0, 21.0])
+        np.testing.assert_array_equal(
+            store.store.column("report", "calibration"), [1, 0])
+        self.assertEqual(store.store.rows("worth"), 30)
+        np.testing.assert_array_equal(store.store.column("worth", "worth"),
+                                      np.tile(worth_table(3.0)["safe"][1], 3))
+        self.assertEqual(store.report("a/1")["totalworth"], 21.0)
+        np.testing.assert_array_equal(store.worth("a/1", "reg")[1],
+                                      worth_table(3.0)["reg"][1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+# Tests for export.py's machine-readable outputs.
+# Usage:
+#
+#     python -m unittest discover tests
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import export
+import rodcal
+from benchmarks import synthetic
+
+
+class WriteTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rod_pulls, withdrawal_times = synthetic.calibration(
+            np.random.RandomState(0))
+        self.fits = [rodcal.reactivity_calc(rod[0], rod[1:])
+                     for rod in rod_pulls]
+        [(safe_int, _, safe_add, _), (shim_int, _, shim_add, _),
+         (reg_int, _, reg_add, _)] = self.fits
+        self.result = rodcal.tech_specs(safe_int, safe_add, shim_int,
+                                        shim_add, reg_int, reg_add,
+                                        rod_pulls[0][0], rod_pulls[1][0],
+                                        withdrawal_times)
+        self.worth_tables = rodcal.tabular_data([safe_int, shim_int, reg_int])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fit_coefficients(self):
+        export.write(self.directory, ["csv", "json"], self.result,
+                     self.worth_tables)
+        with open(os.path.join(self.directory, "techspecs.json")) as f:
+            written = json.load(f)
+        with open(os.path.join(self.directory, "techspecs.csv")) as f:
+            rows = dict(line.split(",", 2)[:2] for line in f)
+        for rod, (integral_fit, _, addition_rate_fit, _) in zip(
+                export.RODS, self.fits):
+            for kind, fit in [("int", integral_fit),
+                              ("add", addition_rate_fit)]:
+                key = rod + kind + "poly_coefficients"
+                np.testing.assert_array_equal(written[key], fit.c)
+                np.testing.assert_allclose(
+                    [float(c) for c in rows[key].split()], fit.c, rtol=1e-9)
+
+    def test_blank_bank_cells(self):
+        bank = {"xenon_free": 0.5,
+                "powers": np.array([0.0, 100.0]),
+                "core_excesses": np.array([0.5, 1.0]),
+                "heights": np.array([[50.0, 70.0], [101.0, np.nan]])}
+        page = export.html(self.result, self.worth_tables, bank)
+        self.assertNotIn("nan", page)
+        self.assertIn("<th>1.00</th><td></td><td></td></tr>", page)
+        self.assertIn("<td>50.0</td><td>70.0</td></tr>", page)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# Tests for using fitmodels.py's curves in place of the usual cubic fits.
+# Usage:
+#
+#     python -m unittest discover tests
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import export
+import fitmodels
+import inverse
+import render
+import rodbank
+import rodcal
+import sweep
+import worthtable
+from benchmarks import synthetic
+
+
+class ModelConsumersTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.rod_pulls, self.withdrawal_times = synthetic.calibration(
+            np.random.RandomState(0))
+        self.fits = dict(
+            (name, [rodcal.reactivity_calc(rod[0], rod[1:], model=model)
+                    for rod in self.rod_pulls])
+            for name, model in fitmodels.MODELS.items())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_any_curve_plots_tabulates_and_exports(self):
+        for fits in self.fits.values():
+            integral_fit, integral, addition_rate_fit, _ = fits[2]
+            render.render_one(os.path.join(self.directory, "plot.png"),
+                              integral_fit, integral, "Integral Worth ($)")
+
+            filename = worthtable.save(
+                os.path.join(self.directory, "reg.rodworth"), "reg",
+                integral_fit, 0.0)
+            table = worthtable.MappedWorthTable(filename)
+            np.testing.assert_allclose(table.worth([10.0, 50.0]),
+                                       integral_fit([10.0, 50.0]))
+            self.assertEqual(table.fit is None,
+                             not isinstance(integral_fit, np.poly1d))
+            del table
+
+            ints = [fit[0] for fit in fits]
+            adds = [fit[2] for fit in fits]
+            result = rodcal.tech_specs(
+                ints[0], adds[0], ints[1], adds[1], ints[2], adds[2],
+                self.rod_pulls[0][0], self.rod_pulls[1][0],
+                self.withdrawal_times)
+            self.assertTrue(np.isfinite(result["totalworth"]))
+            export.write(self.directory, export.FORMATS, result,
+                         rodcal.tabular_data(ints))
+
+    def test_coefficient_users_refuse_other_curves(self):
+        for fits in self.fits.values():
+            integral_fit = fits[0][0]
+            polynomial = isinstance(integral_fit, np.poly1d)
+            for use in [
+                    lambda: inverse.MonotoneIndex(integral_fit, 50.0, 90.0),
+                    lambda: rodbank.RodHeightEvaluator(integral_fit,
+                                                       integral_fit),
+                    lambda: sweep.grid(fits, 60.0, 60.0,
+                                       self.withdrawal_times, {})]:
+                if polynomial:
+                    use()
+                else:
+                    self.assertRaises(ValueError, use)
+
+
+class CurveTest(unittest.TestCase):
+    def test_incomplete_curve_fails_when_made(self):
+        class Flat(fitmodels.Curve):
+            def evaluate(self, x):
+                return np.zeros_like(x)
+        self.assertRaises(TypeError, Flat)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+# Tests for history.py's calibration store.
+# Usage:
+#
+#     python -m unittest discover tests
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import history
+from benchmarks import synthetic
+
+
+class ArtifactNameTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.record = synthetic.record(np.random.RandomState(0), "cal000")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def store(self, name):
+        return history.History(os.path.join(self.directory, name))
+
+    def test_names_are_per_store_and_kept_on_rerun(self):
+        with self.store("a.sqlite") as store:
+            first = store.artifact_name(store.add(self.record))
+            # A corrected re-run of the same record keeps its name
+            self.assertEqual(store.artifact_name(store.add(self.record)),
+                             first)
+        with self.store("a.sqlite") as store:
+            self.assertEqual(store.artifact_name(1), first)
+            self.assertEqual(store.artifact(1, "report", "out"),
+                             os.path.join("out", "report-" + first + ".tex"))
+        with self.store("b.sqlite") as store:
+            self.assertNotEqual(store.artifact_name(store.add(self.record)),
+                                first)
+
+if __name__ == "__main__":
+    unittest.main()
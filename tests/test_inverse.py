@@ -0,0 +1,65 @@
+# Tests for inverse.py's worth queries, on fits to realistic calibrations.
+# Usage:
+#
+#     python -m unittest discover tests
+
+import unittest
+
+import numpy as np
+
+import inverse
+import rodcal
+from benchmarks import synthetic
+
+
+class WorthQueryTest(unittest.TestCase):
+    def setUp(self):
+        random = np.random.RandomState(0)
+        self.fits = []
+        for _ in xrange(20):
+            for rod in synthetic.calibration(random)[0]:
+                self.fits.append((rod[0],
+                                  rodcal.reactivity_calc(rod[0], rod[1:])[0]))
+
+    def test_realistic_fits_turn_over(self):
+        # The default range runs past where the fits turn over, so only the
+        # longest monotone stretch of it is indexed
+        for bottom, fit in self.fits:
+            query = inverse.WorthQuery(fit, lo=bottom)
+            self.assertTrue(90.0 < query.index.hi < 100.0)
+            self.assertTrue(np.isnan(query.worth(query.index.hi + 0.1)))
+            self.assertTrue(np.isnan(query.height_for_insertion(
+                query.index.hi + 0.1, 0.01)))
+            self.assertFalse(np.isnan(query.worth(query.index.hi)))
+            with self.assertRaises(ValueError):
+                inverse.MonotoneIndex(fit, bottom, 100.0, strict=True)
+
+    def test_agrees_with_roots(self):
+        for bottom, fit in self.fits:
+            query = inverse.WorthQuery(fit, lo=bottom)
+            # Not the ends, where np.roots finds a double root of a turning
+            # point only approximately
+            worth = np.linspace(query.index.y_min, query.index.y_max, 52)[1:-1]
+            np.testing.assert_allclose(query.height_for_worth(worth),
+                                       query.index.invert_exact(worth),
+                                       atol=1e-6)
+            self.assertTrue(np.isnan(query.height_for_worth(
+                query.index.y_max + 0.01)))
+
+    def test_error_bound(self):
+        for bottom, fit in self.fits:
+            index = inverse.WorthQuery(fit, lo=bottom).index
+            self.assertTrue(index.error_bound < 1e-3)
+            self.assertTrue(85.0 < index.bound_hi < index.hi)
+            heights = np.linspace(index.bound_lo, index.bound_hi, 50)
+            worth = index.poly(heights)
+            # np.roots itself is good to about 1e-9 %
+            self.assertTrue(np.all(np.abs(index.invert(worth) - heights) <=
+                                   index.error_bound + 1e-9))
+            np.testing.assert_array_equal(index.error_bounds(worth),
+                                          index.error_bound)
+            self.assertEqual(index.error_bounds(
+                index.poly((index.bound_hi + index.hi) / 2)), np.inf)
+
+if __name__ == "__main__":
+    unittest.main()
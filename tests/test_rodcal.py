@@ -0,0 +1,40 @@
+# Tests for rodcal.py's batched rod worth calculations. Usage:
+#
+#     python -m unittest discover tests
+
+import unittest
+
+import numpy as np
+
+import rodcal
+from benchmarks import synthetic
+
+
+class ReactivityCalcManyTest(unittest.TestCase):
+    def test_identical_to_reactivity_calc(self):
+        random = np.random.RandomState(0)
+        rods = []
+        for pulls in (8, 12, 12, 15):
+            for _ in xrange(25):
+                rods.extend(synthetic.calibration(random, pulls)[0])
+        for rod, many in zip(rods, rodcal.reactivity_calc_many(rods)):
+            single = rodcal.reactivity_calc(rod[0], rod[1:])
+            self.assertEqual(list(many[0].c), list(single[0].c))
+            self.assertEqual(many[1], single[1])
+            self.assertEqual(list(many[2].c), list(single[2].c))
+            self.assertEqual(many[3], single[3])
+
+    def test_batch_within_rounding(self):
+        random = np.random.RandomState(1)
+        bottom, heights, periods = synthetic.batch_arrays(random, 200)
+        int_c, integral, add_c, addition_rate = rodcal.reactivity_calc_batch(
+            bottom, heights, periods)
+        for i in xrange(len(bottom)):
+            single = rodcal.reactivity_calc(bottom[i],
+                                            zip(heights[i], periods[i]))
+            np.testing.assert_allclose(int_c[i], single[0].c, rtol=1e-9)
+            np.testing.assert_allclose(integral[i], single[1], rtol=1e-12)
+            np.testing.assert_allclose(add_c[i], single[2].c, rtol=1e-9)
+
+if __name__ == "__main__":
+    unittest.main()
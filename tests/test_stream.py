@@ -0,0 +1,27 @@
+# Tests for stream.py's live calibration.
+# Usage:
+#
+#     python -m unittest discover tests
+
+import StringIO
+import unittest
+
+import rodcal
+import stream
+
+
+class RunTest(unittest.TestCase):
+    def test_pull_that_does_not_move_is_skipped(self):
+        out = StringIO.StringIO()
+        rod = stream.run(["50", "55 30000", "55 40000", "60 20000",
+                          "70 15000", "100 9000"], out=out)
+        self.assertIn("Skipped 55 40000", out.getvalue())
+        self.assertEqual(rod.pulls, [(55.0, 30.0), (60.0, 20.0),
+                                     (70.0, 15.0), (100.0, 9.0)])
+        # What was added still agrees with reactivity_calc()
+        self.assertAlmostEqual(rod.integral_fit()(0),
+                               rodcal.reactivity_calc(50.0, rod.pulls)[0](0))
+        self.assertRaises(ValueError, rod.add, 99.0, 10.0)
+
+if __name__ == "__main__":
+    unittest.main()
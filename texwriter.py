@@ -0,0 +1,195 @@
+# Streaming LaTeX output
+#
+# Templates are split at their placeholders once, when first used, and then
+# written out piece by piece straight to the .tex file. Tables are formatted
+# from arrays a block of rows at a time, with one % operation per block
+# instead of one str.format() per cell, and each block is written as soon as
+# it's ready. Time is linear in the size of the table and memory is bounded
+# by the block size, however fine the table.
+
+import os
+import re
+
+import numpy as np
+
+# Placeholders as in template-worthtable.tex: (safedata)
+PAREN = re.compile(r"\((\w+)\)")
+# Placeholders as in template-report.tex and template-banktable.tex, with the
+# conversions they use: %(tablebody)s, %(numpowers)i. %% is a literal %.
+PERCENT = re.compile(r"%(?:\((\w+)\)([si])|%)")
+
+# Rows per block written by the table generators
+CHUNK_ROWS = 4096
+
+# (absolute filename, pattern) -> (modification time, Template)
+_templates = {}
+
+
+class Template(object):
+    """
+    A LaTeX template split at its placeholders.
+
+    Fill one in with write(), giving a value for each placeholder: a string or
+    number, or an iterable of strings (e.g. one of the table generators
+    below), which is written chunk by chunk as it's produced. An iterable is
+    only consumed once, so should only fill a placeholder that appears once.
+    """
+    def __init__(self, text, pattern=PERCENT):
+        """
+        Args:
+            text: The template's contents.
+            pattern: PERCENT or PAREN, the placeholder syntax it uses.
+        """
+        self.pattern = pattern
+        # Alternating literal text and placeholders: a placeholder is a
+        # (name, conversion, original text) tuple
+        self.parts = []
+        position = 0
+        for match in pattern.finditer(text):
+            self.parts.append(text[position:match.start()])
+            if match.group(1) is None:  # %%
+                self.parts.append("%")
+            else:
+                conversion = match.group(2) if pattern is PERCENT else "s"
+                self.parts.append((match.group(1), conversion,
+                                   match.group(0)))
+            position = match.end()
+        self.parts.append(text[position:])
+
+    def write(self, f, values):
+        """
+        Write the filled-in template to an open file.
+
+        Args:
+            f: The file.
+            values: A dict of the value for each placeholder. A PAREN
+                placeholder with no value is left as it is; a PERCENT one
+                raises KeyError, as the % operator would.
+        """
+        for part in self.parts:
+            if isinstance(part, basestring):
+                f.write(part)
+                continue
+
+            name, conversion, original = part
+            if name not in values and self.pattern is PAREN:
+                f.write(original)
+                continue
+            value = values[name]
+            if isinstance(value, basestring):
+                f.write(value)
+            elif hasattr(value, "__iter__"):
+                for chunk in value:
+                    f.write(chunk)
+            else:
+                f.write(("%" + conversion) % value)
+
+    def fill(self, filename, values):
+        """
+        Write the filled-in template to a file.
+
+        Returns:
+            filename.
+        """
+        with open(filename, "w") as f:
+            self.write(f, values)
+        return filename
+
+
+def template(filename, pattern=PERCENT):
+    """
+    Load and split a template file, or return the already-split template if
+    the file hasn't changed since.
+    """
+    key = (os.path.abspath(filename), pattern.pattern)
+    mtime = os.path.getmtime(filename)
+    cached = _templates.get(key)
+    if cached is None or cached[0] != mtime:
+        with open(filename) as f:
+            cached = (mtime, Template(f.read(), pattern))
+        _templates[key] = cached
+    return cached[1]
+
+def worth_table(data, columns, chunk_rows=CHUNK_ROWS):
+    """
+    Generate the rows of a LaTeX tabular environment for one page of one rod's
+    worth table, as rodcal.tex_one_table() describes: the (%, $) pairs run
+    down each pair of columns in turn, and the last pair of columns may be
+    short.
+
+    Args:
+        data: [(%, $), ...], or the same as an N x 2 array.
+        columns: The number of pairs wide the table should be.
+        chunk_rows: The most rows to format at once.
+
+    Yields:
+        Blocks of rows, each ending in LaTeX's \\\\ and a newline.
+    """
+    data = np.asarray(data, dtype=float).reshape(-1, 2)
+    n = len(data)
+    if n == 0:
+        return
+    rows = -(-n // columns)
+    cols = -(-n // rows)
+    # Rows that reach into the last column, which may be short
+    full = n - (cols - 1) * rows
+
+    padded = np.zeros((cols * rows, 2))
+    padded[:n] = data
+    # cells[i, c] is the pair in row i of column c
+    cells = padded.reshape(cols, rows, 2).transpose(1, 0, 2)
+
+    cell = "%.1f & \\$%.2f"
+    full_row = " & ".join([cell] * cols) + "\\\\\n"
+    short_row = " & ".join([cell] * (cols - 1) + [" & "]) + "\\\\\n"
+
+    for start in xrange(0, rows, chunk_rows):
+        stop = min(start + chunk_rows, rows)
+        if start < full:
+            end = min(stop, full)
+            yield (full_row * (end - start)) % tuple(
+                cells[start:end].ravel().tolist())
+        if stop > full:
+            begin = max(start, full)
+            yield (short_row * (stop - begin)) % tuple(
+                cells[begin:stop, :-1].ravel().tolist())
+
+def bank_table(data, core_excesses, bold, decimals=2,
+               chunk_rows=CHUNK_ROWS):
+    """
+    Generate the body of the banked rod height table: one row per core
+    excess, giving the excess and then the rod height for each power, rounded
+    to the nearest %. Heights above 100.5% are left blank.
+
+    Args:
+        data: The heights, an array of core excesses x powers.
+        core_excesses: The core excess of each row, in dollars.
+        bold: A boolean for each row, whether to set it in bold.
+        decimals: Decimal places for the core excesses.
+        chunk_rows: The most rows to format at once.
+
+    Yields:
+        Blocks of rows, each row ending in LaTeX's \\\\.
+    """
+    data = np.asarray(data, dtype=float)
+    bold = np.asarray(bold, dtype=bool)
+    # Round half away from zero, as round() does, which np.round doesn't
+    rounded = (np.sign(data) * np.floor(np.abs(data) + 0.5)).astype(np.int64)
+    blank = ~(data < 100.5)
+
+    for start in xrange(0, len(data), chunk_rows):
+        stop = min(start + chunk_rows, len(data))
+        cells = np.char.mod("%d", rounded[start:stop]).astype(object)
+        cells[blank[start:stop]] = ""
+        excesses = np.char.mod("\\$%.{}f".format(decimals),
+                               np.asarray(core_excesses[start:stop],
+                                          dtype=float)).astype(object)
+
+        # Bold rows' excess and non-blank heights
+        rows_bold = bold[start:stop]
+        excesses[rows_bold] = "\\textbf{" + excesses[rows_bold] + "}"
+        embolden = rows_bold[:, np.newaxis] & ~blank[start:stop]
+        cells[embolden] = "\\textbf{" + cells[embolden] + "}"
+
+        yield "".join(excess + "".join(" & " + cell for cell in row) + "\\\\"
+                      for excess, row in zip(excesses, cells.tolist()))
@@ -0,0 +1,235 @@
+# Concurrent, cached pdflatex typesetting
+#
+# Generated .tex files are typeset in a bounded pool of worker threads (the
+# work itself happens in the pdflatex subprocesses). Finished PDFs are cached
+# under a hash of everything that goes into them, so re-running an unchanged
+# calibration copies the old PDF instead of running pdflatex again.
+
+import datetime
+import hashlib
+import multiprocessing
+import multiprocessing.pool
+import os
+import shutil
+import subprocess
+import tempfile
+
+import instrument
+
+# Where finished PDFs are kept. Set RODCAL_TEX_CACHE to move it, or to an empty
+# string to turn caching off.
+CACHE_DIR = os.environ.get("RODCAL_TEX_CACHE",
+                           os.path.join(os.path.expanduser("~"), ".cache",
+                                        "rodcal"))
+
+
+class TypesetError(Exception):
+    """
+    pdflatex failed, or couldn't be run at all. The message includes the end
+    of the LaTeX log when there is one.
+    """
+    def __init__(self, filename, message):
+        Exception.__init__(self, "{}: {}".format(filename, message))
+        self.filename = filename
+
+
+def cache_key(filename, template=None, dependencies=()):
+    """
+    Hash everything that determines the typeset PDF.
+
+    Args:
+        filename: The generated .tex file.
+        template: The template it was generated from, if any.
+        dependencies: Other files the document pulls in, e.g. the plots
+            included by the report. Paths are relative to the .tex file.
+
+    Returns:
+        A hex digest.
+    """
+    directory = os.path.dirname(filename)
+    hasher = hashlib.sha1()
+    with open(filename, "rb") as f:
+        source = f.read()
+    hasher.update(source)
+    # A document that prints the date is only the same document on the same day
+    if "\\today" in source:
+        hasher.update(datetime.date.today().isoformat())
+
+    paths = ([template] if template else []) + [os.path.join(directory, path)
+                                                for path in dependencies]
+    for path in paths:
+        hasher.update("\0" + os.path.basename(path) + "\0")
+        with open(path, "rb") as f:
+            hasher.update(f.read())
+    return hasher.hexdigest()
+
+def typeset(filename, template=None, dependencies=(), cache_dir=CACHE_DIR):
+    """
+    Typeset a generated .tex file with pdflatex, or copy the PDF from the cache
+    if the same document has been typeset before.
+
+    Args:
+        filename: The .tex file to typeset. pdflatex runs from the directory
+            containing it.
+        template: The template it was generated from, if any.
+        dependencies: Other files the document pulls in, relative to the .tex
+            file.
+        cache_dir: Where finished PDFs are cached, or None for no caching.
+
+    Returns:
+        The filename of the final typeset PDF.
+
+    Raises:
+        TypesetError: pdflatex failed or didn't produce a PDF.
+    """
+    pdf = filename[:-len(".tex")] + ".pdf"
+
+    cached = None
+    if cache_dir:
+        cached = os.path.join(cache_dir,
+                              cache_key(filename, template, dependencies) +
+                              ".pdf")
+        if os.path.exists(cached):
+            shutil.copyfile(cached, pdf)
+            return pdf
+
+    directory, basename = os.path.split(filename)
+    if os.path.exists(pdf):
+        os.remove(pdf)
+    try:
+        with instrument.stage("pdflatex", file=filename):
+            returncode = subprocess.call(
+                ["pdflatex", "-interaction=batchmode", "-halt-on-error",
+                 basename],
+                cwd=directory or None)
+    except OSError as e:
+        raise TypesetError(filename, "couldn't run pdflatex: {}".format(e))
+
+    if returncode != 0 or not os.path.exists(pdf):
+        raise TypesetError(filename, "pdflatex exited with status {}\n{}"
+                                     .format(returncode, _log_tail(filename)))
+
+    if cached:
+        _store(pdf, cached)
+    return pdf
+
+def _log_tail(filename, lines=20):
+    """
+    The last few lines of the LaTeX log for filename, where errors end up in
+    batch mode.
+    """
+    log = filename[:-len(".tex")] + ".log"
+    if not os.path.exists(log):
+        return "(no log)"
+    with open(log) as f:
+        return "".join(f.readlines()[-lines:])
+
+def _store(pdf, cached):
+    """
+    Copy a PDF into the cache. The copy is renamed into place so that
+    concurrent jobs never see a partial file.
+    """
+    cache_dir = os.path.dirname(cached)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, temp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(pdf, temp)
+        os.rename(temp, cached)
+    except (IOError, OSError):
+        # The cache is only an optimization; the PDF itself is fine.
+        pass
+
+
+class Typesetter(object):
+    """
+    A bounded pool of concurrent typesetting jobs.
+
+    Jobs are submitted with submit(), which returns at once; wait() blocks
+    until they have all finished. Use as a context manager to close the pool
+    when done:
+
+        with Typesetter() as typesetter:
+            typesetter.submit("report.tex", "template-report.tex")
+            typesetter.submit("worthtable.tex", "template-worthtable.tex")
+            pdfs = typesetter.wait()
+    """
+    def __init__(self, processes=None, cache_dir=CACHE_DIR):
+        """
+        Args:
+            processes: The most pdflatex jobs to run at once; defaults to the
+                number of CPUs.
+            cache_dir: Where finished PDFs are cached, or None for no caching.
+        """
+        self.pool = multiprocessing.pool.ThreadPool(
+            processes or multiprocessing.cpu_count())
+        self.cache_dir = cache_dir
+        self.jobs = []
+
+    def submit(self, filename, template=None, dependencies=()):
+        """
+        Queue a .tex file for typesetting; the arguments are as for typeset().
+
+        Returns:
+            A multiprocessing AsyncResult for the PDF filename.
+        """
+        job = self.pool.apply_async(typeset, (filename, template,
+                                              dependencies, self.cache_dir))
+        self.jobs.append(job)
+        return job
+
+    def wait(self):
+        """
+        Wait for every submitted job to finish.
+
+        Returns:
+            The PDF filenames, in the order the jobs were submitted.
+
+        Raises:
+            TypesetError: One or more jobs failed. The message covers all of
+                them.
+        """
+        jobs, self.jobs = self.jobs, []
+        pdfs = []
+        errors = []
+        for job in jobs:
+            try:
+                pdfs.append(job.get())
+            except TypesetError as e:
+                errors.append(e)
+        if len(errors) == 1:
+            raise errors[0]
+        if errors:
+            raise TypesetError("{} documents".format(len(errors)),
+                               "\n".join(str(e) for e in errors))
+        return pdfs
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def typeset_all(jobs, processes=None, cache_dir=CACHE_DIR):
+    """
+    Typeset several documents at once.
+
+    Args:
+        jobs: A list of (filename, template, dependencies) tuples, as for
+            typeset().
+        processes: The most pdflatex jobs to run at once.
+        cache_dir: Where finished PDFs are cached, or None for no caching.
+
+    Returns:
+        The PDF filenames, in the same order as jobs.
+    """
+    with Typesetter(processes, cache_dir) as typesetter:
+        for job in jobs:
+            typesetter.submit(*job)
+        return typesetter.wait()
@@ -0,0 +1,201 @@
+# Monte Carlo uncertainty propagation for a calibration
+#
+# Perturbs every height and period reading many times, pushes all the samples
+# through the same inhour equation, cubic fits and Tech Specs arithmetic as
+# rodcal, and reports confidence intervals on the results. Samples go through
+# reactivity_calc_batch() a block at a time, so 100,000 samples take seconds
+# and a bounded amount of memory. Usage:
+#
+#     python uncertainty.py records.json [-n 100000] [--height-sigma 0.1]
+#                                        [--period-sigma 0.02]
+
+import argparse
+
+import numpy as np
+
+import rodcal
+import sweep
+
+RODS = ["safe", "shim", "reg"]
+
+# The quantities reported, with their Tech Specs limits: (name, description,
+# units, "<" or ">" the limit, limit). Quantities without a limit have None.
+QUANTITIES = [
+    ("safeworth", "Safe rod worth", "$", None, None),
+    ("shimworth", "Shim rod worth", "$", None, None),
+    ("regworth", "Reg rod worth", "$", None, None),
+    ("totalworth", "Total worth", "$", None, None),
+    ("safemaxdps", "Safe max. addition rate", "c/s", "<", 12),
+    ("shimmaxdps", "Shim max. addition rate", "c/s", "<", 12),
+    ("regmaxdps", "Reg max. addition rate", "c/s", "<", 12),
+    ("safecxs", "Core excess (Safe)", "$", "<", 3),
+    ("shimcxs", "Core excess (Shim)", "$", "<", 3),
+    ("safesdm", "Shutdown margin (Safe)", "$", ">", 1),
+    ("shimsdm", "Shutdown margin (Shim)", "$", ">", 1),
+    ("safeosr", "One-stuck-rod SDM (Safe)", "$", ">", 0.5),
+    ("shimosr", "One-stuck-rod SDM (Shim)", "$", ">", 0.5),
+]
+
+
+def sample(rod_pulls, withdrawal_times, samples=100000, height_sigma=0.1,
+           period_sigma=0.02, seed=None, block=10000, together=False):
+    """
+    Draw perturbed copies of a calibration and compute the Tech Specs
+    quantities for each.
+
+    Every height reading (including each rod's critical height) gets
+    independent normal noise with standard deviation height_sigma, and every
+    period reading is scaled by independent normal noise of relative size
+    period_sigma. When the Safe and Shim were calibrated together, each
+    period was read once for both rods (see rodcal.together_pulls()), so
+    both rods' pulls get that reading's one perturbation.
+
+    Args:
+        rod_pulls: [safe, shim, reg], each in the form collect_rod() returns.
+        withdrawal_times: The [safe, shim, reg] withdrawal times, in seconds.
+        samples: The number of perturbed copies.
+        height_sigma: The standard deviation of height readings, in %.
+        period_sigma: The relative standard deviation of period readings.
+        seed: Seed for the random number generator, for repeatable runs.
+        block: How many samples to fit at a time; bounds memory use.
+        together: Whether the Safe and Shim were calibrated together.
+
+    Returns:
+        A dict from each name in QUANTITIES to an array of samples.
+
+    Raises:
+        ValueError: together, but the Safe and Shim pulls don't share their
+            periods as rodcal.together_pulls() gives them.
+    """
+    if together:
+        safe_periods = [period for _, period in rod_pulls[0][1:]]
+        shim_periods = [period for _, period in rod_pulls[1][1:]]
+        if safe_periods != shim_periods[::-1]:
+            raise ValueError("the Safe and Shim pulls don't share periods, "
+                             "so weren't calibrated together")
+
+    random = np.random.RandomState(seed)
+    values = dict((name, np.empty(samples)) for name, _, _, _, _ in QUANTITIES)
+
+    for first in xrange(0, samples, block):
+        count = min(block, samples - first)
+        fits = {}
+        bottoms = {}
+        period_noise = None
+        for rod, pulls in zip(RODS, rod_pulls):
+            heights, periods = np.array(pulls[1:], dtype=float).T
+            bottom = (pulls[0] + height_sigma *
+                      random.standard_normal(count))
+            heights = (heights + height_sigma *
+                       random.standard_normal((count, len(heights))))
+            if together and rod == "shim":
+                # The Shim's pulls are the Safe's readings in reverse
+                period_noise = period_noise[:, ::-1]
+            else:
+                period_noise = random.standard_normal((count, len(periods)))
+            periods = periods * (1.0 + period_sigma * period_noise)
+            int_c, _, add_c, _ = rodcal.reactivity_calc_batch(bottom, heights,
+                                                              periods)
+            fits[rod] = (int_c, add_c)
+            bottoms[rod] = bottom
+
+        block_values = sweep.tech_spec_values(fits, bottoms["safe"],
+                                              bottoms["shim"],
+                                              withdrawal_times)
+        for name in values:
+            values[name][first:first + count] = block_values[name]
+
+    return values
+
+def propagate(rod_pulls, withdrawal_times, samples=100000, height_sigma=0.1,
+              period_sigma=0.02, confidence=0.95, seed=None, together=False):
+    """
+    Summarize the spread of the Tech Specs quantities under measurement error.
+
+    Args:
+        rod_pulls, withdrawal_times, samples, height_sigma, period_sigma,
+            seed, together: As for sample().
+        confidence: The confidence level of the reported intervals.
+
+    Returns:
+        A dict from each name in QUANTITIES to a dict with the point
+        "estimate" (from the unperturbed data), "nan": the number of samples
+        for which it couldn't be worked out (e.g. no critical height in
+        range), and over the rest, the sample "mean" and "std", the
+        confidence interval "low" and "high", and for quantities with a
+        limit, "fail": the fraction of samples that fail it.
+    """
+    values = sample(rod_pulls, withdrawal_times, samples, height_sigma,
+                    period_sigma, seed, together=together)
+    fits = {}
+    for rod, pulls in zip(RODS, rod_pulls):
+        int_c, _, add_c, _ = rodcal.reactivity_calc_batch(
+            [pulls[0]], [[height for height, _ in pulls[1:]]],
+            [[period for _, period in pulls[1:]]])
+        fits[rod] = (int_c, add_c)
+    estimates = sweep.tech_spec_values(fits, np.array([rod_pulls[0][0]]),
+                                       np.array([rod_pulls[1][0]]),
+                                       withdrawal_times)
+
+    tail = (1 - confidence) / 2 * 100
+    summary = {}
+    for name, _, _, sense, limit in QUANTITIES:
+        # Samples that came out NaN are counted, and left out of the
+        # intervals and the failure fractions alike
+        nan = np.isnan(values[name])
+        finite = values[name][~nan]
+        low, high = np.nanpercentile(values[name], [tail, 100 - tail])
+        summary[name] = {"estimate": estimates[name][0],
+                         "nan": int(nan.sum()),
+                         "mean": np.nanmean(values[name]),
+                         "std": np.nanstd(values[name]),
+                         "low": low,
+                         "high": high}
+        if sense == "<":
+            summary[name]["fail"] = np.mean(~(finite < limit))
+        elif sense == ">":
+            summary[name]["fail"] = np.mean(~(finite > limit))
+    return summary
+
+def main():
+    import batch
+
+    parser = argparse.ArgumentParser(
+        description="Propagate measurement error through calibrations.")
+    parser.add_argument("files", nargs="+",
+                        help="JSON or CSV files of calibration records, as "
+                             "for batch.py")
+    parser.add_argument("-n", "--samples", type=int, default=100000)
+    parser.add_argument("--height-sigma", type=float, default=0.1,
+                        help="standard deviation of height readings, in %% "
+                             "(default: 0.1)")
+    parser.add_argument("--period-sigma", type=float, default=0.02,
+                        help="relative standard deviation of period readings "
+                             "(default: 0.02)")
+    parser.add_argument("--confidence", type=float, default=0.95)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    for filename in args.files:
+        for record in batch.load_records(filename):
+            summary = propagate(batch.rod_pulls(record),
+                                record["withdrawal_times"], args.samples,
+                                args.height_sigma, args.period_sigma,
+                                args.confidence, args.seed,
+                                batch.calibrated_together(record))
+            print "{} ({} samples, {:g}% intervals)".format(
+                record["id"], args.samples, args.confidence * 100)
+            for name, description, units, sense, limit in QUANTITIES:
+                s = summary[name]
+                line = "  {:<26} {:8.3f}  [{:8.3f}, {:8.3f}] {:<3}".format(
+                    description, s["estimate"], s["low"], s["high"], units)
+                if limit is not None:
+                    line += "  spec {} {:g}: P(fail) = {:.4f}".format(
+                        sense, limit, s["fail"])
+                if s["nan"]:
+                    line += "  ({} samples undefined)".format(s["nan"])
+                print line
+            print
+
+if __name__ == "__main__":
+    main()
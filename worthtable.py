@@ -0,0 +1,178 @@
+# Array-backed rod worth tables
+#
+# The same tables tabular_data() produces for the logbook, but as structured
+# numpy arrays at any resolution, with a binary file format that other tools
+# can memory-map. A file is a fixed 128-byte header followed by the table rows:
+#
+#     magic        8 bytes  "RODWORTH"
+#     version      uint32   FORMAT_VERSION
+#     rod          12 bytes "safe", "shim" or "reg", NUL-padded
+#     coefficients 4 x f8   the integral worth cubic, highest power first
+#                           (NaN for other curves from fitmodels.py)
+#     start        f8       the first height in the table, %
+#     stop         f8       the table runs up to but not including this, %
+#     step         f8       the spacing of the heights, %
+#     count        uint64   the number of rows
+#     (reserved to 128 bytes)
+#     rows         count x (height f8, worth f8)
+#
+# All values are little-endian. Row i is at byte 128 + 16 * i and holds the
+# height start + i * step, so any height can be found without a search.
+
+import numpy as np
+
+import fitmodels
+
+MAGIC = "RODWORTH"
+FORMAT_VERSION = 1
+
+ROW = np.dtype([("height", "<f8"), ("worth", "<f8")])
+HEADER = np.dtype([("magic", "S8"),
+                   ("version", "<u4"),
+                   ("rod", "S12"),
+                   ("coefficients", "<f8", (4,)),
+                   ("start", "<f8"),
+                   ("stop", "<f8"),
+                   ("step", "<f8"),
+                   ("count", "<u8"),
+                   ("reserved", "V40")])
+
+# Where the logbook tables start, as in rodcal.tabular_data()
+STARTS = {"safe": 48.0, "shim": 48.0, "reg": 0.0}
+
+
+def build(fit, start, stop=100.0, step=0.1):
+    """
+    Tabulate an integral worth fit.
+
+    Args:
+        fit: The integral rod worth fit, as a np.poly1d or another curve from
+            fitmodels.py.
+        start: The first height, in %.
+        stop: The table runs up to but not including this height.
+        step: The spacing of the heights, e.g. 0.001 for thousandths of a
+            percent.
+
+    Returns:
+        A structured array of ROW, one row per height.
+    """
+    heights = np.arange(start, stop, step)
+    table = np.empty(len(heights), dtype=ROW)
+    table["height"] = heights
+    table["worth"] = fit(heights)
+    return table
+
+def build_all(cubics, step=0.1):
+    """
+    The array version of rodcal.tabular_data().
+
+    Args:
+        cubics: [safe, shim, reg], where each is the integral rod worth fit, as
+            a numpy poly1d instance or another curve from fitmodels.py.
+        step: The spacing of the heights, in %.
+
+    Returns:
+        [safe, shim, reg], each a structured array from build(), from 48% (for
+            the Safe and Shim) or 0% (for the Reg) up to 100%.
+    """
+    return [build(fit, STARTS[rod], step=step)
+            for rod, fit in zip(["safe", "shim", "reg"], cubics)]
+
+def save(filename, rod, fit, start, stop=100.0, step=0.1):
+    """
+    Tabulate an integral worth fit straight into a worth table file.
+
+    Args:
+        filename: The file to write.
+        rod: "safe", "shim", or "reg".
+        fit, start, stop, step: As for build().
+
+    Returns:
+        filename.
+    """
+    table = build(fit, start, stop, step)
+
+    header = np.zeros(1, dtype=HEADER)
+    header["magic"] = MAGIC
+    header["version"] = FORMAT_VERSION
+    header["rod"] = rod
+    if isinstance(fit, fitmodels.Curve) and not isinstance(fit, np.poly1d):
+        header["coefficients"] = np.nan
+    else:
+        header["coefficients"] = np.poly1d(fit).c
+    header["start"] = start
+    header["stop"] = stop
+    header["step"] = step
+    header["count"] = len(table)
+
+    with open(filename, "wb") as f:
+        header.tofile(f)
+        table.tofile(f)
+    return filename
+
+
+class MappedWorthTable(object):
+    """
+    A worth table file opened as a memory map. Only the pages that lookups
+    touch are read from disk.
+
+    Attributes:
+        rod: "safe", "shim", or "reg".
+        fit: The integral worth cubic from the header, as a np.poly1d, or
+            None if the table was made from another curve.
+        start, stop, step: The range and spacing of the heights.
+        rows: The table itself, a read-only memory-mapped array of ROW.
+    """
+    def __init__(self, filename):
+        header = np.fromfile(filename, dtype=HEADER, count=1)
+        if len(header) != 1 or header["magic"][0] != MAGIC:
+            raise ValueError("{} is not a worth table file".format(filename))
+        if header["version"][0] != FORMAT_VERSION:
+            raise ValueError("{} has unsupported format version {}".format(
+                filename, header["version"][0]))
+        header = header[0]
+
+        self.rod = header["rod"]
+        coefficients = header["coefficients"]
+        self.fit = (None if np.isnan(coefficients).any()
+                    else np.poly1d(coefficients))
+        self.start = float(header["start"])
+        self.stop = float(header["stop"])
+        self.step = float(header["step"])
+        self.rows = np.memmap(filename, dtype=ROW, mode="r",
+                              offset=HEADER.itemsize,
+                              shape=(int(header["count"]),))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def index(self, height):
+        """
+        The row nearest to each height, clipped to the table.
+
+        Args:
+            height: Heights in %, scalar or array.
+
+        Returns:
+            Row indices, with the same shape as height.
+        """
+        i = np.rint((np.asarray(height, dtype=float) - self.start) / self.step)
+        return np.clip(i, 0, len(self.rows) - 1).astype(np.intp)
+
+    def worth(self, height):
+        """
+        Look up the tabulated integral worth at the row nearest each height,
+        as an operator would read it off the printed table.
+
+        Args:
+            height: Heights in %, scalar or array.
+
+        Returns:
+            Worths in dollars, with the same shape as height. Heights
+            outside the table's range, from half a step below start up to
+            stop, give NaN.
+        """
+        height = np.asarray(height, dtype=float)
+        worth = self.rows["worth"][self.index(height)]
+        outside = (height < self.start - self.step / 2.0) | (height > self.stop)
+        return np.where(outside, np.nan, worth)[()]